@@ -0,0 +1,69 @@
+"""Compare coordinate chunking strategies used by ``get_seg_at_location``.
+
+Reports run time, number of requests and per-request locality for
+synthetic, clustered "synapse-like" point clouds. Locality is measured as
+the number of block loads: the distinct 64^3 voxel blocks touched by each
+request, summed over all requests (i.e. how many blocks the server has to
+load) - lower is better.
+
+Usage::
+
+    python benchmarks/bench_chunking.py [n_points ...]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from brainmappy.utils import chunk_coords
+
+CHUNKSIZE = 200
+
+# k-means gets painfully slow - skip it above this many points
+MAX_KMEANS = 200_000
+
+
+def make_coords(n, n_clusters=500, seed=0):
+    """Generate clustered voxel coordinates."""
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, [50_000, 50_000, 7_000], size=(n_clusters, 3))
+    labels = rng.integers(0, n_clusters, n)
+    jitter = rng.normal(scale=[500, 500, 50], size=(n, 3))
+    return (centers[labels] + jitter).round().astype(int)
+
+
+def locality(coords, chunks, block=64):
+    """Total number of distinct blocks touched per chunk."""
+    blocks = coords // block
+    return sum(len(np.unique(blocks[ix], axis=0)) for ix in chunks)
+
+
+def main(sizes):
+    print(
+        "{:>10} {:>8} {:>10} {:>10} {:>12}".format(
+            "n_points", "method", "time [s]", "requests", "block loads"
+        )
+    )
+    for n in sizes:
+        coords = make_coords(n)
+        for method in ("kmeans", "morton", "grid"):
+            if method == "kmeans" and n > MAX_KMEANS:
+                print("{:>10} {:>8} {:>10}".format(n, method, "skipped"))
+                continue
+
+            start = time.perf_counter()
+            chunks = chunk_coords(coords, CHUNKSIZE, method=method)
+            dur = time.perf_counter() - start
+
+            print(
+                "{:>10} {:>8} {:>10.3f} {:>10} {:>12}".format(
+                    n, method, dur, len(chunks), locality(coords, chunks)
+                )
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(float(s)) for s in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    main(sizes)
@@ -0,0 +1,184 @@
+"""CPU micro-benchmarks for decoding, chunking and mesh assembly.
+
+These are `asv <https://asv.readthedocs.io>`_ benchmarks: run them across
+commits (results are stored per commit in ``.asv/results``) with e.g.::
+
+    asv run master~10..master
+    asv compare HEAD~1 HEAD
+
+For a quick run against the working tree::
+
+    asv run --python=same --quick
+
+All inputs are synthetic and generated in ``setup`` - no network access
+required.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from brainmappy import io, mesh, utils
+from brainmappy.fetch import _SegBlock, _assemble_fragments
+
+
+def make_ng(n_frags, n_verts=10, n_faces=20, seed=0):
+    """Generate neuroglancer binary with ``n_frags`` fragments."""
+    rng = np.random.default_rng(seed)
+    verts = (rng.random((n_verts, 3)) * 10_000).astype("<f4").tobytes()
+    faces = rng.integers(0, n_verts, (n_faces, 3)).astype("<u4").tobytes()
+    counts = struct.pack("<2q", n_verts, n_faces)
+
+    chunks = []
+    for i in range(n_frags):
+        fn = "{:x}".format(i).encode()
+        chunks.append(struct.pack("<QI4x", 10_000 + i, len(fn)) + fn)
+        chunks.append(counts + verts + faces)
+    return b"".join(chunks)
+
+
+def make_coords(n, seed=0):
+    """Generate clustered voxel coordinates."""
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, [50_000, 50_000, 7_000], size=(max(n // 200, 1), 3))
+    labels = rng.integers(0, len(centers), n)
+    jitter = rng.normal(scale=[500, 500, 50], size=(n, 3))
+    return (centers[labels] + jitter).round().astype(int)
+
+
+def make_mesh(n_verts, seed=0):
+    """Generate random vertices and faces."""
+    rng = np.random.default_rng(seed)
+    verts = (rng.random((n_verts, 3)) * 10_000).astype(np.float32)
+    faces = rng.integers(0, n_verts, (n_verts * 2, 3)).astype(np.uint32)
+    return verts, faces
+
+
+class DecodeNG:
+    """Parsing of neuroglancer's binary mesh format."""
+
+    params = [1, 100, 10_000, 100_000]
+    param_names = ["fragments"]
+
+    def setup(self, n):
+        self.data = make_ng(n)
+        self.decoded = io._decode_raw_ng(self.data)
+
+    def time_parse_raw_ng(self, n):
+        io.parse_raw_ng(self.data)
+
+    def time_scan_raw_ng(self, n):
+        io._scan_raw_ng(io._as_buffer(self.data))
+
+    def time_decode_raw_ng(self, n):
+        io._decode_raw_ng(self.data)
+
+    def time_split_fragments(self, n):
+        io._split_fragments(*self.decoded)
+
+    def peakmem_decode_raw_ng(self, n):
+        io._decode_raw_ng(self.data)
+
+
+class ChunkCoords:
+    """Grouping of coordinates into requests for ``get_seg_at_location``."""
+
+    params = [["morton", "grid", "kmeans"], [1_000, 10_000, 100_000]]
+    param_names = ["method", "points"]
+    timeout = 300
+
+    def setup(self, method, n):
+        self.coords = make_coords(n)
+
+    def time_chunk_coords(self, method, n):
+        utils.chunk_coords(self.coords, 200, method=method)
+
+
+class SegRequests:
+    """Deduplication, chunking and serialization of segmentation requests."""
+
+    params = [1_000, 10_000, 100_000]
+    param_names = ["points"]
+
+    def setup(self, n):
+        self.coords = make_coords(n)
+        self.block = self._block()
+
+        # Responses with large (> 2**63) segment IDs
+        rng = np.random.default_rng(0)
+        self.responses = [
+            json.dumps(
+                {"uint64StrList": {"values": [str(2**63 + x) for x in ids.tolist()]}}
+            ).encode()
+            for ids in (rng.integers(0, 2**40, len(ix)) for ix in self.block.requests)
+        ]
+
+    def _block(self):
+        return _SegBlock(
+            self.coords,
+            offset=0,
+            raw_px_dims=None,
+            chunking="morton",
+            memo=None,
+            volume_id="volume",
+            change_stack_id=None,
+        )
+
+    def time_prepare(self, n):
+        self._block()
+
+    def time_serialize(self, n):
+        for i in range(len(self.block.requests)):
+            self.block.post(i)
+
+    def time_parse(self, n):
+        for content in self.responses:
+            _SegBlock.parse(content)
+
+    def time_result(self, n):
+        for i in range(len(self.block.requests)):
+            ids = np.ones(len(self.block.requests[i]), dtype=np.uint64)
+            self.block.update(i, ids)
+
+
+class AssembleMesh:
+    """Stacking fragments with face offsets and building the final mesh."""
+
+    params = [10, 1_000, 10_000]
+    param_names = ["fragments"]
+
+    def setup(self, n):
+        pieces = io._split_fragments(*io._decode_raw_ng(make_ng(n)))
+        self.frags = list(pieces)
+        self.pieces = pieces
+        self.verts_list = [v for v, _ in pieces.values()]
+        self.faces_list = [f for _, f in pieces.values()]
+
+    def time_stack_meshes(self, n):
+        io._stack_meshes(self.verts_list, self.faces_list)
+
+    def time_assemble_fragments(self, n):
+        _assemble_fragments(self.frags, self.pieces)
+
+
+class Trimesh:
+    """Construction of the mesh at the end of ``get_meshes_batch``."""
+
+    params = [1_000, 100_000, 1_000_000]
+    param_names = ["vertices"]
+
+    def setup(self, n):
+        import trimesh
+
+        self.trimesh = trimesh
+        self.verts, self.faces = make_mesh(n)
+
+    def time_trimesh(self, n):
+        self.trimesh.Trimesh(self.verts, self.faces)
+
+    def time_trimesh_no_process(self, n):
+        self.trimesh.Trimesh(self.verts, self.faces, process=False)
+
+    def time_weld_vertices(self, n):
+        mesh.weld_vertices(self.verts, self.faces)
@@ -0,0 +1,83 @@
+"""Measure how long ``import brainmappy`` takes and what it pulls in.
+
+Runs the import in fresh interpreters with ``-X importtime`` and reports
+the best cumulative import time. Exits with a non-zero status if the import
+exceeds the time budget or loads any of the heavy dependencies that are
+supposed to be imported on first use only - use this to guard against
+regressions.
+
+Usage::
+
+    python benchmarks/bench_import.py [budget in ms]
+
+"""
+
+import subprocess
+import sys
+
+# Default budget in milliseconds
+BUDGET = 500
+
+# Number of runs - we report the fastest
+REPEATS = 5
+
+# These must not be imported by `import brainmappy`
+LAZY = (
+    "trimesh",
+    "pandas",
+    "scipy",
+    "tqdm",
+    "google_auth_oauthlib",
+    "google.auth",
+    "aiohttp",
+)
+
+
+def import_time():
+    """Return cumulative import time in ms and names of imported modules."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import brainmappy"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # Lines look like: "import time:  self [us] | cumulative | imported package"
+    total, modules = 0, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "brainmappy":
+            total = int(cumulative) / 1000
+
+    return total, modules
+
+
+def main(budget):
+    times = []
+    for _ in range(REPEATS):
+        t, modules = import_time()
+        times.append(t)
+
+    best = min(times)
+    eager = [l for l in LAZY if l in modules]
+
+    print("import brainmappy: {:.1f} ms (budget {} ms)".format(best, budget))
+
+    failed = False
+    if best > budget:
+        print("FAIL: import exceeds budget")
+        failed = True
+    if eager:
+        print("FAIL: heavy dependencies imported eagerly: " + ", ".join(eager))
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    sys.exit(main(budget))
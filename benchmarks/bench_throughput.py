@@ -0,0 +1,217 @@
+"""End-to-end throughput of brainmappy against a local stand-in server.
+
+Runs ``get_meshes_batch``, ``get_meshes_bulk``, ``get_seg_at_location``,
+``get_seg_in_bbox`` and ``get_ng_meshes`` against the mock server in
+``mock_server.py`` and reports wall time, requests/s, fragments/s (meshes),
+points/s (segmentation, i.e. voxels for ``get_seg_in_bbox``) and peak
+(traced) memory.
+
+Each scenario is run twice: once for timing and once under ``tracemalloc``
+to measure peak memory - tracing slows things down considerably.
+
+By default the server runs in a background thread of the benchmark process
+(i.e. it competes with the client for the GIL). For cleaner numbers start
+it in a separate process and pass its URL::
+
+    python benchmarks/mock_server.py --port 8080 --latency 0.02 &
+    python benchmarks/bench_throughput.py --url http://127.0.0.1:8080/
+
+Usage::
+
+    python benchmarks/bench_throughput.py [--latency 0.02] [--throttle 0.05]
+                                          [--objects 20] [--points 100000]
+                                          [--threads 10] [--processes 0]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import brainmappy as bm  # noqa: E402
+
+from mock_server import MockServer  # noqa: E402
+
+VOLUME = "volume"
+
+
+def make_client(max_threads):
+    """Client with dummy credentials and without metadata cache."""
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2.credentials import Credentials
+
+    session = AuthorizedSession(Credentials(token="mock"))
+    return bm.BrainmapsClient(session, max_threads=max_threads, metadata_cache=False)
+
+
+def make_coords(n, seed=0):
+    """Clustered, synapse-like coordinates in nm."""
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, [400_000, 400_000, 280_000], size=(max(n // 200, 1), 3))
+    labels = rng.integers(0, len(centers), n)
+    return centers[labels] + rng.normal(scale=[2000, 2000, 400], size=(n, 3))
+
+
+def scenarios(server, client, args):
+    """Yield ``(name, callable, {unit: count})``."""
+    # Spread object IDs so that they have different numbers of fragments
+    object_ids = [i * 7919 for i in range(1, args.objects + 1)]
+    n_frags = sum(len(server.fragments(ob)[0]) for ob in object_ids)
+
+    def meshes_batch():
+        for ob in object_ids:
+            bm.get_meshes_batch(
+                ob,
+                volume_id=VOLUME,
+                session=client,
+                max_threads=args.threads,
+                processes=args.processes,
+            )
+
+    yield "get_meshes_batch", meshes_batch, {"fragments": n_frags}
+
+    def meshes_bulk():
+        bm.get_meshes_bulk(
+            object_ids,
+            volume_id=VOLUME,
+            session=client,
+            max_threads=args.threads,
+            processes=args.processes,
+        )
+
+    yield "get_meshes_bulk", meshes_bulk, {"fragments": n_frags}
+
+    coords = make_coords(args.points)
+
+    def seg_at_location():
+        bm.get_seg_at_location(
+            coords, volume_id=VOLUME, session=client, max_threads=args.threads
+        )
+
+    yield "get_seg_at_location", seg_at_location, {"points": len(coords)}
+
+    # Dense cutout with about as many voxels as there are points above
+    side = max(round(args.points ** (1 / 3)), 1)
+    bbox = [[1000, 1000, 100], [1000 + side, 1000 + side, 100 + side]]
+
+    def seg_in_bbox():
+        bm.get_seg_in_bbox(
+            bbox,
+            volume_id=VOLUME,
+            raw_coords=True,
+            session=client,
+            max_threads=args.threads,
+        )
+
+    yield "get_seg_in_bbox", seg_in_bbox, {"points": side**3}
+
+    curls = server.curls(object_ids, url=bm.utils.brainmaps_url)
+
+    def ng_meshes():
+        bm.get_ng_meshes(curls, max_threads=args.threads, processes=args.processes)
+
+    yield "get_ng_meshes", ng_meshes, {"fragments": n_frags}
+
+
+def run(func):
+    """Run ``func`` and return wall time in s."""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def peak_memory(func):
+    """Run ``func`` and return peak traced memory in MB."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main(args):
+    bm.utils.use_pbars = False
+
+    # Import lazily loaded dependencies up front - we don't want to measure
+    # imports here (see bench_import.py)
+    import pandas  # noqa: F401
+    import tqdm  # noqa: F401
+    import trimesh  # noqa: F401
+
+    server = None
+    if args.url:
+        bm.utils.brainmaps_url = args.url
+    else:
+        server = MockServer(latency=args.latency, throttle=args.throttle).start()
+        bm.utils.brainmaps_url = server.url
+
+    # We need the server's fragment lists even if it runs elsewhere (assumes
+    # it runs with default payload sizes)
+    ref = server or MockServer()
+    client = make_client(args.threads)
+
+    # Count requests (including retries) on the wire
+    n_requests = [0]
+
+    def count(resp, *args, **kwargs):
+        n_requests[0] += 1
+
+    for c in (client, bm.client._anonymous_client()):
+        c.session.hooks["response"].append(count)
+
+    print(
+        "{:<20} {:>8} {:>9} {:>12} {:>12} {:>10}".format(
+            "function", "time [s]", "req/s", "fragments/s", "points/s", "peak [MB]"
+        )
+    )
+    for name, func, units in scenarios(ref, client, args):
+        n_requests[0] = 0
+        dur = run(func)
+        req_rate = n_requests[0] / dur
+        mem = peak_memory(func) if args.memory else float("nan")
+
+        print(
+            "{:<20} {:>8.2f} {:>9.1f} {:>12} {:>12} {:>10.1f}".format(
+                name,
+                dur,
+                req_rate,
+                _rate(units.get("fragments"), dur),
+                _rate(units.get("points"), dur),
+                mem,
+            )
+        )
+
+    client.close()
+    if server:
+        server.stop()
+
+
+def _rate(n, dur):
+    return "{:.0f}".format(n / dur) if n else "-"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="URL of an already running mock server")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--objects", type=int, default=20)
+    parser.add_argument("--points", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument(
+        "--processes", type=int, default=0, help="decode in worker processes"
+    )
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the (slow) peak memory measurement",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,379 @@
+"""Local stand-in for the brainmaps API.
+
+Serves the endpoints used by brainmappy with synthetic data so that client
+performance can be measured without access to the real API:
+
+- ``GET  v1/volumes`` and ``v1/volumes/{volume}`` (volume list and geometry)
+- ``GET  v1/objects/{volume}/meshes`` (mesh list)
+- ``GET  v1/objects/{volume}/meshes/{mesh}:listfragments``
+- ``GET  v1/changes/{volume}/change_stacks``
+- ``POST v1/objects/meshes:batch`` (neuroglancer binary fragments)
+- ``POST v1/volumes/{volume}/values`` (segment IDs at locations)
+- ``POST v1/volumes/{volume}/subvolume:binary`` (segmentation cutouts)
+
+Latency, throttling (429 responses) and payload sizes are configurable.
+Responses are deterministic: the same object always has the same fragments
+and the same location always maps to the same segment ID.
+
+Use from Python::
+
+    >>> from mock_server import MockServer
+    >>> with MockServer(latency=0.05) as server:
+    ...     brainmappy.utils.brainmaps_url = server.url
+    ...     ...
+
+or run as a separate process (e.g. to keep it off the client's GIL) and
+point brainmappy at it via the ``BRAINMAPS_URL`` environment variable::
+
+    python benchmarks/mock_server.py --port 8080 --latency 0.05
+
+"""
+
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Number of distinct fragment payloads to generate
+N_TEMPLATES = 64
+
+
+class MockServer:
+    """Stand-in brainmaps server running in a background thread.
+
+    Parameters
+    ----------
+    port :                  int
+                            Port to listen on. 0 picks a free port.
+    latency :               float
+                            Delay in seconds before each response.
+    jitter :                float
+                            Random extra delay (uniform between 0 and
+                            ``jitter`` seconds).
+    throttle :              float
+                            Probability (0-1) of answering a POST with 429.
+    throttle_gets :         bool
+                            Whether to also throttle GETs (fragment lists,
+                            metadata).
+    fragments_per_object :  (int, int)
+                            Min and max number of fragments per object.
+    verts_per_fragment :    (int, int)
+                            Min and max number of vertices per fragment.
+                            Fragments have about twice as many faces.
+    voxel_size :            (int, int, int)
+                            Voxel size reported for volumes.
+    seg_offset :            int
+                            Added to all segment IDs.
+
+    """
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        throttle=0.0,
+        fragments_per_object=(1, 250),
+        verts_per_fragment=(50, 500),
+        voxel_size=(4, 4, 40),
+        seg_offset=2**63,
+        throttle_gets=False,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.throttle_gets = throttle_gets
+        self.fragments_per_object = fragments_per_object
+        self.verts_per_fragment = verts_per_fragment
+        self.voxel_size = voxel_size
+        self.seg_offset = seg_offset
+
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._templates = _make_templates(verts_per_fragment)
+
+        handler = type("Handler", (_Handler,), dict(server_state=self))
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    def __repr__(self):
+        return "<{} url={!r}>".format(type(self).__name__, self.url)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        """Root URL of the server - use as ``brainmappy.utils.brainmaps_url``."""
+        return "http://127.0.0.1:{}/".format(self._httpd.server_address[1])
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset(self):
+        """Reset request counts."""
+        with self._lock:
+            self.counts.clear()
+
+    def count(self, endpoint, n=1):
+        """Increment request count for ``endpoint``."""
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + n
+
+    def fragments(self, object_id, mesh_name="mesh"):
+        """Return ``(supervoxel IDs, fragment keys)`` for given object.
+
+        Low resolution meshes ("mesh_lowres") have every 4th fragment.
+        """
+        lo, hi = self.fragments_per_object
+        n = lo + int(object_id) % (hi - lo + 1)
+        ob = int(object_id)
+        step = 4 if mesh_name == "mesh_lowres" else 1
+        return (
+            [ob * 1000 + i // 3 for i in range(0, n, step)],
+            ["{}:{}".format(ob, i) for i in range(0, n, step)],
+        )
+
+    def fragment_bytes(self, supervoxel_id, key):
+        """Return neuroglancer binary for a single fragment."""
+        fn = key.encode()
+        body = self._templates[zlib.crc32(fn) % len(self._templates)]
+        return struct.pack("<QI4x", int(supervoxel_id), len(fn)) + fn + body
+
+    def seg_ids(self, voxels):
+        """Return segment IDs for (N, 3) voxels."""
+        v = np.asarray(voxels, dtype=np.uint64) // np.uint64(10)
+        ids = v[:, 0] * np.uint64(1000003) + v[:, 1] * np.uint64(1009) + v[:, 2]
+        return ids + np.uint64(self.seg_offset)
+
+    def curls(self, object_ids, volume_id="volume", mesh_name="mesh", url=None):
+        """Return neuroglancer-style cURLs fetching meshes for given objects.
+
+        ``url`` defaults to this server's URL.
+        """
+        url = url or self.url
+        curls = []
+        for ob in object_ids:
+            svs, keys = self.fragments(ob)
+            for i in range(0, len(svs), 100):
+                body = dict(
+                    volumeId=volume_id,
+                    meshName=mesh_name,
+                    batches=[
+                        {"object_id": str(sv), "fragment_keys": [k]}
+                        for sv, k in zip(svs[i : i + 100], keys[i : i + 100])
+                    ],
+                )
+                curls.append(
+                    "curl '{}v1/objects/meshes:batch' "
+                    "-H 'authorization: Bearer mock' "
+                    "-H 'content-type: application/json' "
+                    "--data-binary '{}' --compressed".format(url, json.dumps(body))
+                )
+        return curls
+
+
+def _make_templates(verts_per_fragment, n=N_TEMPLATES, seed=0):
+    """Pre-generate fragment payloads (everything after the filename)."""
+    rng = np.random.default_rng(seed)
+    lo, hi = verts_per_fragment
+    templates = []
+    for _ in range(n):
+        nv = int(rng.integers(lo, hi + 1))
+        nf = 2 * nv
+        verts = (rng.random((nv, 3)) * 10_000).astype("<f4")
+        faces = rng.integers(0, nv, (nf, 3)).astype("<u4")
+        templates.append(struct.pack("<2q", nv, nf) + verts.tobytes() + faces.tobytes())
+    return templates
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Request handler - ``server_state`` is set to the ``MockServer``."""
+
+    server_state = None
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are written separately - without this, Nagle's
+    # algorithm and delayed ACKs add ~40ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type="application/json", code=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        s = self.server_state
+        if s.latency or s.jitter:
+            time.sleep(s.latency + random.uniform(0, s.jitter))
+
+    def do_GET(self):
+        s = self.server_state
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self._delay()
+
+        if s.throttle_gets and s.throttle and random.random() < s.throttle:
+            s.count("throttled")
+            return self._send({"error": "rate limit exceeded"}, code=429)
+
+        m = re.fullmatch(r"/v1/objects/([^/]+)/meshes/([^/]+):listfragments", url.path)
+        if m:
+            s.count("listfragments")
+            svs, keys = s.fragments(query["objectId"], m.group(2))
+            return self._send(
+                {"supervoxelId": [str(sv) for sv in svs], "fragmentKey": keys}
+            )
+
+        if re.fullmatch(r"/v1/objects/([^/]+)/meshes", url.path):
+            s.count("meshes")
+            return self._send(
+                {
+                    "meshes": [
+                        {"name": "mesh", "type": "TRIANGLES"},
+                        {"name": "mesh_lowres", "type": "TRIANGLES"},
+                    ]
+                }
+            )
+
+        if re.fullmatch(r"/v1/changes/([^/]+)/change_stacks", url.path):
+            s.count("change_stacks")
+            return self._send({"changeStackId": ["stack"]})
+
+        if url.path == "/v1/volumes":
+            s.count("volumes")
+            return self._send({"volumeId": ["volume"]})
+
+        if re.fullmatch(r"/v1/volumes/([^/]+)", url.path):
+            s.count("volume_info")
+            size = dict(x=100_000, y=100_000, z=10_000)
+            pixel_size = dict(zip("xyz", s.voxel_size))
+            return self._send(
+                {
+                    "geometry": [
+                        {
+                            "volumeSize": size,
+                            "channelCount": "1",
+                            "channelType": "UINT64",
+                            "pixelSize": pixel_size,
+                            "boundingBox": [{"corner": {}, "size": size}],
+                        }
+                    ]
+                }
+            )
+
+        self._send({"error": "not found"}, code=404)
+
+    def do_POST(self):
+        s = self.server_state
+        url = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._delay()
+
+        if s.throttle and random.random() < s.throttle:
+            s.count("throttled")
+            return self._send({"error": "rate limit exceeded"}, code=429)
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return self._send({"error": "invalid JSON"}, code=400)
+
+        if url.path == "/v1/objects/meshes:batch":
+            s.count("meshes:batch")
+            frags = [
+                (b["object_id"], k) for b in data["batches"] for k in b["fragment_keys"]
+            ]
+            s.count("fragments", len(frags))
+            return self._send(
+                b"".join(s.fragment_bytes(sv, k) for sv, k in frags),
+                content_type="application/octet-stream",
+            )
+
+        if re.fullmatch(r"/v1/volumes/([^/]+)/values", url.path):
+            s.count("values")
+            voxels = [[int(c) for c in loc.split(",")] for loc in data["locations"]]
+            s.count("locations", len(voxels))
+            ids = s.seg_ids(np.array(voxels).reshape(-1, 3))
+            return self._send({"uint64StrList": {"values": ids.astype(str).tolist()}})
+
+        if re.fullmatch(r"/v1/volumes/([^/]+)/subvolume:binary", url.path):
+            s.count("subvolume")
+            geometry = data["geometry"]
+            corner = [int(c) for c in geometry["corner"].split(",")]
+            size = [int(c) for c in geometry["size"].split(",")]
+            ids = s.seg_ids(
+                np.stack(
+                    np.meshgrid(
+                        *[np.arange(c, c + n) for c, n in zip(corner, size)],
+                        indexing="ij",
+                    ),
+                    axis=-1,
+                ).reshape(-1, 3)
+            ).reshape(size)
+
+            body = ids.T.astype("<u8").tobytes()
+            if data.get("subvolume_format", "RAW") == "RAW_SNAPPY":
+                import snappy
+
+                body = snappy.compress(body)
+            return self._send(body, content_type="application/octet-stream")
+
+        self._send({"error": "not found"}, code=404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--fragments", type=int, nargs=2, default=(1, 250))
+    parser.add_argument("--verts", type=int, nargs=2, default=(50, 500))
+    args = parser.parse_args()
+
+    server = MockServer(
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle=args.throttle,
+        fragments_per_object=args.fragments,
+        verts_per_fragment=args.verts,
+    )
+    print("Serving at {} - use BRAINMAPS_URL={}".format(server.url, server.url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
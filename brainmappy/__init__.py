@@ -1,5 +1,13 @@
 __version__ = "0.2.6"
 
 from .auth import *
+from .cache import *
+from .client import *
+from .decode import *
 from .fetch import *
 from .io import *
+from .jobs import *
+from .mesh import *
+from .store import *
+
+from . import metrics
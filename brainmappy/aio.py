@@ -0,0 +1,350 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains an asyncio client for Google's brainmaps API.
+
+Requires ``aiohttp`` (``pip3 install aiohttp``).
+"""
+
+import asyncio
+import itertools
+import time
+
+import numpy as np
+import requests
+
+from .auth import _eval_session, _eval_volumeId
+from .cache import _eval_fragment_cache, _eval_metadata_cache
+from .client import BrainmapsClient
+from .fetch import (
+    _SegBlock,
+    _assemble_mesh,
+    _batch_posts,
+    _fragments_url,
+    _make_url,
+)
+from .io import _as_buffer, _decode_raw_ng, _split_fragments
+from .mesh import _eval_return_type
+from .scheduler import RequestScheduler
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = ["AsyncClient"]
+
+
+class AsyncClient:
+    """Asynchronous client for the brainmaps API.
+
+    All requests share a single connection pool: any number of requests can
+    be awaited concurrently, only ``max_connections`` of them are actually
+    on the wire at any given time. Credentials are taken from the
+    (synchronous) session and refreshed when they expire.
+
+    Failed requests (connection errors, 429 and 5xx responses) are retried
+    with the same rules and backoff as ``RequestScheduler``.
+
+    Parameters
+    ----------
+    session :           AuthorizedSession | BrainmapsClient | requests.Session
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals. Plain
+                        ``requests.Session`` have no credentials: requests
+                        are sent without authorization.
+    max_connections :   int
+                        Size of the connection pool.
+    timeout :           int | float
+                        Total timeout per request in seconds.
+    metadata_cache :    MetadataCache | str | bool
+                        Cache for metadata (volume info, mesh lists, etc).
+                        See ``brainmappy.BrainmapsClient``.
+    scheduler :         RequestScheduler, optional
+                        Provides retry rules (``max_retries``, ``backoff``,
+                        etc.). If None, will use the scheduler of ``session``
+                        (if it is a ``BrainmapsClient``) or a new one.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from brainmappy.aio import AsyncClient
+    >>> async def main():
+    ...     async with AsyncClient() as client:
+    ...         return await asyncio.gather(
+    ...             *[client.get_meshes_batch(ob) for ob in object_ids]
+    ...         )
+    >>> meshes = asyncio.run(main())
+
+    """
+
+    def __init__(
+        self,
+        session=None,
+        max_connections=10,
+        timeout=300,
+        metadata_cache=True,
+        scheduler=None,
+    ):
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncClient requires aiohttp. Please install: pip3 install aiohttp"
+            )
+
+        if isinstance(session, BrainmapsClient):
+            scheduler = scheduler or session.scheduler
+            session = session.session
+        elif session is None or not isinstance(session, requests.Session):
+            session = _eval_session(session)
+
+        self.credentials = getattr(session, "credentials", None)
+        self.scheduler = scheduler or RequestScheduler()
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._session = None
+        self._refresh_lock = None
+        self.metadata_cache = _eval_metadata_cache(metadata_cache)
+
+    def __repr__(self):
+        return "<{} max_connections={}>".format(
+            type(self).__name__, self.max_connections
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def session(self):
+        """The underlying ``aiohttp.ClientSession``."""
+        # Must be created from within the event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """Close connection pool."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _headers(self):
+        """Return auth headers - refresh credentials if required."""
+        if self.credentials is None:
+            return {}
+
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+
+        if not self.credentials.valid:
+            async with self._refresh_lock:
+                if not self.credentials.valid:
+                    from google.auth.transport.requests import Request
+
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(
+                        None, self.credentials.refresh, Request()
+                    )
+
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def _request(self, method, url, json=None, data=None, binary=False):
+        """Make request and return parsed JSON or raw bytes.
+
+        ``data`` is sent as is and must already be JSON-encoded.
+        """
+        sched = self.scheduler
+
+        for attempt in itertools.count():
+            headers = await self._headers()
+            if data is not None:
+                headers = {**headers, "Content-Type": "application/json"}
+
+            start = time.perf_counter()
+            try:
+                async with self.session.request(
+                    method, url, json=json, data=data, headers=headers
+                ) as r:
+                    latency = time.perf_counter() - start
+                    if not sched._should_retry(r.status, None, latency):
+                        sched._count("requests")
+                        r.raise_for_status()
+                        if binary:
+                            return await r.read()
+                        return await r.json(content_type=None)
+                    if attempt >= sched.max_retries:
+                        sched._count("requests")
+                        sched._count("failed")
+                        r.raise_for_status()
+                    wait = sched._wait(attempt, r.headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                sched._should_retry(None, e, time.perf_counter() - start)
+                if attempt >= sched.max_retries:
+                    sched._count("requests")
+                    sched._count("failed")
+                    raise
+                wait = sched._wait(attempt)
+
+            sched._count("retries")
+            await asyncio.sleep(wait)
+
+    async def _get_metadata(self, endpoint, url, **args):
+        """GET ``url`` - use metadata cache if we have one."""
+        cache = self.metadata_cache
+        if cache is not None:
+            data = cache.get(endpoint, url)
+            if data is not None:
+                return data
+
+        data = await self._request("GET", url)
+
+        if cache is not None:
+            cache.put(endpoint, url, data, **args)
+
+        return data
+
+    async def get_volume_info(self, volume_id):
+        """Get info on volume. See ``brainmappy.get_volume_info``."""
+        url = _make_url("v1", "volumes", volume_id)
+        data = await self._get_metadata("volume_info", url, volume_id=volume_id)
+        return data["geometry"]
+
+    async def get_mesh_list(self, volume_id):
+        """List meshes for this volume. See ``brainmappy.get_mesh_list``."""
+        url = _make_url("v1", "objects", volume_id, "meshes")
+        data = await self._get_metadata("mesh_list", url, volume_id=volume_id)
+        return data.get("meshes", None)
+
+    async def get_fragments(
+        self, object_id, mesh_name, volume_id=None, change_stack_id=None
+    ):
+        """Return fragments constituting a given object.
+
+        See ``brainmappy.get_fragments``.
+        """
+        volume_id = _eval_volumeId(volume_id)
+        url = _fragments_url(object_id, mesh_name, volume_id, change_stack_id)
+
+        frags = await self._request("GET", url)
+
+        if not frags:
+            raise ValueError("No fragments found for object {}".format(object_id))
+
+        return list(zip(frags["supervoxelId"], frags["fragmentKey"]))
+
+    async def get_meshes_batch(
+        self,
+        object_id,
+        lod=0,
+        volume_id=None,
+        change_stack_id=None,
+        cache=None,
+        return_type="trimesh",
+    ):
+        """Return mesh for given object ID.
+
+        See ``brainmappy.get_meshes_batch``.
+        """
+        volume_id = _eval_volumeId(volume_id)
+        cache = _eval_fragment_cache(cache)
+        return_type = _eval_return_type(return_type)
+
+        mesh_info = await self.get_mesh_list(volume_id)
+        if isinstance(lod, int):
+            mesh_name = mesh_info[lod]["name"]
+        elif isinstance(lod, str):
+            assert lod in [m["name"] for m in mesh_info]
+            mesh_name = lod
+        else:
+            raise ValueError("lod must be int or str")
+
+        frags = await self.get_fragments(
+            object_id,
+            mesh_name=mesh_name,
+            volume_id=volume_id,
+            change_stack_id=change_stack_id,
+        )
+
+        pieces = {}
+        missing = frags
+        if cache is not None:
+            for p in cache.iter_decoded(volume_id, mesh_name, frags):
+                pieces.update(p)
+            missing = [(sv, k) for sv, k in frags if (int(sv), k) not in pieces]
+
+        url = _make_url("v1", "objects", "meshes:batch")
+        _, posts = _batch_posts(missing, mesh_name, volume_id)
+
+        async def fetch(post):
+            data = _as_buffer(await self._request("POST", url, json=post, binary=True))
+            headers, verts, faces = _decode_raw_ng(data)
+            if cache is not None:
+                cache.put(volume_id, mesh_name, data, frags=headers)
+            return _split_fragments(headers, verts, faces)
+
+        for p in await asyncio.gather(*[fetch(p) for p in posts]):
+            pieces.update(p)
+
+        return _assemble_mesh(frags, pieces, return_type)
+
+    async def get_seg_at_location(
+        self,
+        coords,
+        volume_id=None,
+        change_stack_id=None,
+        raw_coords=False,
+        raw_px_dims=None,
+        chunking="morton",
+        memo=None,
+    ):
+        """Return segmentation IDs at given locations.
+
+        See ``brainmappy.get_seg_at_location``.
+        """
+        volume_id = _eval_volumeId(volume_id)
+        url = _make_url("v1", "volumes", volume_id, "values")
+
+        if not raw_coords:
+            if raw_px_dims is None:
+                vinfo = await self.get_volume_info(volume_id)
+                raw_px_dims = [vinfo[0]["pixelSize"][d] for d in "xyz"]
+            raw_px_dims = np.asarray(raw_px_dims)
+        else:
+            raw_px_dims = None
+
+        block = _SegBlock(
+            coords,
+            offset=0,
+            raw_px_dims=raw_px_dims,
+            chunking=chunking,
+            memo=memo,
+            volume_id=volume_id,
+            change_stack_id=change_stack_id,
+        )
+
+        async def fetch(i):
+            resp = await self._request("POST", url, data=block.post(i), binary=True)
+            block.update(i, _SegBlock.parse(resp))
+
+        await asyncio.gather(*[fetch(i) for i in range(len(block.requests))])
+
+        return block.result(np.arange(block.size))[1]
@@ -19,10 +19,6 @@ import sys
 import pickle
 import json
 
-from google_auth_oauthlib import get_user_credentials
-from google.auth.transport.requests import AuthorizedSession
-from google.auth.transport.requests import Request
-
 __all__ = ["acquire_credentials", "set_global_volume"]
 
 _BRAINMAPS_SCOPES = ["https://www.googleapis.com/auth/brainmaps"]
@@ -43,6 +39,9 @@ def acquire_credentials(
     client_secret_file or both client_id and client_secret are required on
     first run. After that, the values are read from storage_path.
     """
+    # Import here to keep `import brainmappy` fast
+    from google.auth.transport.requests import AuthorizedSession, Request
+
     # Construct authentication from a client secrets file,
     # available from https://console.developers.google.com/
 
@@ -57,6 +56,8 @@ def acquire_credentials(
                 "Must either provide a `client_secret_file` or `client_id` and `client_secret`."
             )
 
+        from google_auth_oauthlib import get_user_credentials
+
         creds = get_user_credentials(
             scopes=_BRAINMAPS_SCOPES,
             client_id=client_id,
@@ -90,6 +91,8 @@ def acquire_credentials(
 
 def _eval_session(session=None, raise_error=True):
     """Evaluate brainmaps session and checks for globally defined session."""
+    from google.auth.transport.requests import AuthorizedSession, Request
+
     if session is None:
         if "brainmap_session" in sys.modules:
             return sys.modules["brainmap_session"]
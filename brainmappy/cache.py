@@ -0,0 +1,1019 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains local caches for data fetched from brainmaps."""
+
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import warnings
+
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from .io import _as_buffer, _decode_raw_ng, _scan_raw_ng, _split_fragments
+
+__all__ = [
+    "FragmentCache",
+    "MetadataCache",
+    "SegmentationChunkCache",
+    "SegmentationMemo",
+]
+
+# Shared default metadata cache (see ``_eval_metadata_cache``)
+_default_metadata_cache = None
+
+
+class FragmentCache:
+    """Persistent on-disk store for raw mesh fragments.
+
+    Mesh fragments are immutable: the same ``(supervoxelId, fragmentKey)``
+    in the same volume and meshes will always have the same content. This
+    cache stores each fragment's raw neuroglancer binary in a separate file so
+    that it can be memory-mapped on the next request instead of being fetched
+    again.
+
+    Writes are atomic (write to temporary file + rename), so multiple
+    processes can share the same cache directory. The size of the cache is
+    limited by evicting the least recently used fragments.
+
+    Parameters
+    ----------
+    path :      str, optional
+                Directory to store fragments in. Will be created if it does
+                not exist.
+    max_size :  int | float
+                Max size of the cache in bytes. Defaults to 5GB.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> cache = bm.FragmentCache()
+    >>> m = bm.get_meshes_batch(21716312853, cache=cache)
+
+    """
+
+    def __init__(
+        self,
+        path=os.path.expanduser("~/.cache/brainmappy/fragments"),
+        max_size=5e9,
+    ):
+        self.path = path
+        self.max_size = int(max_size)
+
+        # Bytes written since we last checked the size of the cache
+        self._written = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "<{} path={!r} max_size={}>".format(
+            type(self).__name__, self.path, self.max_size
+        )
+
+    def _filepath(self, volume_id, mesh_name, supervoxel_id, fragment_key):
+        """Return filepath for given fragment."""
+        key = "{}/{}/{}/{}".format(
+            volume_id, mesh_name, int(supervoxel_id), fragment_key
+        )
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    @property
+    def size(self):
+        """Current size of the cache in bytes."""
+        return sum(s for _, s, _ in _list_files(self.path))
+
+    def get(self, volume_id, mesh_name, fragments):
+        """Get raw data for given fragments.
+
+        Parameters
+        ----------
+        volume_id :     str
+        mesh_name :     str
+        fragments :     list of (supervoxel ID, fragment key)
+                        As returned by ``brainmappy.get_fragments``.
+
+        Returns
+        -------
+        dict
+                        ``{(supervoxel ID, fragment key): memoryview}`` for
+                        fragments found in the cache. The memoryviews are
+                        backed by memory-mapped files - see ``iter_decoded``
+                        for reading many fragments.
+
+        """
+        found = {}
+        for sv, key in fragments:
+            fp = self._filepath(volume_id, mesh_name, sv, key)
+            try:
+                with open(fp, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # Mark as recently used
+                os.utime(fp)
+            except (OSError, ValueError):
+                # Not cached, evicted by another process, empty or we ran
+                # out of memory maps (``vm.max_map_count``)
+                continue
+            found[(sv, key)] = memoryview(mm)
+
+        return found
+
+    def iter_decoded(self, volume_id, mesh_name, fragments, batch_size=1000):
+        """Decode cached fragments batch by batch.
+
+        At most ``batch_size`` files are memory-mapped at any time: each
+        batch is decoded and its memory maps are closed before the next one
+        is read.
+
+        Parameters
+        ----------
+        volume_id :     str
+        mesh_name :     str
+        fragments :     list of (supervoxel ID, fragment key)
+                        As returned by ``brainmappy.get_fragments``.
+        batch_size :    int
+                        Number of fragments to read at a time.
+
+        Yields
+        ------
+        dict
+                        ``{(supervoxel ID, fragment key): (verts, faces)}``
+                        for fragments of a batch found in the cache.
+
+        """
+        for i in range(0, len(fragments), batch_size):
+            found = self.get(volume_id, mesh_name, fragments[i : i + batch_size])
+            if not found:
+                continue
+
+            pieces = {}
+            try:
+                for data in found.values():
+                    pieces.update(_split_fragments(*_decode_raw_ng(data)))
+            finally:
+                _close_maps(found.values())
+            yield pieces
+
+    def put(self, volume_id, mesh_name, data, frags=None):
+        """Add fragments to cache.
+
+        Parameters
+        ----------
+        volume_id :     str
+        mesh_name :     str
+        data :          bytes | memoryview
+                        Raw neuroglancer binary for one or more fragments,
+                        e.g. the response to a ``meshes:batch`` request.
+        frags :         dict, optional
+                        Fragment headers for ``data`` as returned by
+                        ``io._scan_raw_ng``. Will be generated if not provided.
+
+        """
+        buf = _as_buffer(data)
+        if frags is None:
+            frags = _scan_raw_ng(buf)
+
+        for sv, key, start, end in zip(
+            frags["object_id"], frags["filename"], frags["start"], frags["end"]
+        ):
+            fp = self._filepath(volume_id, mesh_name, sv, key)
+            _atomic_write(fp, buf[start:end])
+            self._written += int(end - start)
+
+        # Check the size every time we wrote ~1% of the max size
+        if self._written > self.max_size / 100:
+            self.prune()
+
+    def prune(self):
+        """Evict least recently used fragments until cache is within size limit."""
+        self._written = 0
+        _evict(_list_files(self.path), self.max_size)
+
+    def clear(self):
+        """Remove all fragments from the cache."""
+        _evict(_list_files(self.path), 0)
+
+
+class SegmentationMemo:
+    """Memo of segment IDs at individual voxels.
+
+    Entries are keyed by ``(volume_id, change_stack_id, voxel)``. The
+    in-memory memo is bounded and evicts least recently used voxels. If a
+    ``path`` is given, entries are additionally written to an SQLite database
+    which survives restarts and can be shared between processes.
+
+    In memory, voxels are packed into 64 bit keys (21 bits per axis) and kept
+    in sorted arrays. Voxels with coordinates outside of +/- 2**20 don't fit
+    and are only memoized in the database.
+
+    Parameters
+    ----------
+    max_items : int
+                Max number of voxels to keep in memory.
+    path :      str, optional
+                Path to SQLite database file for on-disk storage.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> memo = bm.SegmentationMemo()
+    >>> ids = bm.get_seg_at_location(coords, memo=memo)
+    >>> # This will not hit the server again
+    >>> ids = bm.get_seg_at_location(coords, memo=memo)
+
+    """
+
+    def __init__(self, max_items=1_000_000, path=None):
+        self.max_items = int(max_items)
+        self.path = path
+        # Maps (volume_id, change_stack_id) -> (keys, seg_ids, last used)
+        # sorted by key
+        self._mem = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+        if self.path:
+            with self._connect() as con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS seg ("
+                    "volume TEXT, change_stack TEXT, x INT, y INT, z INT, seg_id INT, "
+                    "PRIMARY KEY (volume, change_stack, x, y, z)) WITHOUT ROWID"
+                )
+
+    def __repr__(self):
+        return "<{} items={} path={!r}>".format(
+            type(self).__name__, len(self), self.path
+        )
+
+    def __len__(self):
+        return sum(len(keys) for keys, _, _ in self._mem.values())
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Connect to database, commit and close when done."""
+        con = sqlite3.connect(self.path, timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def lookup(self, volume_id, change_stack_id, voxels):
+        """Look up segment IDs for given voxels.
+
+        Parameters
+        ----------
+        volume_id :         str
+        change_stack_id :   str | None
+        voxels :            (N, 3) array of int
+
+        Returns
+        -------
+        found :             (N, ) array of bool
+        seg_ids :           (N, ) array of uint64
+                            Segment IDs for found voxels, 0 otherwise.
+
+        """
+        cs = change_stack_id or ""
+        voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+        found = np.zeros(len(voxels), dtype=bool)
+        seg_ids = np.zeros(len(voxels), dtype=np.uint64)
+
+        with self._lock:
+            mem_keys, mem_ids, used = self._mem.get((volume_id, cs), _NO_VOXELS)
+            if len(mem_keys):
+                keys, valid = _pack_voxels(voxels)
+                ix = np.minimum(np.searchsorted(mem_keys, keys), len(mem_keys) - 1)
+                found = valid & (mem_keys[ix] == keys)
+                seg_ids[found] = mem_ids[ix[found]]
+                used[ix[found]] = self._ticks(found.sum())
+
+        if self.path and not found.all():
+            miss = np.where(~found)[0]
+            with self._connect() as con:
+                con.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS q (i INT, x INT, y INT, z INT)"
+                )
+                con.execute("DELETE FROM q")
+                con.executemany(
+                    "INSERT INTO q VALUES (?, ?, ?, ?)",
+                    zip(miss.tolist(), *voxels[miss].T.tolist()),
+                )
+                rows = con.execute(
+                    "SELECT q.i, seg.seg_id FROM q JOIN seg ON "
+                    "seg.volume = ? AND seg.change_stack = ? AND "
+                    "seg.x = q.x AND seg.y = q.y AND seg.z = q.z",
+                    (volume_id, cs),
+                ).fetchall()
+
+            if rows:
+                ix, ids = np.array(rows, dtype=np.int64).T
+                found[ix] = True
+                seg_ids[ix] = ids.view(np.uint64)
+                self._remember(volume_id, cs, voxels[ix], seg_ids[ix])
+
+        return found, seg_ids
+
+    def update(self, volume_id, change_stack_id, voxels, seg_ids):
+        """Add segment IDs for given voxels.
+
+        Parameters
+        ----------
+        volume_id :         str
+        change_stack_id :   str | None
+        voxels :            (N, 3) array of int
+        seg_ids :           (N, ) array of int
+
+        """
+        cs = change_stack_id or ""
+        voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+        seg_ids = np.asarray(seg_ids).astype(np.uint64)
+
+        self._remember(volume_id, cs, voxels, seg_ids)
+
+        if self.path:
+            with self._connect() as con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO seg VALUES (?, ?, ?, ?, ?, ?)",
+                    zip(
+                        [volume_id] * len(voxels),
+                        [cs] * len(voxels),
+                        *voxels.T.tolist(),
+                        # SQLite integers are signed 64 bit
+                        seg_ids.view(np.int64).tolist(),
+                    ),
+                )
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._mem.clear()
+        if self.path:
+            with self._connect() as con:
+                con.execute("DELETE FROM seg")
+
+    def _remember(self, volume_id, cs, voxels, seg_ids):
+        """Add entries to in-memory memo."""
+        keys, valid = _pack_voxels(voxels)
+        keys, seg_ids = keys[valid], seg_ids[valid]
+
+        with self._lock:
+            used = self._ticks(len(keys))
+
+            # Keep the last entry for duplicate voxels
+            keys, ix = np.unique(keys[::-1], return_index=True)
+            seg_ids, used = seg_ids[::-1][ix], used[::-1][ix]
+
+            # Replace existing entries, insert the rest
+            mem_keys, mem_ids, mem_used = self._mem.get((volume_id, cs), _NO_VOXELS)
+            ix = np.searchsorted(mem_keys, keys)
+            known = ix < len(mem_keys)
+            known[known] = mem_keys[ix[known]] == keys[known]
+            mem_ids[ix[known]] = seg_ids[known]
+            mem_used[ix[known]] = used[known]
+
+            new = ~known
+            self._mem[(volume_id, cs)] = (
+                np.insert(mem_keys, ix[new], keys[new]),
+                np.insert(mem_ids, ix[new], seg_ids[new]),
+                np.insert(mem_used, ix[new], used[new]),
+            )
+
+            self._evict()
+
+    def _ticks(self, n):
+        """Return ``n`` consecutive "last used" values. Must hold the lock."""
+        ticks = np.arange(self._tick, self._tick + n, dtype=np.int64)
+        self._tick += int(n)
+        return ticks
+
+    def _evict(self):
+        """Drop least recently used voxels over ``max_items``. Must hold the lock."""
+        n = len(self) - self.max_items
+        if n <= 0:
+            return
+
+        # "Last used" values are unique - drop everything up to the n-th oldest
+        used = np.concatenate([u for _, _, u in self._mem.values()])
+        cutoff = np.partition(used, n - 1)[n - 1]
+
+        for key, (keys, seg_ids, used) in list(self._mem.items()):
+            keep = used > cutoff
+            if keep.all():
+                continue
+            elif keep.any():
+                self._mem[key] = (keys[keep], seg_ids[keep], used[keep])
+            else:
+                del self._mem[key]
+
+
+class SegmentationChunkCache:
+    """Cache of whole blocks of segmentation for repeated point lookups.
+
+    Point lookups (``get_seg_at_location``) are counted per chunk of
+    ``chunk_size`` voxels. Once ``min_hits`` voxels in a chunk have been
+    looked up, the segmentation for the entire chunk is downloaded and all
+    further lookups in that chunk are answered locally.
+
+    Chunks are keyed by ``(volume_id, change_stack_id, scale, chunk index)``
+    and kept in memory in compressed form (unique IDs + small integer labels)
+    which can be indexed directly. The in-memory cache evicts least recently
+    used chunks. If a ``path`` is given, chunks are additionally written to
+    disk (zlib-compressed ``.npz``) where they survive restarts and can be
+    shared between processes.
+
+    Parameters
+    ----------
+    chunk_size :    (int, int, int)
+                    Size of chunks in voxels.
+    min_hits :      int
+                    Number of looked-up voxels in a chunk after which the full
+                    chunk is fetched. Fetching a 64x64x64 chunk costs a
+                    single (albeit larger) request - about the same as
+                    looking up 200 voxels.
+    max_chunks :    int
+                    Max number of chunks to keep in memory.
+    path :          str, optional
+                    Directory to store chunks in. Will be created if it does
+                    not exist.
+    max_size :      int | float
+                    Max size of the on-disk cache in bytes. Defaults to 5GB.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> chunks = bm.SegmentationChunkCache(path="~/.cache/brainmappy/seg")
+    >>> client = bm.BrainmapsClient(chunk_cache=chunks)
+    >>> # After a few lookups in the same region, this won't hit the server
+    >>> ids = client.get_seg_at_location(coords)
+
+    """
+
+    def __init__(
+        self,
+        chunk_size=(64, 64, 64),
+        min_hits=100,
+        max_chunks=500,
+        path=None,
+        max_size=5e9,
+    ):
+        self.chunk_size = np.asarray(chunk_size, dtype=np.int64).reshape(3)
+        self.min_hits = int(min_hits)
+        self.max_chunks = int(max_chunks)
+        self.path = os.path.expanduser(path) if path else None
+        self.max_size = int(max_size)
+
+        self._mem = OrderedDict()
+        # Looked-up voxels per chunk not (yet) in the cache
+        self._hits = Counter()
+        self._written = 0
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "<{} chunks={} path={!r}>".format(
+            type(self).__name__, len(self), self.path
+        )
+
+    def __len__(self):
+        return len(self._mem)
+
+    def _filepath(self, key):
+        """Return filepath for given chunk."""
+        volume_id, cs, scale, (x, y, z) = key
+        digest = hashlib.sha1(
+            "{}/{}/{}/{}_{}_{}".format(volume_id, cs, scale, x, y, z).encode()
+        ).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + ".npz")
+
+    def lookup(self, volume_id, change_stack_id, voxels, scale=0, fetch=None):
+        """Look up segment IDs for given voxels.
+
+        Parameters
+        ----------
+        volume_id :         str
+        change_stack_id :   str | None
+        voxels :            (N, 3) array of int
+                            Voxel coordinates at given ``scale``. Each voxel
+                            counts as one hit for its chunk.
+        scale :             int
+        fetch :             callable, optional
+                            Called as ``fetch(boxes)`` with a list of
+                            ``(corner, size)`` for chunks that reached
+                            ``min_hits`` and must return a list of (X, Y, Z)
+                            segmentation arrays. Arrays may be smaller than
+                            the chunk (e.g. at the edge of the volume). If not
+                            provided, will only use chunks already cached.
+
+        Returns
+        -------
+        found :             (N, ) array of bool
+        seg_ids :           (N, ) array of uint64
+                            Segment IDs for found voxels, 0 otherwise.
+
+        """
+        cs = change_stack_id or ""
+        voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+        found = np.zeros(len(voxels), dtype=bool)
+        seg_ids = np.zeros(len(voxels), dtype=np.uint64)
+
+        if not len(voxels):
+            return found, seg_ids
+
+        # Group voxels by chunk
+        chunks, inverse, counts = np.unique(
+            voxels // self.chunk_size, axis=0, return_inverse=True, return_counts=True
+        )
+        order = np.argsort(inverse.reshape(-1), kind="stable")
+        groups = np.split(order, np.cumsum(counts)[:-1])
+        keys = [(volume_id, cs, int(scale), tuple(c)) for c in chunks.tolist()]
+
+        entries = {}
+        hot = []
+        for key, n in zip(keys, counts.tolist()):
+            entry = self._get(key)
+            if entry is not None:
+                entries[key] = entry
+                continue
+            self._hits[key] += n
+            if self._hits[key] >= self.min_hits:
+                hot.append(key)
+
+        if hot and fetch is not None:
+            boxes = [(np.array(k[3]) * self.chunk_size, self.chunk_size) for k in hot]
+            for key, seg in zip(hot, fetch(boxes)):
+                entries[key] = self.put(volume_id, change_stack_id, key[3], seg, scale)
+
+        # Don't let hit counts for chunks we never fetch pile up
+        if len(self._hits) > 100 * self.max_chunks:
+            self._hits.clear()
+
+        for key, ix in zip(keys, groups):
+            entry = entries.get(key)
+            if entry is None:
+                continue
+            ids, labels = entry
+            local = voxels[ix] - np.array(key[3]) * self.chunk_size
+            inside = (local < labels.shape).all(axis=1)
+            ix = ix[inside]
+            seg_ids[ix] = ids[labels[tuple(local[inside].T)]]
+            found[ix] = True
+
+        return found, seg_ids
+
+    def put(self, volume_id, change_stack_id, chunk_index, seg, scale=0):
+        """Add segmentation for a chunk.
+
+        Parameters
+        ----------
+        volume_id :         str
+        change_stack_id :   str | None
+        chunk_index :       (int, int, int)
+                            The chunk's corner divided by ``chunk_size``.
+        seg :               (X, Y, Z) array of int
+                            Segmentation starting at the chunk's corner. May
+                            be smaller (but not larger) than ``chunk_size``.
+        scale :             int
+
+        Returns
+        -------
+        ids :               (K, ) array of uint64
+                            Unique segment IDs in this chunk.
+        labels :            (X, Y, Z) array of uint
+                            Indices into ``ids``.
+
+        """
+        key = (
+            volume_id,
+            change_stack_id or "",
+            int(scale),
+            tuple(int(i) for i in chunk_index),
+        )
+
+        seg = np.asarray(seg, dtype=np.uint64)
+        if (np.array(seg.shape) > self.chunk_size).any():
+            raise ValueError(
+                "Segmentation of shape {} does not fit into chunk of size {}".format(
+                    seg.shape, self.chunk_size
+                )
+            )
+
+        ids, labels = np.unique(seg, return_inverse=True)
+        labels = labels.reshape(seg.shape).astype(
+            np.min_scalar_type(max(len(ids) - 1, 0))
+        )
+        entry = (ids, labels)
+        self._remember(key, entry)
+
+        if self.path:
+            fp = self._filepath(key)
+            f = io.BytesIO()
+            np.savez_compressed(f, ids=ids, labels=labels)
+            _atomic_write(fp, f.getbuffer())
+
+            self._written += os.path.getsize(fp)
+            if self._written > self.max_size / 100:
+                self.prune()
+
+        return entry
+
+    def prune(self):
+        """Evict least recently used chunks until disk cache is within size limit."""
+        self._written = 0
+        if self.path:
+            _evict(_list_files(self.path), self.max_size)
+
+    def clear(self):
+        """Remove all chunks."""
+        self._mem.clear()
+        self._hits.clear()
+        if self.path:
+            _evict(_list_files(self.path), 0)
+
+    def _get(self, key):
+        """Return ``(ids, labels)`` for given chunk or None if not cached."""
+        entry = self._mem.get(key)
+        if entry is not None:
+            self._mem.move_to_end(key)
+            return entry
+
+        if not self.path:
+            return None
+
+        fp = self._filepath(key)
+        try:
+            with np.load(fp) as f:
+                entry = (f["ids"], f["labels"])
+            # Mark as recently used
+            os.utime(fp)
+        except (FileNotFoundError, ValueError, OSError, KeyError):
+            # Not cached, evicted by another process or corrupted
+            return None
+
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        """Add chunk to in-memory cache."""
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        self._hits.pop(key, None)
+
+        while len(self._mem) > self.max_chunks:
+            self._mem.popitem(last=False)
+
+
+class MetadataCache:
+    """Persistent on-disk cache for metadata (volumes, meshes, etc).
+
+    Responses are keyed by endpoint and query (i.e. the URL) - not by
+    session - and expire after a per-endpoint time-to-live. Because entries
+    are stored on disk, they survive restarts and are shared between
+    processes using the same directory.
+
+    Recently used responses are also kept in memory, so that repeated
+    lookups don't have to read from disk. Note that invalidating entries
+    from another process only takes effect here once they expire.
+
+    Parameters
+    ----------
+    path :      str, optional
+                Directory to store responses in. Will be created if it does
+                not exist.
+    ttl :       dict, optional
+                Time-to-live in seconds for individual endpoints, e.g.
+                ``{"change_stacks": 0}``. Overrides the defaults in
+                ``MetadataCache.ttl``. Endpoints without TTL use
+                ``default_ttl``.
+    max_items : int
+                Max number of responses to keep in memory.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> cache = bm.MetadataCache(ttl={"mesh_list": 7 * 86400})
+    >>> client = bm.BrainmapsClient(metadata_cache=cache)
+    >>> # Force re-fetching change stacks for a volume
+    >>> cache.invalidate("change_stacks", volume_id="some_volume")
+
+    """
+
+    # Default time-to-live in seconds
+    ttl = {
+        "schemas": 86400,
+        "volumes": 3600,
+        "volume_info": 86400,
+        "mesh_list": 86400,
+        "resource_list": 3600,
+        "projects": 3600,
+        "datasets": 3600,
+        "change_stacks": 300,
+    }
+    default_ttl = 3600
+
+    def __init__(
+        self,
+        path=os.path.expanduser("~/.cache/brainmappy/metadata"),
+        ttl=None,
+        max_items=1000,
+    ):
+        self.path = path
+        self.ttl = dict(self.ttl, **(ttl or {}))
+        self.max_items = int(max_items)
+        # Maps (endpoint, url) -> entry as stored on disk
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError:
+            # E.g. read-only home directory
+            warnings.warn(
+                "Unable to create metadata cache at {!r} - caching in memory "
+                "only".format(self.path)
+            )
+            self.path = None
+
+    def __repr__(self):
+        return "<{} path={!r}>".format(type(self).__name__, self.path)
+
+    def _filepath(self, endpoint, url):
+        """Return filepath for given request."""
+        digest = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.path, endpoint, digest + ".json")
+
+    def get(self, endpoint, url):
+        """Get cached response.
+
+        Parameters
+        ----------
+        endpoint :  str
+                    Name of the endpoint, e.g. "volume_info".
+        url :       str
+                    URL of the request.
+
+        Returns
+        -------
+        Parsed JSON response or None if not cached or expired.
+
+        """
+        ttl = self.ttl.get(endpoint, self.default_ttl)
+
+        with self._lock:
+            entry = self._mem.get((endpoint, url))
+            if entry is not None:
+                if time.time() - entry["time"] <= ttl:
+                    self._mem.move_to_end((endpoint, url))
+                    # Callers may modify the response
+                    return copy.deepcopy(entry["data"])
+                del self._mem[(endpoint, url)]
+
+        if self.path is None:
+            return None
+
+        fp = self._filepath(endpoint, url)
+        try:
+            with open(fp, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # Not cached, invalidated by another process or corrupted
+            return None
+
+        if time.time() - entry["time"] > ttl:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(fp)
+            return None
+
+        self._remember(endpoint, url, entry)
+
+        return copy.deepcopy(entry["data"])
+
+    def put(self, endpoint, url, data, **args):
+        """Add response to cache.
+
+        Parameters
+        ----------
+        endpoint :  str
+                    Name of the endpoint, e.g. "volume_info".
+        url :       str
+                    URL of the request.
+        data :      dict | list
+                    Parsed JSON response.
+        **args
+                    Arguments of the request (e.g. ``volume_id``). Used to
+                    selectively invalidate entries.
+
+        """
+        entry = dict(
+            time=time.time(),
+            url=url,
+            args={k: str(v) for k, v in args.items()},
+            data=copy.deepcopy(data),
+        )
+        self._remember(endpoint, url, entry)
+
+        if self.path is None:
+            return
+
+        try:
+            _atomic_write(self._filepath(endpoint, url), json.dumps(entry).encode())
+        except OSError:
+            # E.g. disk full - the response is still cached in memory
+            pass
+
+    def invalidate(self, endpoint=None, **args):
+        """Remove cached responses.
+
+        Parameters
+        ----------
+        endpoint :  str, optional
+                    Name of the endpoint, e.g. "change_stacks". If None,
+                    will invalidate all endpoints.
+        **args
+                    If provided, will only invalidate responses for requests
+                    with matching arguments, e.g. ``volume_id="some_volume"``.
+
+        """
+        with self._lock:
+            for key, entry in list(self._mem.items()):
+                if endpoint and key[0] != endpoint:
+                    continue
+                if any(entry["args"].get(k) != str(v) for k, v in args.items()):
+                    continue
+                del self._mem[key]
+
+        if self.path is None:
+            return
+
+        endpoints = [endpoint] if endpoint else os.listdir(self.path)
+        for ep in endpoints:
+            d = os.path.join(self.path, ep)
+            if not os.path.isdir(d):
+                continue
+            for e in os.scandir(d):
+                if e.name.endswith(".tmp"):
+                    continue
+                if args:
+                    try:
+                        with open(e.path, "r") as f:
+                            stored = json.load(f)["args"]
+                    except (FileNotFoundError, ValueError):
+                        continue
+                    if any(stored.get(k) != str(v) for k, v in args.items()):
+                        continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(e.path)
+
+    def clear(self):
+        """Remove all responses from the cache."""
+        self.invalidate()
+
+    def _remember(self, endpoint, url, entry):
+        """Add entry to in-memory cache."""
+        with self._lock:
+            self._mem[(endpoint, url)] = entry
+            self._mem.move_to_end((endpoint, url))
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+
+# Empty (keys, seg_ids, last used) for ``SegmentationMemo``
+_NO_VOXELS = (
+    np.zeros(0, dtype=np.uint64),
+    np.zeros(0, dtype=np.uint64),
+    np.zeros(0, dtype=np.int64),
+)
+
+# Bits per axis of voxels packed into ``SegmentationMemo`` keys
+_KEY_BITS = 21
+
+
+def _pack_voxels(voxels):
+    """Pack (N, 3) int64 voxels into (N, ) uint64 keys.
+
+    Returns
+    -------
+    keys :      (N, ) array of uint64
+    valid :     (N, ) array of bool
+                Whether the voxel fits into ``_KEY_BITS`` per axis. Keys of
+                other voxels are meaningless.
+
+    """
+    v = voxels + 2 ** (_KEY_BITS - 1)
+    valid = ((v >= 0) & (v < 2**_KEY_BITS)).all(axis=1)
+    v = v.astype(np.uint64)
+    bits = np.uint64(_KEY_BITS)
+    keys = (v[:, 0] << (bits + bits)) | (v[:, 1] << bits) | v[:, 2]
+    return keys, valid
+
+
+def _atomic_write(fp, data):
+    """Write ``data`` to file so that readers never see a partial file.
+
+    Writes to a temporary file first and then (atomically) moves it into
+    place. Creates the parent directory if necessary.
+    """
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, fp)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+
+def _close_maps(views):
+    """Release memoryviews returned by ``FragmentCache.get`` and their maps."""
+    for mv in views:
+        mm = mv.obj
+        mv.release()
+        try:
+            mm.close()
+        except BufferError:
+            # Still exported elsewhere - will be closed once garbage collected
+            pass
+
+
+def _list_files(path):
+    """Return ``(path, size, mtime)`` for all files in an on-disk cache."""
+    files = []
+    for d in os.scandir(path):
+        if not d.is_dir():
+            continue
+        for e in os.scandir(d.path):
+            if e.name.endswith(".tmp"):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            files.append((e.path, st.st_size, st.st_mtime))
+    return files
+
+
+def _evict(files, max_size):
+    """Remove least recently used ``files`` until total size is within limit."""
+    total = sum(s for _, s, _ in files)
+
+    # Oldest first
+    for fp, s, _ in sorted(files, key=lambda x: x[2]):
+        if total <= max_size:
+            break
+        try:
+            os.remove(fp)
+        except FileNotFoundError:
+            # Already removed by another process
+            pass
+        total -= s
+
+
+def _eval_metadata_cache(cache):
+    """Evaluate ``metadata_cache`` parameter.
+
+    True means the shared default cache, False/None no cache.
+    """
+    global _default_metadata_cache
+
+    if cache is None or cache is False or isinstance(cache, MetadataCache):
+        return cache or None
+    elif cache is True:
+        if _default_metadata_cache is None:
+            _default_metadata_cache = MetadataCache()
+        return _default_metadata_cache
+    elif isinstance(cache, str):
+        return MetadataCache(cache)
+    raise TypeError("Expected MetadataCache, str or bool, got {}".format(type(cache)))
+
+
+def _eval_fragment_cache(cache):
+    """Evaluate ``cache`` parameter."""
+    if cache is None or isinstance(cache, FragmentCache):
+        return cache
+    elif isinstance(cache, str):
+        return FragmentCache(cache)
+    raise TypeError("Expected FragmentCache, str or None, got {}".format(type(cache)))
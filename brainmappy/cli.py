@@ -0,0 +1,143 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""Command line interface for resumable bulk exports.
+
+Export meshes for object IDs listed in ``ids.txt`` into a mesh store::
+
+    brainmappy --volume VOLUME meshes ids.txt meshes/
+
+Look up segment IDs for each coordinate file listed in ``files.txt``::
+
+    brainmappy --volume VOLUME seg files.txt seg/
+
+Both keep a checkpoint log in the output directory: re-run the same command
+to resume an interrupted job. Uses stored credentials (see
+``brainmappy.acquire_credentials``) unless ``--credentials`` is given.
+"""
+
+import argparse
+import os
+import sys
+
+
+def main(argv=None):
+    """Run command line interface."""
+    args = _parser().parse_args(argv)
+
+    # Import here so that ``--help`` is fast
+    from . import auth, client, jobs, utils
+
+    utils.use_pbars = not args.quiet
+
+    session = auth.acquire_credentials(
+        client_secret_file=args.credentials, make_global=False
+    )
+
+    with client.BrainmapsClient(session, max_threads=args.threads) as c:
+        if args.command == "meshes":
+            jobs.export_meshes(
+                jobs.read_manifest(args.manifest),
+                args.out,
+                batch_size=args.batch_size,
+                lod=args.lod,
+                volume_id=args.volume,
+                change_stack_id=args.change_stack,
+                max_threads=args.threads,
+                cache=args.fragment_cache,
+                processes=args.processes,
+                session=c,
+            )
+        elif args.command == "seg":
+            files = jobs.read_manifest(args.manifest)
+            # Paths in the manifest (and outputs) are relative to the manifest
+            root = None
+            if args.manifest != "-":
+                root = os.path.dirname(os.path.abspath(args.manifest))
+                files = [os.path.join(root, fp) for fp in files]
+            jobs.export_seg(
+                files,
+                args.out,
+                volume_id=args.volume,
+                change_stack_id=args.change_stack,
+                raw_coords=args.raw_coords,
+                max_threads=args.threads,
+                chunking=args.chunking,
+                root=root,
+                session=c,
+            )
+
+    return 0
+
+
+def _parser():
+    """Return argument parser."""
+    parser = argparse.ArgumentParser(
+        prog="brainmappy",
+        description=__doc__.split("\n")[0],
+        epilog="Re-run an interrupted job with the same output to resume it.",
+    )
+    parser.add_argument("--volume", required=True, help="ID of segmentation volume.")
+    parser.add_argument(
+        "--credentials",
+        help="Path to client_secret.json. Default is to use stored credentials.",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=10, help="Max number of parallel requests."
+    )
+    parser.add_argument("--change-stack", help="ID of alternative agglomeration stack.")
+    parser.add_argument(
+        "--quiet", action="store_true", help="Don't show progress bars."
+    )
+
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    meshes = sub.add_parser("meshes", help="Export meshes into a mesh store.")
+    meshes.add_argument(
+        "manifest", help='File with object IDs (one per line) or "-" for stdin.'
+    )
+    meshes.add_argument("out", help="Directory of the mesh store.")
+    meshes.add_argument("--lod", type=int, default=0, help="Level of detail.")
+    meshes.add_argument(
+        "--batch-size", type=int, default=100, help="Number of objects per batch."
+    )
+    meshes.add_argument(
+        "--processes", type=int, help="Number of processes for decoding meshes."
+    )
+    meshes.add_argument("--fragment-cache", help="Directory of a fragment cache.")
+
+    seg = sub.add_parser("seg", help="Look up segment IDs for coordinate files.")
+    seg.add_argument(
+        "manifest",
+        help="File with paths to .npy or CSV coordinate files (one per line) "
+        'or "-" for stdin.',
+    )
+    seg.add_argument("out", help="Output directory.")
+    seg.add_argument(
+        "--raw-coords",
+        action="store_true",
+        help="Coordinates are in voxels instead of nm.",
+    )
+    seg.add_argument(
+        "--chunking",
+        default="morton",
+        choices=("morton", "grid", "kmeans"),
+        help="How to group coordinates into requests.",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main())
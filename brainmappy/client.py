@@ -0,0 +1,283 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains a reusable client for the brainmaps API."""
+
+import collections
+import threading
+import weakref
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from .auth import _eval_session
+from .cache import _eval_fragment_cache, _eval_metadata_cache
+from .decode import _eval_decode_pool
+from .scheduler import RequestScheduler
+
+__all__ = ["BrainmapsClient"]
+
+# Default clients for sessions (see ``_eval_client``). Entries go away with
+# their session: clients only hold a copy of it (see ``_copy_session``)
+_default_clients = weakref.WeakKeyDictionary()
+_default_lock = threading.Lock()
+_anonymous = None
+
+
+class BrainmapsClient:
+    """Long-lived client for the brainmaps API.
+
+    Bundles everything that is expensive to set up and worth reusing across
+    calls: the HTTP connection pool (i.e. open TLS connections), the thread
+    pool + adaptive scheduler that runs requests in parallel and (optional)
+    caches.
+
+    All fetch functions accept a client in place of a session. Functions
+    called with a plain ``AuthorizedSession`` (or with the global session)
+    use a default client for that session.
+
+    Parameters
+    ----------
+    session :           AuthorizedSession | requests.Session, optional
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals. The client uses a
+                        copy with its own connection pool - the session
+                        itself is not modified.
+    max_threads :       int
+                        Max number of parallel requests. Individual calls can
+                        ask for more (up to the scheduler's ``pool_size``).
+    pool_size :         int, optional
+                        Max number of connections kept open. Defaults to
+                        ``max_threads``.
+    fragment_cache :    FragmentCache | str, optional
+                        Cache used by mesh fetches unless they are given
+                        their own. See ``brainmappy.FragmentCache``.
+    memo :              SegmentationMemo, optional
+                        Memo used by segmentation lookups unless they are
+                        given their own. See ``brainmappy.SegmentationMemo``.
+    chunk_cache :       SegmentationChunkCache, optional
+                        Chunk cache used by segmentation lookups unless they
+                        are given their own. See
+                        ``brainmappy.SegmentationChunkCache``.
+    metadata_cache :    MetadataCache | str | bool
+                        Cache for metadata (volume info, mesh lists, etc).
+                        True (default) uses a cache shared with all other
+                        clients, False disables caching. A string is
+                        interpreted as path to the cache directory. See
+                        ``brainmappy.MetadataCache``.
+    scheduler :         RequestScheduler, optional
+                        Scheduler to run requests with. If not provided will
+                        create a new one.
+    processes :         int | DecodePool, optional
+                        Decode large mesh responses in this many worker
+                        processes (or in the given pool) unless a call asks for
+                        something else. See ``brainmappy.DecodePool``.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> client = bm.BrainmapsClient(max_threads=20, memo=bm.SegmentationMemo())
+    >>> ids = client.get_seg_at_location(coords)
+    >>> # Equivalently
+    >>> ids = bm.get_seg_at_location(coords, session=client)
+
+    """
+
+    def __init__(
+        self,
+        session=None,
+        max_threads=10,
+        pool_size=None,
+        fragment_cache=None,
+        memo=None,
+        metadata_cache=True,
+        scheduler=None,
+        processes=None,
+        chunk_cache=None,
+    ):
+        if session is None or not isinstance(session, requests.Session):
+            session = _eval_session(session)
+
+        # Work on a copy so that the caller's session keeps its adapters
+        self.session = _copy_session(session)
+        self.max_threads = max_threads
+        self.pool_size = pool_size or max_threads
+        self.fragment_cache = _eval_fragment_cache(fragment_cache)
+        self.memo = memo
+        self.chunk_cache = chunk_cache
+        self.metadata_cache = _eval_metadata_cache(metadata_cache)
+        self.scheduler = scheduler or RequestScheduler(max_concurrency=max_threads)
+        self.decode_pool = _eval_decode_pool(processes)
+
+        # Make sure the connection pool can hold a connection for each thread.
+        # Custom adapters are used as they are.
+        self._adapters = []
+        for prefix in ("https://", "http://"):
+            old = self.session.adapters.get(prefix)
+            if type(old) is not HTTPAdapter:
+                continue
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=self.pool_size,
+                max_retries=old.max_retries,
+                pool_block=old._pool_block,
+            )
+            self.session.mount(prefix, adapter)
+            self._adapters.append(adapter)
+
+    def __repr__(self):
+        return "<{} max_threads={} pool_size={}>".format(
+            type(self).__name__, self.max_threads, self.pool_size
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Shut down thread pool and close open connections."""
+        self.scheduler.close()
+        for adapter in self._adapters:
+            adapter.close()
+
+    def get_schemas(self):
+        """Return DataFrame with available schemata. See ``brainmappy.get_schemas``."""
+        return fetch.get_schemas(session=self)
+
+    def get_volumes(self):
+        """Return list of available volumes. See ``brainmappy.get_volumes``."""
+        return fetch.get_volumes(session=self)
+
+    def get_volume_info(self, volume_id):
+        """Get info on volume. See ``brainmappy.get_volume_info``."""
+        return fetch.get_volume_info(volume_id, session=self)
+
+    def get_mesh_list(self, volume_id):
+        """List meshes for this volume. See ``brainmappy.get_mesh_list``."""
+        return fetch.get_mesh_list(volume_id, session=self)
+
+    def get_resource_list(self, object_id, volume_id):
+        """List resources for given object. See ``brainmappy.get_resource_list``."""
+        return fetch.get_resource_list(object_id, volume_id, session=self)
+
+    def get_projects(self):
+        """Return list of projects. See ``brainmappy.get_projects``."""
+        return fetch.get_projects(session=self)
+
+    def get_datasets(self, project_id):
+        """Return datasets in given project. See ``brainmappy.get_datasets``."""
+        return fetch.get_datasets(project_id, session=self)
+
+    def get_change_stacks(self, volume_id):
+        """Return change stacks for given volume. See ``brainmappy.get_change_stacks``."""
+        return fetch.get_change_stacks(volume_id, session=self)
+
+    def get_fragments(self, object_id, mesh_name, **kwargs):
+        """Return fragments for given object. See ``brainmappy.get_fragments``."""
+        return fetch.get_fragments(object_id, mesh_name, session=self, **kwargs)
+
+    def get_meshes_batch(self, object_id, **kwargs):
+        """Return mesh for given object. See ``brainmappy.get_meshes_batch``."""
+        return fetch.get_meshes_batch(object_id, session=self, **kwargs)
+
+    def get_meshes_bulk(self, object_ids, **kwargs):
+        """Return meshes for many objects. See ``brainmappy.get_meshes_bulk``."""
+        return fetch.get_meshes_bulk(object_ids, session=self, **kwargs)
+
+    def iter_meshes_progressive(self, object_id, **kwargs):
+        """Yield meshes from coarse to fine. See ``brainmappy.iter_meshes_progressive``."""
+        return fetch.iter_meshes_progressive(object_id, session=self, **kwargs)
+
+    def get_meshes_progressive(self, object_id, callback, **kwargs):
+        """Fetch meshes from coarse to fine. See ``brainmappy.get_meshes_progressive``."""
+        return fetch.get_meshes_progressive(object_id, callback, session=self, **kwargs)
+
+    def refresh_meshes(self, meshes, **kwargs):
+        """Update meshes with changed fragments. See ``brainmappy.refresh_meshes``."""
+        return fetch.refresh_meshes(meshes, session=self, **kwargs)
+
+    def get_seg_at_location(self, coords, **kwargs):
+        """Return segment IDs at locations. See ``brainmappy.get_seg_at_location``."""
+        return fetch.get_seg_at_location(coords, session=self, **kwargs)
+
+    def get_seg_in_bbox(self, bbox, **kwargs):
+        """Return segmentation for bounding box. See ``brainmappy.get_seg_in_bbox``."""
+        return fetch.get_seg_in_bbox(bbox, session=self, **kwargs)
+
+    def iter_seg_at_location(self, coords, **kwargs):
+        """Yield segment IDs at locations. See ``brainmappy.iter_seg_at_location``."""
+        return fetch.iter_seg_at_location(coords, session=self, **kwargs)
+
+
+def _eval_client(session=None):
+    """Return client for given session.
+
+    Parameters
+    ----------
+    session :   BrainmapsClient | AuthorizedSession | requests.Session | None
+                If None, will use (the default client for) the global session.
+
+    Returns
+    -------
+    BrainmapsClient
+
+    """
+    if isinstance(session, BrainmapsClient):
+        return session
+
+    if session is None or not isinstance(session, requests.Session):
+        session = _eval_session(session)
+
+    with _default_lock:
+        client = _default_clients.get(session)
+        if client is None:
+            client = _default_clients[session] = BrainmapsClient(session)
+            # Shut down threads and connections once the session is gone
+            weakref.finalize(session, client.close)
+
+    return client
+
+
+def _copy_session(session):
+    """Return shallow copy of session with its own adapters.
+
+    Credentials, headers, proxies, etc. are shared with the original.
+    """
+    # Not ``copy.copy``: sessions only pickle requests' own attributes
+    new = object.__new__(type(session))
+    new.__dict__.update(session.__dict__)
+    new.adapters = collections.OrderedDict(session.adapters)
+    return new
+
+
+def _anonymous_client():
+    """Return client without credentials.
+
+    For requests that carry their own authorization headers (e.g. cURLs
+    copied from neuroglancer).
+    """
+    global _anonymous
+
+    with _default_lock:
+        if _anonymous is None:
+            _anonymous = BrainmapsClient(requests.Session())
+
+    return _anonymous
+
+
+# Import at the end to avoid circular imports
+from . import fetch  # noqa: E402
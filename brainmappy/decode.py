@@ -0,0 +1,287 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains decoding of mesh data in worker processes."""
+
+import os
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import numpy as np
+
+from . import metrics
+from .io import _as_buffer, _decode_into, _decode_raw_ng, _scan_raw_ng
+
+__all__ = ["DecodePool"]
+
+# Shared pools by number of processes (see ``_eval_decode_pool``)
+_default_pools = {}
+_default_lock = threading.Lock()
+
+
+class DecodePool:
+    """Pool of processes decoding neuroglancer's binary mesh format.
+
+    Raw data is handed to the workers and decoded vertices and faces are
+    returned via shared memory instead of being pickled. Payloads smaller than
+    ``min_size`` are not worth the overhead and are decoded in the calling
+    process.
+
+    Worker processes are started on first use and kept running until the
+    pool is closed. They are started via a fork server (or spawned on
+    platforms without one), so scripts using a pool need the usual
+    ``if __name__ == "__main__":`` guard.
+
+    Parameters
+    ----------
+    processes : int, optional
+                Number of worker processes. Defaults to the number of CPUs.
+    min_size :  int
+                Min size (in bytes) of payloads to decode in a worker process.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> with bm.DecodePool(16) as pool:
+    ...     meshes = bm.get_meshes_bulk(ids, processes=pool)
+
+    """
+
+    def __init__(self, processes=None, min_size=2**18):
+        self.processes = processes or os.cpu_count()
+        self.min_size = min_size
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<{} processes={}>".format(type(self).__name__, self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def executor(self):
+        """Process pool - started on first access."""
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Forking while other threads (e.g. the scheduler's) hold
+                # locks can deadlock the workers - start them from a clean
+                # server process instead
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    ctx = multiprocessing.get_context("forkserver")
+                else:
+                    ctx = multiprocessing.get_context("spawn")
+
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=ctx
+                )
+            return self._executor
+
+    def submit(self, data):
+        """Decode raw neuroglancer mesh data.
+
+        Parameters
+        ----------
+        data :      bytes | bytearray | memoryview
+
+        Returns
+        -------
+        concurrent.futures.Future
+                    Resolves to ``(frags, verts, faces)`` - see
+                    ``brainmappy.io._decode_raw_ng``.
+
+        """
+        buf = _as_buffer(data)
+        out = Future()
+
+        if len(buf) < self.min_size:
+            with metrics.timer("ng_decode"):
+                out.set_result(_decode_raw_ng(buf))
+            return out
+
+        from multiprocessing.shared_memory import SharedMemory
+
+        size = len(buf)
+        shm = SharedMemory(create=True, size=size)
+        shm.buf[:size] = buf
+        del buf
+
+        def done(f):
+            shm.close()
+            shm.unlink()
+            try:
+                out.set_result(_receive(*f.result()))
+            except BaseException as e:
+                out.set_exception(e)
+
+        self.executor.submit(_decode_shared, shm.name, size).add_done_callback(done)
+
+        return out
+
+    def close(self):
+        """Shut down worker processes."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def imap_decode(items, pool=None):
+    """Decode raw mesh data and yield results in order of completion.
+
+    Parameters
+    ----------
+    items :     iterable of (key, data)
+                Will be consumed while earlier items are being decoded.
+    pool :      DecodePool, optional
+                If None, will decode in the calling process.
+
+    Yields
+    ------
+    key, (frags, verts, faces)
+
+    """
+    if pool is None:
+        for key, data in items:
+            with metrics.timer("ng_decode"):
+                decoded = _decode_raw_ng(data)
+            del data
+            yield key, decoded
+        return
+
+    pending = {}
+    for key, data in items:
+        pending[pool.submit(data)] = key
+        del data
+
+        # Don't let finished results (and shared memory) pile up
+        block = len(pending) > 2 * pool.processes
+        done, _ = wait(
+            pending, timeout=None if block else 0, return_when=FIRST_COMPLETED
+        )
+        for f in done:
+            yield pending.pop(f), f.result()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            yield pending.pop(f), f.result()
+
+
+def _decode_shared(name, size):
+    """Decode data in shared memory into a new block of shared memory.
+
+    Runs in the worker processes.
+
+    Returns
+    -------
+    frags :     dict
+                Fragment headers as returned by ``_scan_raw_ng``.
+    name :      str
+                Name of the shared memory with vertices followed by faces.
+                The caller is responsible for unlinking it.
+    n_verts :   int
+    n_faces :   int
+
+    """
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = SharedMemory(name=name)
+    buf = shm.buf[:size]
+    try:
+        frags = _scan_raw_ng(buf)
+    except BaseException:
+        buf.release()
+        shm.close()
+        raise
+
+    n_verts = int(frags["n_verts"].sum())
+    n_faces = int(frags["n_faces"].sum())
+
+    out = SharedMemory(create=True, size=max((n_verts + n_faces) * 12, 1))
+    try:
+        verts, faces = _shared_arrays(out, n_verts, n_faces)
+        _decode_into(buf, frags, verts, faces)
+    except BaseException:
+        out.unlink()
+        raise
+
+    # Views must be gone before we can close
+    del verts, faces
+    out.close()
+    buf.release()
+    shm.close()
+
+    return frags, out.name, n_verts, n_faces
+
+
+def _receive(frags, name, n_verts, n_faces):
+    """Copy decoded arrays out of shared memory and release it."""
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = SharedMemory(name=name)
+    try:
+        v, f = _shared_arrays(shm, n_verts, n_faces)
+        verts, faces = v.copy(), f.copy()
+        del v, f
+    finally:
+        shm.unlink()
+    shm.close()
+
+    return frags, verts, faces
+
+
+def _shared_arrays(shm, n_verts, n_faces):
+    """Return vertex and face arrays backed by given shared memory."""
+    verts = np.ndarray((n_verts, 3), dtype="<f4", buffer=shm.buf)
+    faces = np.ndarray((n_faces, 3), dtype="<u4", buffer=shm.buf, offset=n_verts * 12)
+    return verts, faces
+
+
+def _eval_decode_pool(processes):
+    """Return decode pool for given number of processes.
+
+    Parameters
+    ----------
+    processes : DecodePool | int | None
+                An int returns a pool shared with all other callers asking for
+                the same number of processes. None or 0 means no pool.
+
+    Returns
+    -------
+    DecodePool | None
+
+    """
+    if not processes:
+        return None
+    elif isinstance(processes, DecodePool):
+        return processes
+    elif isinstance(processes, int):
+        with _default_lock:
+            if processes not in _default_pools:
+                _default_pools[processes] = DecodePool(processes)
+            return _default_pools[processes]
+
+    raise TypeError(
+        "`processes` must be DecodePool or int, got {}".format(type(processes))
+    )
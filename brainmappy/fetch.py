@@ -14,22 +14,25 @@
 
 """This module contains functions to fetch data via Google's brainmaps API."""
 
-import functools
-import math
+import collections
+import concurrent.futures
+import itertools
+import json
+import threading
 import urllib
 import warnings
 
 import numpy as np
-import pandas as pd
-import trimesh as tm
 
-from tqdm import tqdm
-from requests_futures.sessions import FuturesSession
-from scipy.cluster.vq import kmeans2
-
-from . import utils
-from .auth import _eval_session, _eval_volumeId
-from .io import parse_raw_ng
+from . import metrics, utils
+from .auth import _eval_volumeId
+from .cache import _eval_fragment_cache
+from .client import _eval_client
+from .decode import _eval_decode_pool, imap_decode
+from .scheduler import imap_requests
+from .utils import tqdm
+from .io import _as_buffer, _split_fragments, _stack_meshes
+from .mesh import _eval_return_type, _make_mesh
 
 __all__ = [
     "get_change_stacks",
@@ -37,22 +40,27 @@ __all__ = [
     "get_fragments",
     "get_mesh_list",
     "get_meshes_batch",
+    "get_meshes_bulk",
+    "get_meshes_progressive",
     "get_projects",
     "get_resource_list",
     "get_schemas",
     "get_seg_at_location",
+    "get_seg_in_bbox",
     "get_volume_info",
     "get_volumes",
+    "iter_meshes_progressive",
+    "iter_seg_at_location",
+    "refresh_meshes",
 ]
 
 
-@functools.lru_cache(maxsize=32)
 def get_schemas(session=None):
     """Return DataFrame with available schemata.
 
     Parameters
     ----------
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
 
@@ -61,23 +69,22 @@ def get_schemas(session=None):
     pandas.DataFrame
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("$discovery", "rest")
-    resp = session.get(url)
+    data = _get_metadata(client, "schemas", url)
 
-    resp.raise_for_status()
+    import pandas as pd
 
-    return pd.DataFrame.from_records(resp.json())
+    return pd.DataFrame.from_records(data)
 
 
-@functools.lru_cache(maxsize=32)
 def get_volumes(session=None):
     """Return list of available volumes.
 
     Parameters
     ----------
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will use search in globals.
 
@@ -86,17 +93,14 @@ def get_volumes(session=None):
     list
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "volumes")
-    resp = session.get(url)
-
-    resp.raise_for_status()
+    data = _get_metadata(client, "volumes", url)
 
-    return resp.json()["volumeId"]
+    return data["volumeId"]
 
 
-@functools.lru_cache(maxsize=32)
 def get_volume_info(volume_id, session=None):
     """Get info on volume.
 
@@ -104,7 +108,7 @@ def get_volume_info(volume_id, session=None):
     ----------
     volume_id :         str
                         Volume ID to look up info for.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
 
@@ -121,17 +125,14 @@ def get_volume_info(volume_id, session=None):
                                            'size': {'x': int, 'y': int, 'z': int}}]}
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "volumes", volume_id)
-    resp = session.get(url)
+    data = _get_metadata(client, "volume_info", url, volume_id=volume_id)
 
-    resp.raise_for_status()
-
-    return resp.json()["geometry"]
+    return data["geometry"]
 
 
-@functools.lru_cache(maxsize=32)
 def get_mesh_list(volume_id, session=None):
     """List meshes for this volume.
 
@@ -139,7 +140,7 @@ def get_mesh_list(volume_id, session=None):
     ----------
     volume_id :         str
                         Volume ID to look up info for.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will use search in globals.
 
@@ -154,17 +155,14 @@ def get_mesh_list(volume_id, session=None):
                         If no meshes
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "objects", volume_id, "meshes")
-    resp = session.get(url)
-
-    resp.raise_for_status()
+    data = _get_metadata(client, "mesh_list", url, volume_id=volume_id)
 
-    return resp.json().get("meshes", None)
+    return data.get("meshes", None)
 
 
-@functools.lru_cache(maxsize=32)
 def get_resource_list(object_id, volume_id, session=None):
     """List resources for a given object.
 
@@ -174,7 +172,7 @@ def get_resource_list(object_id, volume_id, session=None):
                         ID of object.
     volume_id :         str
                         Volume ID to look up info for.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will use search in globals.
 
@@ -183,23 +181,22 @@ def get_resource_list(object_id, volume_id, session=None):
     dict
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "volumes", volume_id, "objects", object_id, "resources")
-    resp = session.get(url)
-
-    resp.raise_for_status()
+    data = _get_metadata(
+        client, "resource_list", url, volume_id=volume_id, object_id=object_id
+    )
 
-    return resp.json()
+    return data
 
 
-@functools.lru_cache(maxsize=32)
 def get_projects(session=None):
     """Return list of projects.
 
     Parameters
     ----------
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
 
@@ -208,17 +205,16 @@ def get_projects(session=None):
     pandas.DataFrame
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "projects")
-    resp = session.get(url)
+    data = _get_metadata(client, "projects", url)
 
-    resp.raise_for_status()
+    import pandas as pd
 
-    return pd.DataFrame.from_records(resp.json()["project"])
+    return pd.DataFrame.from_records(data["project"])
 
 
-@functools.lru_cache(maxsize=32)
 def get_datasets(project_id, session=None):
     """Return list of datasets in given project.
 
@@ -226,7 +222,7 @@ def get_datasets(project_id, session=None):
     ----------
     project_id :        str | int
                         Project ID.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
 
@@ -235,17 +231,14 @@ def get_datasets(project_id, session=None):
     list of datasetIds
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "datasets", project_id=project_id)
-    resp = session.get(url)
-
-    resp.raise_for_status()
+    data = _get_metadata(client, "datasets", url, project_id=project_id)
 
-    return resp.json()["datasetIds"]
+    return data["datasetIds"]
 
 
-@functools.lru_cache(maxsize=32)
 def get_change_stacks(volume_id, session=None):
     """Return list of change stacks for given volume.
 
@@ -253,7 +246,7 @@ def get_change_stacks(volume_id, session=None):
     ----------
     volume_id :         int
                         ID of volume. See ``brainmappy.get_volumes``.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
 
@@ -261,15 +254,20 @@ def get_change_stacks(volume_id, session=None):
     -------
     list
 
+    Notes
+    -----
+    Metadata is cached for a few minutes (see ``brainmappy.MetadataCache``).
+    To see new change stacks right away, invalidate the cache::
+
+        >>> client.metadata_cache.invalidate("change_stacks", volume_id=volume_id)
+
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
 
     url = _make_url("v1", "changes", volume_id, "change_stacks")
-    resp = session.get(url)
-
-    resp.raise_for_status()
+    data = _get_metadata(client, "change_stacks", url, volume_id=volume_id)
 
-    return resp.json()["changeStackId"]
+    return data["changeStackId"]
 
 
 def get_fragments(
@@ -291,7 +289,7 @@ def get_fragments(
     volume_id :         str | None, optional
                         ID of segmentation volume to use. If None, will search
                         in globals.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
     change_stack_id :   str, optional
@@ -303,26 +301,16 @@ def get_fragments(
                         List of object ID -> fragment ID mapping.
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
     volume_id = _eval_volumeId(volume_id)
 
-    url = _make_url(
-        "v1",
-        "objects",
-        volume_id,
-        "meshes",
-        mesh_name + ":listfragments",
-        objectId=object_id,
-        returnSupervoxelIds=True,
-    )
+    url = _fragments_url(object_id, mesh_name, volume_id, change_stack_id)
 
-    if change_stack_id:
-        url += "&" + urllib.parse.urlencode({"header.changeStackId": change_stack_id})
-
-    resp = session.get(url)
+    resp = _get(client, url, endpoint="listfragments")
     resp.raise_for_status()
 
-    frags = resp.json()
+    with metrics.timer("json_decode"):
+        frags = resp.json()
 
     if not frags:
         raise ValueError("No fragments found for object {}".format(object_id))
@@ -336,6 +324,11 @@ def get_meshes_batch(
     volume_id=None,
     session=None,
     change_stack_id=None,
+    max_threads=10,
+    cache=None,
+    store=None,
+    return_type="trimesh",
+    processes=None,
 ):
     """Return meshes for given object ID.
 
@@ -351,73 +344,770 @@ def get_meshes_batch(
     volume_id :         str | None, optional
                         ID of segmentation volume to use. If not provided, will
                         use global.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
     change_stack_id :   str, optional
                         If provided, will use alternative agglomeration stack.
+    max_threads :       int, optional
+                        Max number of parallel requests. Reduce if you run into
+                        any issues.
+    cache :             FragmentCache | str, optional
+                        If provided, will only fetch fragments that are not
+                        already in the cache and add new fragments to it. A
+                        string is interpreted as path to the cache directory.
+                        See ``brainmappy.FragmentCache``.
+    store :             MeshStore, optional
+                        If provided, will write the mesh to this store instead
+                        of returning it. Fragments are streamed into the store
+                        as they arrive (in that order), so the full mesh is
+                        never held in memory.
+    return_type :       "trimesh" | "mesh" | "arrays"
+                        What to return: a ``trimesh.Trimesh`` (default; note
+                        that this merges duplicate vertices which can be slow
+                        for large meshes), a lightweight ``brainmappy.Mesh``
+                        or a ``(vertices, faces)`` tuple of numpy arrays. The
+                        latter two are not processed in any way - see
+                        ``brainmappy.weld_vertices`` to merge vertices along
+                        fragment seams.
+    processes :         int | DecodePool, optional
+                        If provided, will decode large responses in this many
+                        worker processes (or in the given pool) instead of in
+                        this process. Pools are kept running for subsequent
+                        calls. See ``brainmappy.DecodePool``.
 
     Returns
     -------
-    vertices, faces
+    trimesh.Trimesh | Mesh | (vertices, faces)
+                        Depending on ``return_type``.
+    MeshStore
+                        If ``store`` is provided.
 
     """
-    session = _eval_session(session)
+    client = _eval_client(session)
     volume_id = _eval_volumeId(volume_id)
+    cache = _eval_fragment_cache(cache or client.fragment_cache)
+    return_type = _eval_return_type(return_type)
+    pool = _eval_decode_pool(processes or client.decode_pool)
 
-    mesh_info = get_mesh_list(volume_id, session=session)
-
-    if isinstance(lod, int):
-        mesh_name = mesh_info[lod]["name"]
-    elif isinstance(lod, str):
-        assert lod in [m["name"] for m in mesh_info]
-        mesh_name = lod
-    else:
-        raise ValueError("lod must be int or str")
+    mesh_name = _eval_lod(lod, volume_id, client)
 
     # Get the fragments
     frags = get_fragments(
         object_id=object_id,
         volume_id=volume_id,
-        session=session,
+        session=client,
         change_stack_id=change_stack_id,
         mesh_name=mesh_name,
     )
 
+    if store is not None:
+        with store.writer(object_id) as w:
+            for pieces in _iter_fragments(
+                frags,
+                mesh_name=mesh_name,
+                volume_id=volume_id,
+                client=client,
+                max_threads=max_threads,
+                cache=cache,
+                pool=pool,
+            ):
+                with metrics.timer("store_write"):
+                    for verts, faces in pieces.values():
+                        w.add(verts, faces)
+        return store
+
+    pieces = _fetch_fragments(
+        frags,
+        mesh_name=mesh_name,
+        volume_id=volume_id,
+        client=client,
+        max_threads=max_threads,
+        cache=cache,
+        pool=pool,
+    )
+
+    if return_type == "trimesh":
+        import trimesh  # noqa: F401 - don't time the import
+
+    # Combine fragments in their original order - make sure to offset faces
+    with metrics.timer("assemble"):
+        return _assemble_mesh(frags, pieces, return_type)
+
+
+def iter_meshes_progressive(
+    object_id,
+    lods=None,
+    volume_id=None,
+    session=None,
+    change_stack_id=None,
+    max_threads=10,
+    cache=None,
+    return_type="trimesh",
+    processes=None,
+):
+    """Yield meshes for given object from coarse to fine level of detail.
+
+    Fragment lists for all levels are fetched in a single round of parallel
+    requests. The coarsest mesh (usually only a few small fragments) is then
+    fetched and yielded first while finer levels are fetched in the
+    background, so viewers can show something right away and refine as
+    higher resolution data streams in.
+
+    Parameters
+    ----------
+    object_id :         int
+                        ID of object.
+    lods :              list of int | str, optional
+                        Levels of detail to fetch in the given order - see
+                        ``brainmappy.get_meshes_batch``. If not provided,
+                        will fetch all available meshes from the lowest to the
+                        highest resolution.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    max_threads :       int, optional
+                        Max number of parallel requests.
+    cache :             FragmentCache | str, optional
+                        See ``brainmappy.get_meshes_batch``.
+    return_type :       "trimesh" | "mesh" | "arrays"
+                        See ``brainmappy.get_meshes_batch``.
+    processes :         int | DecodePool, optional
+                        See ``brainmappy.get_meshes_batch``.
+
+    Yields
+    ------
+    mesh_name :         str
+                        Name of the meshes (i.e. level of detail).
+    mesh
+                        Mesh of ``return_type``. None if the object has no
+                        fragments at this level of detail.
+
+    See Also
+    --------
+    get_meshes_progressive
+                        Same but delivers meshes to a callback.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> for name, mesh in bm.iter_meshes_progressive(21716312853):
+    ...     viewer.show(mesh)
+
+    """
+    client = _eval_client(session)
+    volume_id = _eval_volumeId(volume_id)
+    cache = _eval_fragment_cache(cache or client.fragment_cache)
+    return_type = _eval_return_type(return_type)
+    pool = _eval_decode_pool(processes or client.decode_pool)
+
+    if lods is None:
+        mesh_names = [m["name"] for m in get_mesh_list(volume_id, session=client)]
+        mesh_names = mesh_names[::-1]
+    else:
+        mesh_names = [_eval_lod(lod, volume_id, client) for lod in lods]
+
+    # Fragment lists for all levels in one go
+    urls = [
+        _fragments_url(object_id, name, volume_id, change_stack_id)
+        for name in mesh_names
+    ]
+    frags = [None] * len(urls)
+    for i, resp in _imap_gets(client, urls, max_threads=max_threads):
+        resp.raise_for_status()
+        with metrics.timer("json_decode"):
+            data = resp.json()
+        frags[i] = list(zip(data.get("supervoxelId", []), data.get("fragmentKey", [])))
+
+    def fetch(i):
+        pieces = _fetch_fragments(
+            frags[i],
+            mesh_name=mesh_names[i],
+            volume_id=volume_id,
+            client=client,
+            max_threads=max_threads,
+            cache=cache,
+            pool=pool,
+        )
+        with metrics.timer("assemble"):
+            return _assemble_mesh(frags[i], pieces, return_type)
+
+    if return_type == "trimesh":
+        import trimesh  # noqa: F401 - don't time the import
+
+    # Fetch each level while the previous one is being consumed
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    futures = [
+        executor.submit(fetch, i) if frags[i] else None for i in range(len(mesh_names))
+    ]
+    try:
+        for name, f in zip(mesh_names, futures):
+            yield name, f.result() if f is not None else None
+    finally:
+        # Don't fetch finer levels nobody is going to look at
+        for f in futures:
+            if f is not None:
+                f.cancel()
+        executor.shutdown(wait=False)
+
+
+def get_meshes_progressive(object_id, callback, **kwargs):
+    """Fetch meshes from coarse to fine level of detail in the background.
+
+    Parameters
+    ----------
+    object_id :     int
+                    ID of object.
+    callback :      callable
+                    Called as ``callback(mesh_name, mesh)`` for each level
+                    of detail as soon as it has arrived. Runs in a
+                    background thread.
+    **kwargs
+                    Passed to ``brainmappy.iter_meshes_progressive``.
+
+    Returns
+    -------
+    concurrent.futures.Future
+                    Resolves to the last (i.e. finest) mesh once all levels
+                    have been delivered.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> f = bm.get_meshes_progressive(21716312853, lambda name, m: viewer.show(m))
+    >>> final = f.result()
+
+    """
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            mesh = None
+            for name, mesh in iter_meshes_progressive(object_id, **kwargs):
+                callback(name, mesh)
+            future.set_result(mesh)
+        except BaseException as e:
+            future.set_exception(e)
+
+    future.set_running_or_notify_cancel()
+    threading.Thread(target=run, daemon=True).start()
+
+    return future
+
+
+def get_meshes_bulk(
+    object_ids,
+    lod=0,
+    volume_id=None,
+    session=None,
+    change_stack_id=None,
+    max_threads=10,
+    cache=None,
+    store=None,
+    return_type="trimesh",
+    processes=None,
+):
+    """Return meshes for many objects.
+
+    Other than calling ``get_meshes_batch`` for each object, this fetches all
+    fragment lists in parallel and then packs fragments from multiple objects
+    into shared ``meshes:batch`` requests. Use this for exporting large numbers
+    of (small) objects.
+
+    Parameters
+    ----------
+    object_ids :        iterable of int
+                        IDs of objects.
+    lod :               int | str, optional
+                        Level of detail. Default is 0 (highest). Can also provide
+                        negative integers - e.g. -1 for the lowest available resolution.
+                        You can also provide a string which much correspond to the
+                        meshes' name - see `get_mesh_list()` for available meshes.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    max_threads :       int, optional
+                        Max number of parallel requests. Reduce if you run into
+                        any issues.
+    cache :             FragmentCache | str, optional
+                        If provided, will only fetch fragments that are not
+                        already in the cache and add new fragments to it. A
+                        string is interpreted as path to the cache directory.
+                        See ``brainmappy.FragmentCache``.
+    store :             MeshStore, optional
+                        If provided, will write meshes to this store instead
+                        of returning them. Each object is written (and its
+                        fragments dropped from memory) as soon as all of its
+                        fragments have arrived. Objects without fragments are
+                        skipped.
+    return_type :       "trimesh" | "mesh" | "arrays"
+                        Type of the returned meshes - see
+                        ``brainmappy.get_meshes_batch``.
+    processes :         int | DecodePool, optional
+                        If provided, will decode large responses in this many
+                        worker processes (or in the given pool) instead of in
+                        this process. Pools are kept running for subsequent
+                        calls. See ``brainmappy.DecodePool``.
+
+    Returns
+    -------
+    dict
+                        ``{object_id: mesh}`` with meshes of ``return_type``.
+                        Objects without any fragments map to ``None``.
+    MeshStore
+                        If ``store`` is provided.
+
+    """
+    client = _eval_client(session)
+    volume_id = _eval_volumeId(volume_id)
+    cache = _eval_fragment_cache(cache or client.fragment_cache)
+    return_type = _eval_return_type(return_type)
+    pool = _eval_decode_pool(processes or client.decode_pool)
+
+    mesh_name = _eval_lod(lod, volume_id, client)
+
+    # Drop duplicates but keep order
+    object_ids = list(dict.fromkeys(object_ids))
+
+    # Get the fragments for all objects
+    frags = _fetch_fragment_lists(
+        client, object_ids, mesh_name, volume_id, change_stack_id, max_threads
+    )
+
+    empty = [ob for ob in object_ids if not frags[ob]]
+    if empty:
+        warnings.warn("No fragments found for {} object(s)".format(len(empty)))
+
+    all_frags = [fr for ob in object_ids for fr in frags[ob]]
+
+    if store is not None:
+        pieces = _iter_fragments(
+            all_frags,
+            mesh_name=mesh_name,
+            volume_id=volume_id,
+            client=client,
+            max_threads=max_threads,
+            cache=cache,
+            pool=pool,
+        )
+        _store_fragments(store, frags, pieces)
+        return store
+
+    # This packs fragments from all objects into shared batches
+    pieces = _fetch_fragments(
+        all_frags,
+        mesh_name=mesh_name,
+        volume_id=volume_id,
+        client=client,
+        max_threads=max_threads,
+        cache=cache,
+        pool=pool,
+    )
+
+    if return_type == "trimesh":
+        import trimesh  # noqa: F401 - don't time the import
+
+    # Combine the fragments for each object
+    meshes = {}
+    for ob in object_ids:
+        if not frags[ob]:
+            meshes[ob] = None
+            continue
+        with metrics.timer("assemble"):
+            meshes[ob] = _assemble_mesh(frags[ob], pieces, return_type)
+
+    return meshes
+
+
+def refresh_meshes(
+    meshes,
+    lod=0,
+    volume_id=None,
+    session=None,
+    change_stack_id=None,
+    max_threads=10,
+    cache=None,
+    processes=None,
+):
+    """Update meshes by fetching only fragments that have changed.
+
+    Fetches the current fragment lists for all objects, downloads only
+    fragments that have been added, drops fragments that have been removed
+    and rebuilds the meshes from old and new fragments. After proofreading
+    edits most fragments of an object are typically unchanged, so this costs
+    a fraction of fetching the full meshes again.
+
+    Parameters
+    ----------
+    meshes :            dict
+                        ``{object_id: Mesh}`` with meshes previously fetched
+                        with ``return_type="mesh"`` (or returned by this
+                        function) - they carry the fragment information
+                        required for the update.
+    lod :               int | str, optional
+                        Level of detail. Must be the same as used for fetching
+                        ``meshes``.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    change_stack_id :   str, optional
+                        The (updated) agglomeration stack to refresh against.
+    max_threads :       int, optional
+                        Max number of parallel requests.
+    cache :             FragmentCache | str, optional
+                        See ``brainmappy.get_meshes_bulk``.
+    processes :         int | DecodePool, optional
+                        See ``brainmappy.get_meshes_bulk``.
+
+    Returns
+    -------
+    dict
+                        ``{object_id: Mesh}``. Unchanged meshes are returned
+                        as is. Objects that no longer have any fragments map
+                        to ``None``.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> meshes = bm.get_meshes_bulk(ids, return_type="mesh")
+    >>> # ... after proofreading
+    >>> meshes = bm.refresh_meshes(meshes, change_stack_id=stack)
+
+    """
+    client = _eval_client(session)
+    volume_id = _eval_volumeId(volume_id)
+    cache = _eval_fragment_cache(cache or client.fragment_cache)
+    pool = _eval_decode_pool(processes or client.decode_pool)
+
+    missing = [ob for ob, m in meshes.items() if getattr(m, "fragments", None) is None]
+    if missing:
+        raise ValueError(
+            "Meshes must have been fetched with `return_type='mesh'` - no "
+            "fragment information for {} object(s)".format(len(missing))
+        )
+
+    mesh_name = _eval_lod(lod, volume_id, client)
+
+    object_ids = list(meshes)
+    frags = _fetch_fragment_lists(
+        client, object_ids, mesh_name, volume_id, change_stack_id, max_threads
+    )
+
+    # Only fetch fragments that are new
+    added = {}
+    for ob in object_ids:
+        old = meshes[ob].fragments
+        for sv, k in frags[ob]:
+            if (int(sv), k) not in old:
+                added[(int(sv), k)] = (sv, k)
+    n_reused = sum(len(fr) for fr in frags.values()) - len(added)
+
+    if metrics.registry.enabled:
+        metrics.registry.inc("cache_hits_total", n_reused, cache="refresh")
+        metrics.registry.inc("cache_misses_total", len(added), cache="refresh")
+
+    pieces = _fetch_fragments(
+        list(added.values()),
+        mesh_name=mesh_name,
+        volume_id=volume_id,
+        client=client,
+        max_threads=max_threads,
+        cache=cache,
+        pool=pool,
+    )
+
+    refreshed = {}
+    for ob in object_ids:
+        mesh = meshes[ob]
+        keys = [(int(sv), k) for sv, k in frags[ob]]
+        if not keys:
+            refreshed[ob] = None
+            continue
+        if keys == list(mesh.fragments):
+            refreshed[ob] = mesh
+            continue
+
+        with metrics.timer("assemble"):
+            combined = {
+                k: pieces[k] if k in pieces else mesh.get_fragment(k)
+                for k in keys
+                if k in pieces or k in mesh.fragments
+            }
+            refreshed[ob] = _assemble_mesh(keys, combined, "mesh")
+
+    return refreshed
+
+
+def _fetch_fragment_lists(
+    client, object_ids, mesh_name, volume_id, change_stack_id=None, max_threads=10
+):
+    """Fetch fragment lists for many objects in parallel.
+
+    Returns
+    -------
+    dict
+                ``{object_id: list of (supervoxel ID, fragment key)}``.
+                Objects without fragments map to empty lists.
+
+    """
+    urls = [
+        _fragments_url(ob, mesh_name, volume_id, change_stack_id) for ob in object_ids
+    ]
+    frags = {}
+    with tqdm(
+        desc="Fetching fragment lists",
+        leave=False,
+        total=len(urls),
+        disable=not utils.use_pbars,
+    ) as pbar:
+        for i, resp in _imap_gets(client, urls, max_threads=max_threads):
+            resp.raise_for_status()
+            with metrics.timer("json_decode"):
+                data = resp.json()
+            frags[object_ids[i]] = list(
+                zip(data.get("supervoxelId", []), data.get("fragmentKey", []))
+            )
+            pbar.update(1)
+
+    return frags
+
+
+def _fetch_fragments(
+    frags, mesh_name, volume_id, client, max_threads=10, cache=None, pool=None
+):
+    """Fetch and decode given fragments.
+
+    Parameters
+    ----------
+    frags :         list of (supervoxel ID, fragment key)
+                    Fragments to fetch. Will be packed into ``meshes:batch``
+                    requests of 100 fragments each.
+    mesh_name :     str
+    volume_id :     str
+    client :        BrainmapsClient
+    max_threads :   int
+                    Max number of parallel requests.
+    cache :         FragmentCache, optional
+                    If provided will only fetch fragments not already in the
+                    cache and add newly fetched fragments to it.
+    pool :          DecodePool, optional
+                    If provided, will decode in worker processes.
+
+    Returns
+    -------
+    dict
+                    ``{(supervoxel ID, fragment key): (verts, faces)}``.
+                    Supervoxel IDs are integers.
+
+    """
+    pieces = {}
+    for p in _iter_fragments(
+        frags,
+        mesh_name=mesh_name,
+        volume_id=volume_id,
+        client=client,
+        max_threads=max_threads,
+        cache=cache,
+        pool=pool,
+    ):
+        pieces.update(p)
+
+    return pieces
+
+
+def _iter_fragments(
+    frags, mesh_name, volume_id, client, max_threads=10, cache=None, pool=None
+):
+    """Fetch and decode given fragments and yield them batch by batch.
+
+    Same as ``_fetch_fragments`` but yields ``{(supervoxel ID, fragment key):
+    (verts, faces)}`` for each batch as soon as it has been decoded. Cached
+    fragments come first.
+
+    """
+    # Get what we can from the cache
+    if cache is not None:
+        found = set()
+        batches = cache.iter_decoded(volume_id, mesh_name, frags)
+        while True:
+            with metrics.timer("cache_read"):
+                pieces = next(batches, None)
+            if pieces is None:
+                break
+            found.update(pieces)
+            yield pieces
+        n_total = len(frags)
+        frags = [(sv, k) for sv, k in frags if (int(sv), k) not in found]
+
+        if metrics.registry.enabled:
+            metrics.registry.inc(
+                "cache_hits_total", n_total - len(frags), cache="fragments"
+            )
+            metrics.registry.inc("cache_misses_total", len(frags), cache="fragments")
+
     url = _make_url("v1", "objects", "meshes:batch")
 
-    # There is a hard cap of 100 fragments per query
-    verts = None
-    faces = None
+    batches, posts = _batch_posts(frags, mesh_name, volume_id)
+
+    def responses():
+        for i, resp in _imap_posts(client, url, posts, max_threads=max_threads):
+            resp.raise_for_status()
+            data = _as_buffer(resp.content)
+
+            if cache is not None:
+                with metrics.timer("cache_write"):
+                    cache.put(volume_id, mesh_name, data)
+
+            yield i, data
+
+    # Decode batches as they come in while the rest is still downloading
     with tqdm(
         desc="Fetching mesh batches",
         leave=False,
         total=len(frags),
         disable=not utils.use_pbars,
     ) as pbar:
-        for i in range(0, len(frags), 100):
-            chunk = frags[i : i + 100]
-
-            post = dict(
-                volumeId=volume_id,
-                meshName=mesh_name,
-                batches=[
-                    {"object_id": ob, "fragment_keys": [fr]} for (ob, fr) in chunk
-                ],
-            )
+        for i, decoded in imap_decode(responses(), pool=pool):
+            pbar.update(len(batches[i]))
+
+            yield _split_fragments(*decoded)
 
-            resp = session.post(url, json=post)
 
-            # Parse binary data
-            obj_id, frag_ids, v, f = parse_raw_ng(resp.content)
+def _store_fragments(store, frags, pieces):
+    """Write objects to store as soon as all their fragments have arrived.
 
-            # Combine chunks - make sure to offset faces
-            faces = f if faces is None else np.append(faces, f + verts.shape[0], axis=0)
-            verts = v if verts is None else np.append(verts, v, axis=0)
+    Parameters
+    ----------
+    store :     MeshStore
+    frags :     dict
+                ``{object ID: list of (supervoxel ID, fragment key)}``.
+    pieces :    iterable of dicts
+                Decoded fragments as yielded by ``_iter_fragments``.
+
+    """
+    # Objects each fragment belongs to
+    owners = collections.defaultdict(list)
+    missing = {}
+    for ob, fr in frags.items():
+        keys = {(int(sv), k) for sv, k in fr}
+        for k in keys:
+            owners[k].append(ob)
+        missing[ob] = len(keys)
+
+    found = collections.defaultdict(dict)
+
+    def write(ob):
+        with metrics.timer("store_write"):
+            with store.writer(ob) as w:
+                for sv, k in frags[ob]:
+                    piece = found[ob].get((int(sv), k))
+                    if piece is not None:
+                        w.add(*piece)
+        # Free memory
+        found.pop(ob, None)
+
+    for p in pieces:
+        for key, piece in p.items():
+            for ob in owners.get(key, ()):
+                found[ob][key] = piece
+                missing[ob] -= 1
+                if not missing[ob]:
+                    write(ob)
+
+    # Write objects with fragments that never arrived
+    for ob in list(found):
+        write(ob)
+
+
+def _batch_posts(frags, mesh_name, volume_id):
+    """Pack fragments into ``meshes:batch`` requests.
+
+    Returns
+    -------
+    batches :   list of lists
+                Fragments in each request.
+    posts :     list of dict
+                JSON payload for each request.
 
-            pbar.update(len(chunk))
+    """
+    # There is a hard cap of 100 fragments per query
+    batches = [frags[i : i + 100] for i in range(0, len(frags), 100)]
+    posts = [
+        dict(
+            volumeId=volume_id,
+            meshName=mesh_name,
+            batches=[{"object_id": ob, "fragment_keys": [fr]} for (ob, fr) in chunk],
+        )
+        for chunk in batches
+    ]
+
+    return batches, posts
+
+
+def _assemble_fragments(frags, pieces):
+    """Combine decoded fragments in the given order.
+
+    Parameters
+    ----------
+    frags :     list of (supervoxel ID, fragment key)
+    pieces :    dict
+                Decoded fragments as returned by ``_fetch_fragments``.
+                Fragments missing from ``pieces`` are skipped.
+
+    Returns
+    -------
+    verts, faces
+
+    """
+    keys = ((int(sv), k) for sv, k in frags)
+    found = [pieces[k] for k in keys if k in pieces]
 
-    return tm.Trimesh(verts, faces)
+    return _stack_meshes([v for v, _ in found], [f for _, f in found])
+
+
+def _fragment_index(frags, pieces):
+    """Return where each fragment ends up in the assembled mesh.
+
+    Returns
+    -------
+    dict
+                ``{(supervoxel ID, fragment key): (v_start, n_verts, f_start,
+                n_faces)}`` for fragments in ``pieces`` - see
+                ``brainmappy.Mesh``.
+
+    """
+    keys = [k for k in ((int(sv), k) for sv, k in frags) if k in pieces]
+    n_verts = np.array([len(pieces[k][0]) for k in keys], dtype=np.int64)
+    n_faces = np.array([len(pieces[k][1]) for k in keys], dtype=np.int64)
+    v_start = np.cumsum(n_verts) - n_verts
+    f_start = np.cumsum(n_faces) - n_faces
+
+    return dict(
+        zip(
+            keys,
+            zip(v_start.tolist(), n_verts.tolist(), f_start.tolist(), n_faces.tolist()),
+        )
+    )
+
+
+def _assemble_mesh(frags, pieces, return_type):
+    """Combine decoded fragments into a mesh of the given type."""
+    verts, faces = _assemble_fragments(frags, pieces)
+    fragments = _fragment_index(frags, pieces) if return_type == "mesh" else None
+    return _make_mesh(verts, faces, return_type, fragments=fragments)
 
 
 def get_seg_at_location(
@@ -428,8 +1118,11 @@ def get_seg_at_location(
     raw_px_dims=None,
     max_threads=10,
     session=None,
+    chunking="morton",
+    memo=None,
+    chunk_cache=None,
 ):
-    """Return meshes for given object ID.
+    """Return segmentation IDs at given locations.
 
     Parameters
     ----------
@@ -438,6 +1131,8 @@ def get_seg_at_location(
     volume_id :         str | None, optional
                         ID of segmentation volume to use. If not provided, will
                         use global.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
     raw_coords :        bool, optional
                         Whether ``coords`` is in raw coordinates. If True, will
                         not convert ``coords`` into voxel coordinates.
@@ -447,99 +1142,648 @@ def get_seg_at_location(
     max_threads :       int, optional
                         Max number of parallel requests. Reduce if you run into
                         any issues.
-    session :           AuthorizedSession
+    session :           AuthorizedSession | BrainmapsClient
                         Get from ``brainmappy.acquire_credentials``.
                         If None, will search in globals.
-
+    chunking :          "morton" | "grid" | "kmeans"
+                        How to group coordinates into (spatially compact)
+                        requests of up to 200 coordinates each. "morton" and
+                        "grid" are O(N log N) and fill every request; "kmeans"
+                        is considerably slower for large numbers of
+                        coordinates. See ``brainmappy.utils.chunk_coords``.
+    memo :              SegmentationMemo, optional
+                        If provided, will skip voxels already in the memo and
+                        add newly fetched voxels to it. See
+                        ``brainmappy.SegmentationMemo``.
+    chunk_cache :       SegmentationChunkCache, optional
+                        If provided, will answer lookups in frequently
+                        queried regions from locally cached blocks of
+                        segmentation. See ``brainmappy.SegmentationChunkCache``.
 
     Returns
     -------
-    List of segmentation IDs
-                        Segment ID 0 indicates unmapped location.
+    numpy array of uint64
+                        Segment IDs for each coordinate. Segment ID 0
+                        indicates unmapped location.
+
+    See Also
+    --------
+    iter_seg_at_location
+                        Streaming version with bounded memory footprint.
 
     """
+    coords = np.asarray(coords)
 
-    session = _eval_session(session)
-    future_session = FuturesSession(session=session, max_workers=max_threads)
+    seg_ids = np.zeros(len(coords), dtype=np.uint64)
+    with tqdm(
+        desc="Fetching segmentation IDs",
+        leave=False,
+        total=len(coords),
+        disable=not utils.use_pbars,
+    ) as pbar:
+        for ix, ids in iter_seg_at_location(
+            coords,
+            volume_id=volume_id,
+            change_stack_id=change_stack_id,
+            raw_coords=raw_coords,
+            raw_px_dims=raw_px_dims,
+            max_threads=max_threads,
+            block_size=None,
+            session=session,
+            chunking=chunking,
+            memo=memo,
+            chunk_cache=chunk_cache,
+        ):
+            seg_ids[ix] = ids
+            pbar.update(len(ix))
+
+    return seg_ids
+
+
+def iter_seg_at_location(
+    coords,
+    volume_id=None,
+    change_stack_id=None,
+    raw_coords=False,
+    raw_px_dims=None,
+    max_threads=10,
+    block_size=100_000,
+    session=None,
+    chunking="morton",
+    memo=None,
+    chunk_cache=None,
+):
+    """Yield segmentation IDs at given locations as they come in.
+
+    Other than ``get_seg_at_location`` this keeps only a fixed number of
+    requests in flight and yields results as soon as they arrive, so memory
+    use stays flat regardless of the number of coordinates.
+
+    Parameters
+    ----------
+    coords :            array-like | iterable of array-like
+                        Either a single (N, 3) array of X/Y/Z coordinates or
+                        an iterable (e.g. generator) of such arrays. A single
+                        array is processed in blocks of ``block_size``.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    raw_coords :        bool, optional
+                        Whether ``coords`` is in raw coordinates. If True, will
+                        not convert ``coords`` into voxel coordinates.
+    raw_px_dims :       tuple, optional
+                        Size of pixels. If not provided will attempt to get
+                        voxel dimensions from ``get_volume_info``.
+    max_threads :       int, optional
+                        Max number of parallel requests. This is also the max
+                        number of requests in flight at any time.
+    block_size :        int | None, optional
+                        Number of coordinates to deduplicate and chunk at a
+                        time if ``coords`` is a single array. None means all
+                        at once.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    chunking :          "morton" | "grid" | "kmeans"
+                        How to group coordinates into (spatially compact)
+                        requests. See ``brainmappy.utils.chunk_coords``.
+    memo :              SegmentationMemo, optional
+                        If provided, will skip voxels already in the memo and
+                        add newly fetched voxels to it.
+    chunk_cache :       SegmentationChunkCache, optional
+                        If provided, will answer lookups in frequently
+                        queried regions from locally cached blocks of
+                        segmentation.
+
+    Yields
+    ------
+    indices :           numpy array
+                        Indices of the coordinates (counted across all blocks).
+    seg_ids :           numpy array of uint64
+                        Segment IDs for these coordinates. Segment ID 0
+                        indicates unmapped location.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> with open("seg_ids.csv", "w") as f:
+    ...     for ix, ids in bm.iter_seg_at_location(coords):
+    ...         np.savetxt(f, np.c_[ix, ids], fmt="%d", delimiter=",")
+
+    """
+    client = _eval_client(session)
     volume_id = _eval_volumeId(volume_id)
     url = _make_url("v1", "volumes", volume_id, "values")
 
-    # Hard coded max chunk size
-    chunksize = 2e2
+    if memo is None:
+        memo = client.memo
+    if chunk_cache is None:
+        chunk_cache = client.chunk_cache
 
-    coords = np.array(coords) if not isinstance(coords, np.ndarray) else coords
+    def fetch_chunks(boxes):
+        return _fetch_chunks(client, volume_id, change_stack_id, boxes, max_threads)
 
     if not raw_coords:
         if isinstance(raw_px_dims, type(None)):
-            vinfo = get_volume_info(volume_id, session=session)
+            vinfo = get_volume_info(volume_id, session=client)
             raw_px_dims = [vinfo[0]["pixelSize"][d] for d in "xyz"]
-        elif not isinstance(raw_px_dims, np.ndarray):
-            raw_px_dims = np.array(raw_px_dims)
+        raw_px_dims = np.asarray(raw_px_dims)
+    else:
+        raw_px_dims = None
 
-        coords = coords / raw_px_dims
+    if isinstance(coords, (np.ndarray, list, tuple)):
+        coords = np.asarray(coords)
+        step = block_size or max(len(coords), 1)
+        blocks = (coords[i : i + step] for i in range(0, len(coords), step))
+    else:
+        blocks = coords
+
+    # Results that can be yielded without a request (i.e. from the memo)
+    ready = collections.deque()
+
+    def requests():
+        offset = 0
+        for block in blocks:
+            with metrics.timer("prepare"):
+                block = _SegBlock(
+                    block,
+                    offset=offset,
+                    raw_px_dims=raw_px_dims,
+                    chunking=chunking,
+                    memo=memo,
+                    volume_id=volume_id,
+                    change_stack_id=change_stack_id,
+                    chunk_cache=chunk_cache,
+                    fetch_chunks=fetch_chunks,
+                )
+            offset += block.size
+
+            if len(block.known):
+                ready.append(block.result(block.known))
+
+            for i in range(len(block.requests)):
+                yield (block, i), "POST", url, dict(
+                    data=block.post(i), headers={"Content-Type": "application/json"}
+                )
+
+    for (block, i), resp in imap_requests(
+        client.session,
+        requests(),
+        max_threads=max_threads,
+        scheduler=client.scheduler,
+    ):
+        while ready:
+            yield ready.popleft()
+
+        resp.raise_for_status()
+        with metrics.timer("json_decode"):
+            ids = _SegBlock.parse(resp.content)
+        yield block.update(i, ids)
+
+    while ready:
+        yield ready.popleft()
+
+
+def get_seg_in_bbox(
+    bbox,
+    volume_id=None,
+    scale=0,
+    change_stack_id=None,
+    raw_coords=False,
+    chunk_size=(256, 256, 32),
+    max_threads=10,
+    session=None,
+    out=None,
+):
+    """Download segmentation for a bounding box.
 
-    # Coords must not be float
-    # Do not remove  ".astype(float)": if coords are objects round() errors out
-    coords = np.round(coords.astype(float)).astype(int)
+    Much faster than ``get_seg_at_location`` if you need the segment IDs of
+    (almost) every voxel in a region. Large boxes are split into chunks that
+    are fetched in parallel.
 
-    # Cluster but catch UserWarning if we get less than n_chunks clusters
-    n_chunks = math.ceil(len(coords) / chunksize)
-    if n_chunks > 1:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            centroid, labels = kmeans2(coords.astype(float), k=n_chunks)
-    else:
-        labels = np.zeros(len(coords))
+    Parameters
+    ----------
+    bbox :              array-like
+                        ``[[x_min, y_min, z_min], [x_max, y_max, z_max]]``.
+                        Max is exclusive.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    scale :             int, optional
+                        Scale (i.e. index into ``get_volume_info``) to fetch.
+                        Default is 0 (highest resolution).
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    raw_coords :        bool, optional
+                        Whether ``bbox`` is in raw coordinates, i.e. voxels at
+                        the given scale. If False (default), will convert
+                        ``bbox`` into voxels using the pixel size from
+                        ``get_volume_info``.
+    chunk_size :        (int, int, int)
+                        Max size (in voxels) of the chunks fetched per request.
+    max_threads :       int, optional
+                        Max number of parallel requests. Reduce if you run into
+                        any issues.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    out :               numpy array | str, optional
+                        Array with the shape of the bounding box (in voxels) to
+                        write to. A string is interpreted as filepath to create
+                        a memory-mapped ``.npy`` file at, e.g. for boxes that
+                        don't fit into memory.
 
-    seg_ix = []
-    posts = []
-    for i in range(n_chunks):
-        # Get this chunk's coordinates
-        ix = np.where(labels == i)[0]
-        chunk = coords[ix]
+    Returns
+    -------
+    numpy array
+                        (X, Y, Z) array of uint64 segment IDs in Fortran
+                        order. Segment ID 0 indicates unmapped voxels. If
+                        ``out`` is provided, this is ``out``.
 
-        # Skip empty chunks
-        if chunk.shape[0] == 0:
-            continue
+    """
+    client = _eval_client(session)
+    volume_id = _eval_volumeId(volume_id)
+
+    bbox = np.asarray(bbox, dtype=float).reshape(2, 3)
+    if not raw_coords:
+        vinfo = get_volume_info(volume_id, session=client)
+        px_dims = np.array([vinfo[scale]["pixelSize"][d] for d in "xyz"], dtype=float)
+        bbox = bbox / px_dims
 
-        # The kmeans cluster will be spatially close but will vary in size
-        # They will become bigger than the 200 cap so we have to chop it up
-        for k in range(0, chunk.shape[0], int(chunksize)):
-            mini_chunk = chunk[k : k + int(chunksize)]
-            seg_ix.append(ix[k : k + int(chunksize)])
-            posts.append(dict(locations=[",".join(c) for c in mini_chunk.astype(str)]))
+    lo = np.floor(bbox[0]).astype(int)
+    hi = np.ceil(bbox[1]).astype(int)
+    shape = tuple(int(x) for x in hi - lo)
 
-    if change_stack_id:
-        for p in posts:
-            p['change_spec'] = {'change_stack_id': change_stack_id}
+    if any(x <= 0 for x in shape):
+        raise ValueError("Bounding box must have min < max, got {}".format(bbox))
 
-    futures = [future_session.post(url, json=p) for p in posts]
+    if out is None:
+        out = np.zeros(shape, dtype=np.uint64, order="F")
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(
+            out, mode="w+", dtype=np.uint64, shape=shape, fortran_order=True
+        )
+    elif out.shape != shape:
+        raise ValueError("`out` must have shape {}, got {}".format(shape, out.shape))
+
+    chunks = _tile_bbox(lo, hi, chunk_size)
 
-    # Get the responses
-    resp = []
     with tqdm(
-        desc="Fetching segmentation IDs",
+        desc="Fetching segmentation",
         leave=False,
-        total=len(coords),
+        total=len(chunks),
         disable=not utils.use_pbars,
     ) as pbar:
-        for f, s in zip(futures, seg_ix):
-            resp.append(f.result())
-            pbar.update(len(s))
+        for i, chunk in _imap_subvolumes(
+            client, volume_id, chunks, scale, change_stack_id, max_threads
+        ):
+            corner, size = chunks[i]
+            x0, y0, z0 = corner - lo
+            x1, y1, z1 = corner - lo + size
+            out[x0:x1, y0:y1, z0:z1] = chunk
+
+            pbar.update(1)
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    return out
+
+
+def _imap_subvolumes(
+    client, volume_id, chunks, scale=0, change_stack_id=None, max_threads=10
+):
+    """Fetch segmentation for ``chunks`` in parallel.
+
+    Parameters
+    ----------
+    chunks :    list of (corner, size)
+                In voxels at given scale.
+
+    Yields
+    ------
+    index :     int
+                Index into ``chunks``.
+    seg :       (X, Y, Z) numpy array of uint64
+
+    """
+    # Use snappy compression if available
+    try:
+        import snappy
+    except ImportError:
+        snappy = None
+
+    url = _make_url("v1", "volumes", volume_id, "subvolume:binary")
+
+    posts = []
+    for corner, size in chunks:
+        post = dict(
+            geometry=dict(
+                corner=",".join(str(c) for c in corner),
+                size=",".join(str(c) for c in size),
+                scale=scale,
+            ),
+            subvolume_format="RAW_SNAPPY" if snappy else "RAW",
+        )
+        if change_stack_id:
+            post["change_spec"] = {"change_stack_id": change_stack_id}
+        posts.append(post)
+
+    for i, resp in _imap_posts(client, url, posts, max_threads=max_threads):
+        resp.raise_for_status()
+
+        with metrics.timer("subvolume_decode"):
+            data = resp.content
+            if snappy:
+                data = snappy.decompress(data)
+
+            # Data comes in Z/Y/X (C) order
+            size = chunks[i][1]
+            seg = np.frombuffer(data, dtype="<u8").reshape(size[::-1]).T
+
+        yield i, seg
+
 
-    # Make sure all futures returned data
-    for r in resp:
-        r.raise_for_status()
+def _fetch_chunks(client, volume_id, change_stack_id, boxes, max_threads=10):
+    """Fetch segmentation for a ``SegmentationChunkCache``.
 
-    # Extract IDs
-    ids = [r.json()["uint64StrList"]["values"] for r in resp]
+    Boxes are clipped to the volume. Boxes entirely outside the volume
+    produce empty arrays.
 
-    # Populate segment IDs
-    seg_ids = np.zeros(len(coords))
-    for ix, i in zip(seg_ix, ids):
-        seg_ids[ix] = i
+    Returns
+    -------
+    list of (X, Y, Z) numpy arrays of uint64
+
+    """
+    vinfo = get_volume_info(volume_id, session=client)
+    shape = np.array([int(vinfo[0]["volumeSize"][d]) for d in "xyz"])
+
+    out = [np.zeros((0, 0, 0), dtype=np.uint64)] * len(boxes)
+    chunks, ix = [], []
+    for i, (corner, size) in enumerate(boxes):
+        size = np.minimum(corner + size, shape) - corner
+        if (corner >= 0).all() and (size > 0).all():
+            chunks.append((corner, size))
+            ix.append(i)
+
+    for i, seg in _imap_subvolumes(
+        client, volume_id, chunks, 0, change_stack_id, max_threads
+    ):
+        out[ix[i]] = seg
+
+    return out
+
+
+def _tile_bbox(lo, hi, chunk_size):
+    """Split bounding box into chunks.
+
+    Returns
+    -------
+    list of (corner, size)
+                Numpy arrays with the corner and size of each chunk.
+
+    """
+    chunk_size = np.asarray(chunk_size, dtype=int)
+    starts = [np.arange(a, b, c) for a, b, c in zip(lo, hi, chunk_size)]
+
+    chunks = []
+    for corner in itertools.product(*starts):
+        corner = np.array(corner)
+        size = np.minimum(corner + chunk_size, hi) - corner
+        chunks.append((corner, size))
+
+    return chunks
+
+
+class _SegBlock:
+    """Helper for a block of coordinates queried by ``iter_seg_at_location``.
+
+    Converts coordinates to voxels, deduplicates them, looks them up in the
+    memo and chunk cache and groups the rest into requests.
+
+    """
+
+    # Hard coded max chunk size
+    chunksize = 200
+
+    def __init__(
+        self,
+        coords,
+        offset,
+        raw_px_dims,
+        chunking,
+        memo,
+        volume_id,
+        change_stack_id,
+        chunk_cache=None,
+        fetch_chunks=None,
+    ):
+        coords = np.asarray(coords)
+        if raw_px_dims is not None:
+            coords = coords / raw_px_dims
+
+        self.size = len(coords)
+        self.offset = offset
+        self.memo = memo
+        self.volume_id = volume_id
+        self.change_stack_id = change_stack_id
+
+        # Coords must not be float
+        # Do not remove  ".astype(float)": if coords are objects round() errors out
+        coords = np.round(coords.astype(float)).astype(int).reshape(-1, 3)
+
+        # Query each voxel only once
+        self.voxels, self.inverse = np.unique(coords, axis=0, return_inverse=True)
+        self.inverse = self.inverse.reshape(-1)
+
+        # Skip voxels we already know
+        if memo is not None:
+            known, self.seg_ids = memo.lookup(volume_id, change_stack_id, self.voxels)
+            query = np.where(~known)[0]
+
+            if metrics.registry.enabled:
+                metrics.registry.inc("cache_hits_total", int(known.sum()), cache="memo")
+                metrics.registry.inc("cache_misses_total", len(query), cache="memo")
+        else:
+            self.seg_ids = np.zeros(len(self.voxels), dtype=np.uint64)
+            query = np.arange(len(self.voxels))
+
+        # Skip voxels in cached chunks (may fetch chunks that became hot)
+        if chunk_cache is not None and len(query):
+            found, ids = chunk_cache.lookup(
+                volume_id, change_stack_id, self.voxels[query], fetch=fetch_chunks
+            )
+            self.seg_ids[query[found]] = ids[found]
+
+            if metrics.registry.enabled:
+                n = int(found.sum())
+                metrics.registry.inc("cache_hits_total", n, cache="chunks")
+                metrics.registry.inc(
+                    "cache_misses_total", len(found) - n, cache="chunks"
+                )
+
+            query = query[~found]
+
+        # Group voxels into spatially compact chunks
+        self.requests = [
+            query[ix]
+            for ix in utils.chunk_coords(
+                self.voxels[query], self.chunksize, method=chunking
+            )
+        ]
 
-    return seg_ids.astype(int)
+        # Serialize all locations in one go - ``post`` only slices
+        if self.requests:
+            first = np.cumsum([0] + [len(ix) for ix in self.requests])
+            buf, offsets = utils.encode_locations(
+                self.voxels[np.concatenate(self.requests)]
+            )
+            self._locations = buf
+            self._bounds = offsets[first]
+        else:
+            self._locations, self._bounds = b"", np.zeros(1, dtype=np.int64)
+
+        # Assign coordinates to requests (-1 = known voxel)
+        req = np.full(len(self.voxels), -1)
+        for i, ix in enumerate(self.requests):
+            req[ix] = i
+        req = req[self.inverse]
+        order = np.argsort(req, kind="stable")
+        counts = np.bincount(req + 1, minlength=len(self.requests) + 1)
+        groups = np.split(order, np.cumsum(counts)[:-1])
+
+        self.known = groups[0]
+        self.coords = groups[1:]
+
+    def post(self, i):
+        """Generate JSON payload (bytes) for ``i``-th request."""
+        start, end = self._bounds[i], self._bounds[i + 1]
+        # Drop the trailing comma
+        post = b'{"locations":[' + self._locations[start : end - 1] + b"]"
+        if self.change_stack_id:
+            post += (
+                b',"change_spec":'
+                + json.dumps({"change_stack_id": self.change_stack_id}).encode()
+            )
+        return post + b"}"
+
+    @staticmethod
+    def parse(content):
+        """Parse segment IDs from response content."""
+        ids = utils.decode_uint64_list(content)
+        if ids is None:
+            values = json.loads(content)["uint64StrList"]["values"]
+            ids = np.array(values, dtype=np.uint64)
+        return ids
+
+    def update(self, i, ids):
+        """Add segment IDs for ``i``-th request and return its result."""
+        ix = self.requests[i]
+        self.seg_ids[ix] = ids
+
+        if self.memo is not None:
+            self.memo.update(
+                self.volume_id, self.change_stack_id, self.voxels[ix], self.seg_ids[ix]
+            )
+
+        return self.result(self.coords[i])
+
+    def result(self, ix):
+        """Return ``(indices, seg_ids)`` for given coordinates of this block."""
+        return ix + self.offset, self.seg_ids[self.inverse[ix]]
+
+
+def _get_metadata(client, endpoint, url, **args):
+    """GET ``url`` and parse JSON - use client's metadata cache if it has one.
+
+    ``args`` are passed to ``MetadataCache.put`` for selective invalidation.
+    """
+    cache = client.metadata_cache
+    if cache is not None:
+        data = cache.get(endpoint, url)
+
+        if metrics.registry.enabled:
+            hit = "cache_hits_total" if data is not None else "cache_misses_total"
+            metrics.registry.inc(hit, cache="metadata")
+
+        if data is not None:
+            return data
+
+    resp = _get(client, url, endpoint=endpoint)
+    resp.raise_for_status()
+    data = resp.json()
+
+    if cache is not None:
+        cache.put(endpoint, url, data, **args)
+
+    return data
+
+
+def _eval_lod(lod, volume_id, client):
+    """Turn level of detail into the name of the corresponding meshes."""
+    mesh_info = get_mesh_list(volume_id, session=client)
+
+    if isinstance(lod, int):
+        return mesh_info[lod]["name"]
+    elif isinstance(lod, str):
+        assert lod in [m["name"] for m in mesh_info]
+        return lod
+    else:
+        raise ValueError("lod must be int or str")
+
+
+def _fragments_url(object_id, mesh_name, volume_id, change_stack_id=None):
+    """Make URL to list fragments of given object."""
+    url = _make_url(
+        "v1",
+        "objects",
+        volume_id,
+        "meshes",
+        mesh_name + ":listfragments",
+        objectId=object_id,
+        returnSupervoxelIds=True,
+    )
+
+    if change_stack_id:
+        url += "&" + urllib.parse.urlencode({"header.changeStackId": change_stack_id})
+
+    return url
+
+
+def _imap_posts(client, url, posts, max_threads=10):
+    """POST JSON payloads ``posts`` to ``url`` in parallel.
+
+    Yields ``(index, response)``. See ``scheduler.imap_requests``.
+    """
+    return imap_requests(
+        client.session,
+        ((i, "POST", url, dict(json=p)) for i, p in enumerate(posts)),
+        max_threads=max_threads,
+        scheduler=client.scheduler,
+    )
+
+
+def _imap_gets(client, urls, max_threads=10):
+    """GET ``urls`` in parallel.
+
+    Yields ``(index, response)``. See ``scheduler.imap_requests``.
+    """
+    return imap_requests(
+        client.session,
+        ((i, "GET", url, {}) for i, url in enumerate(urls)),
+        max_threads=max_threads,
+        scheduler=client.scheduler,
+    )
+
+
+def _get(client, url, endpoint=None):
+    """GET ``url`` via the client's scheduler (i.e. with retries and backoff)."""
+    ((_, resp),) = client.scheduler.imap(
+        client.session, [(0, "GET", url, dict(endpoint=endpoint))], max_concurrency=1
+    )
+    return resp
 
 
 def _make_url(*args, **GET):
@@ -563,10 +1807,11 @@ def _make_url(*args, **GET):
     Returns
     -------
     url :       str
+                Relative to ``brainmappy.utils.brainmaps_url``.
 
     """
     # Generate the URL
-    url = "https://brainmaps.googleapis.com/"
+    url = utils.brainmaps_url
 
     for arg in args:
         arg_str = str(arg)
@@ -15,6 +15,7 @@
 """This module contains functions to convert data."""
 
 import argparse
+import collections
 import io
 import json
 import os
@@ -24,15 +25,20 @@ import shlex
 import struct
 
 from collections import OrderedDict
-from requests_futures.sessions import FuturesSession
 from six.moves import http_cookies as Cookie
-from tqdm import tqdm
 
 import numpy as np
-import pandas as pd
+
+from . import utils
+from .scheduler import imap_requests
+from .utils import tqdm
 
 __all__ = ["get_ng_meshes", "parse_curls", "parse_raw_ng", "uncurl"]
 
+# Fragment header of neuroglancer's binary mesh format (see ``parse_raw_ng``)
+_NG_HEADER = struct.Struct("<QI4x")
+_NG_COUNTS = struct.Struct("<2q")
+
 parser = argparse.ArgumentParser()
 parser.add_argument("command")
 parser.add_argument("url")
@@ -44,73 +50,122 @@ parser.add_argument("--compressed", action="store_true")
 parser.add_argument("--insecure", action="store_true")
 
 
-def get_ng_meshes(x=None):
+def get_ng_meshes(x=None, max_threads=10, processes=None):
     """Load neuroglancer meshes from cURLs.
 
+    Responses are decoded as soon as they arrive (while the remaining
+    requests are still in flight) and their raw data is discarded right away.
+    Each object is combined as soon as all of its responses are in.
+
     Parameters
     ----------
-    x :         filepath | file-like | None
-                File with cURLs to read. If ``None``, will read from clipboard.
+    x :             filepath | file-like | None
+                    File with cURLs to read. If ``None``, will read from clipboard.
+    max_threads :   int
+                    Max number of parallel requests.
+    processes :     int | DecodePool, optional
+                    If provided, will decode large responses in this many
+                    worker processes (or in the given pool). See
+                    ``brainmappy.DecodePool``.
 
     Returns
     -------
     dict
                 ``{object_id : {'verts': [[x1, y1, z1], [...]],
-                                'faces': [[v1, v2, v3], [...]]}}``
+                                'faces': [[v1, v2, v3], [...]],
+                                'fragments': [[fn1, fn2, ...], [...]]}}``
+
+                Objects and fragments are in the order of the cURLs.
 
     """
     if isinstance(x, type(None)):
+        import pandas as pd
+
         # Read without any delimiting
         x = pd.read_clipboard(delimiter="\t", header=None)[0].values
 
+    # Import here to avoid circular imports
+    from .client import _anonymous_client
+    from .decode import _eval_decode_pool, imap_decode
+
+    client = _anonymous_client()
+
     # Parse the curls
-    re = parse_curls(x)
+    req = parse_curls(x)
 
     # Discard Requests that don't point to meshes
-    req = [r for r in re if r.method == "POST"]
-    req = [r for r in re if "batches" in r.data]
+    req = [r for r in req if r.method == "POST"]
+    req = [r for r in req if r.data and "batches" in r.data]
 
     if len(req) == 0:
         raise ValueError("No valid mesh cURLs found.")
 
-    # Now retrieve data
-    future_session = FuturesSession(max_workers=10)
+    # Number of requests per object - to tell when an object is complete
+    objects = [_ng_object_id(r) for r in req]
+    remaining = collections.Counter(objects)
 
-    # For some reason .send() does not work concurrently, only .get()
-    # and .post() do
-    futures = [future_session.post(r.url, data=r.data, headers=r.headers) for r in req]
-    responses = [f.result() for f in tqdm(futures, desc="Fetching meshes", leave=False)]
+    posts = (
+        (i, "POST", r.url, dict(json=r.data, headers=r.headers))
+        for i, r in enumerate(req)
+    )
 
-    # Raise errors, if any
-    for r in responses:
-        r.raise_for_status()
+    def responses():
+        for i, resp in imap_requests(
+            client.session, posts, max_threads=max_threads, scheduler=client.scheduler
+        ):
+            resp.raise_for_status()
+            # Decoding copies the data, so the response is dropped right away
+            yield i, resp.content
+
+    pool = _eval_decode_pool(processes)
+
+    # Decoded responses of incomplete objects, keyed by request index
+    pieces = {ob: {} for ob in objects}
+    data = {ob: None for ob in objects}
+    with tqdm(
+        desc="Fetching meshes",
+        total=len(remaining),
+        unit="objects",
+        leave=False,
+        disable=not utils.use_pbars,
+    ) as pbar:
+        for i, (frags, verts, faces) in imap_decode(responses(), pool=pool):
+            ob = objects[i]
+            pieces[ob][i] = (frags["filename"], verts, faces)
+
+            remaining[ob] -= 1
+            if not remaining[ob]:
+                data[ob] = _combine_responses(pieces.pop(ob))
+                pbar.update(1)
+
+    return data
 
-    # Parse data
-    data = {}
-    for r in tqdm(responses, desc="Extracting data", leave=False):
-        object_id, filename, verts, faces = parse_raw_ng(r.content)
 
-        if object_id not in data:
-            data[object_id] = dict(fragments=[], verts=[], faces=[])
+def _combine_responses(decoded):
+    """Combine decoded responses for one object in order of requests.
 
-        data[object_id]["fragments"].append(filename)
-        data[object_id]["verts"].append(verts)
-        data[object_id]["faces"].append(faces)
+    Parameters
+    ----------
+    decoded :   dict
+                ``{request index: (filenames, verts, faces)}``.
 
-    # If we have multiple fragments per object, we need to add an offset
-    # to the faces before merging
-    for ob in data:
-        for i, faces in enumerate(data[ob]["faces"][1:]):
-            # Get number of previous verts
-            n_prev = sum([v.shape[0] for v in data[ob]["verts"][: i + 1]])
-            faces += n_prev
+    """
+    # Responses arrive in random order
+    decoded = [decoded[i] for i in sorted(decoded)]
+    n_verts = np.cumsum([0] + [len(v) for _, v, _ in decoded[:-1]])
+
+    return dict(
+        fragments=[f for f, _, _ in decoded],
+        verts=np.vstack([v for _, v, _ in decoded]),
+        # Offset faces by the vertices of this object's previous responses
+        faces=np.vstack([f + np.uint32(n) for (_, _, f), n in zip(decoded, n_verts)]),
+    )
 
-    # Stack vertices and faces
-    for ob in data:
-        data[ob]["verts"] = np.vstack(data[ob]["verts"])
-        data[ob]["faces"] = np.vstack(data[ob]["faces"])
 
-    return data
+def _ng_object_id(req):
+    """Return ID of object a neuroglancer mesh request is for (as str)."""
+    batches = req.data["batches"]
+    return str(batches[-1]["object_id"]) if batches else None
 
 
 def parse_curls(x):
@@ -170,6 +225,7 @@ def uncurl(curl):
         method = "GET"
 
     post_data = parsed_args.data or parsed_args.data_binary
+    post_data_json = None
 
     if post_data:
         # Make sure method is POST if there is postdata
@@ -177,7 +233,7 @@ def uncurl(curl):
         try:
             post_data_json = json.loads(post_data)
         except ValueError:
-            post_data_json = None
+            pass
 
     cookie_dict = OrderedDict()
     quoted_headers = OrderedDict()
@@ -213,15 +269,18 @@ def parse_raw_ng(x):
 
     Parameters
     ----------
-    x :         bytes
-                Binary data to parse.
+    x :         bytes | bytearray | memoryview | file-like
+                Binary data to parse. File-like objects are read in full.
 
     Returns
     -------
     object ID :     str
+                    ID of the last fragment's object.
     fragment IDs :  list of str
-    vertices :      numpy array
-    faces :         numpy array
+                    Decoded from the raw (bytes) filenames.
+    vertices :      (N, 3) numpy array of float32
+    faces :         (M, 3) numpy array of uint32
+                    Already offset to index into ``vertices``.
 
     Note
     ----
@@ -237,32 +296,213 @@ def parse_raw_ng(x):
     - face indices - int ({n_faces} * 3 * 4 bytes)
 
     """
-    if not isinstance(x, (bytes, io.BufferedIOBase)):
-        raise TypeError("Unable to parse data of type {}".format(type(x)))
+    frags, verts, faces = _decode_raw_ng(x)
+
+    object_id = str(frags["object_id"][-1]) if len(frags["object_id"]) else None
+
+    return object_id, frags["filename"], verts, faces
+
 
-    # Turn bytes into a file-like object if necessary
-    f = io.BytesIO(x) if isinstance(x, bytes) else x
+def _stack_meshes(verts, faces):
+    """Stack lists of vertex and face arrays into a single mesh.
 
-    size = os.path.getsize(f.name) if isinstance(x, io.BufferedIOBase) else len(x)
+    Faces are offset by the number of vertices in all preceding arrays.
+
+    Parameters
+    ----------
+    verts :     list of (N, 3) arrays
+    faces :     list of (M, 3) arrays
+                Face indices into the respective vertex array.
+
+    Returns
+    -------
+    verts :     (N, 3) numpy array
+    faces :     (M, 3) numpy array
+
+    """
+    n_verts = np.array([len(v) for v in verts], dtype=np.int64)
+    n_faces = np.array([len(f) for f in faces], dtype=np.int64)
+    offsets = np.cumsum(n_verts) - n_verts
+
+    verts = np.concatenate(verts) if len(verts) else np.zeros((0, 3), dtype=np.float32)
+    faces = np.concatenate(faces) if len(faces) else np.zeros((0, 3), dtype=np.uint32)
+
+    faces = faces + np.repeat(offsets, n_faces).astype(faces.dtype)[:, None]
+
+    return verts, faces
+
+
+def _split_fragments(frags, verts, faces):
+    """Split decoded arrays into individual fragments.
+
+    Parameters
+    ----------
+    frags :         dict
+                    Fragment headers as returned by ``_scan_raw_ng``.
+    verts, faces :  numpy arrays
+                    Combined vertices and faces as returned by
+                    ``_decode_raw_ng``.
+
+    Returns
+    -------
+    dict
+                    ``{(object ID, filename): (verts, faces)}``. Vertices are
+                    views into ``verts``, faces index into the fragment's
+                    vertices.
 
-    verts = []
-    faces = []
-    filenames = []
-    while f.tell() < size:
-        object_id, filenamelen = struct.unpack("qi4x", f.read(16))
-        fn, n_verts, n_faces = struct.unpack(
-            "{}s2q".format(filenamelen), f.read(filenamelen + 8 + 8)
+    """
+    v_ends = np.cumsum(frags["n_verts"])
+    f_ends = np.cumsum(frags["n_faces"])
+    v_starts = v_ends - frags["n_verts"]
+    f_starts = f_ends - frags["n_faces"]
+
+    return {
+        (int(ob), fn): (verts[v0:v1], faces[f0:f1] - np.uint32(v0))
+        for ob, fn, v0, v1, f0, f1 in zip(
+            frags["object_id"], frags["filename"], v_starts, v_ends, f_starts, f_ends
         )
+    }
+
+
+def _as_buffer(x):
+    """Turn bytes-like or file-like ``x`` into a flat memoryview."""
+    if hasattr(x, "read"):
+        x = x.read()
+
+    if not isinstance(x, (bytes, bytearray, memoryview)):
+        raise TypeError("Unable to parse data of type {}".format(type(x)))
+
+    return memoryview(x).cast("B")
+
+
+def _scan_raw_ng(buf):
+    """Scan fragment headers in neuroglancer's binary mesh format.
+
+    Only the headers are touched - the vertex and face payloads are skipped
+    over.
+
+    Parameters
+    ----------
+    buf :       memoryview
+                Flat (i.e. byte format) buffer. See ``_as_buffer``.
 
-        this_verts = struct.unpack("{}f".format(n_verts * 3), f.read(n_verts * 3 * 4))
-        this_verts = np.array(this_verts).reshape((n_verts, 3))
+    Returns
+    -------
+    dict
+                ``object_id``, ``n_verts``, ``n_faces``, ``verts_start``,
+                ``faces_start``, ``start`` and ``end`` are numpy arrays with
+                one entry per fragment (offsets are in bytes), ``filename``
+                is a list of str.
 
-        this_faces = struct.unpack("{}i".format(n_faces * 3), f.read(n_faces * 3 * 4))
-        this_faces = np.array(this_faces).reshape((n_faces, 3))
+    """
+    size = len(buf)
 
-        # Make sure to add an offset to the faces
-        faces.append(this_faces + sum([v.shape[0] for v in verts]))
-        verts.append(this_verts)
+    object_ids, filenames, n_verts, n_faces, starts = [], [], [], [], []
+    pos = 0
+    while pos < size:
+        starts.append(pos)
+        try:
+            object_id, fn_len = _NG_HEADER.unpack_from(buf, pos)
+            pos += _NG_HEADER.size
+            fn = bytes(buf[pos : pos + fn_len]).decode()
+            pos += fn_len
+            nv, nf = _NG_COUNTS.unpack_from(buf, pos)
+        except struct.error:
+            # Cut off in the middle of a header
+            raise ValueError(
+                "Truncated mesh data: incomplete fragment header at byte {}".format(
+                    starts[-1]
+                )
+            ) from None
+        pos += _NG_COUNTS.size + (nv + nf) * 12
+
+        object_ids.append(object_id)
         filenames.append(fn)
+        n_verts.append(nv)
+        n_faces.append(nf)
+
+    if pos != size:
+        raise ValueError(
+            "Truncated mesh data: expected {} bytes, got {}".format(pos, size)
+        )
+
+    n_verts = np.array(n_verts, dtype=np.int64)
+    n_faces = np.array(n_faces, dtype=np.int64)
+    starts = np.array(starts, dtype=np.int64)
+    fn_lens = np.array([len(fn.encode()) for fn in filenames], dtype=np.int64)
+
+    verts_start = starts + _NG_HEADER.size + fn_lens + _NG_COUNTS.size
+    faces_start = verts_start + n_verts * 12
+
+    return dict(
+        object_id=np.array(object_ids, dtype=np.uint64),
+        filename=filenames,
+        n_verts=n_verts,
+        n_faces=n_faces,
+        verts_start=verts_start,
+        faces_start=faces_start,
+        start=starts,
+        end=faces_start + n_faces * 12,
+    )
+
+
+def _decode_raw_ng(x):
+    """Decode neuroglancer's binary mesh format into combined arrays.
+
+    Parameters
+    ----------
+    x :         bytes | bytearray | memoryview | file-like
+                Binary data to parse.
+
+    Returns
+    -------
+    frags :     dict
+                Fragment headers as returned by ``_scan_raw_ng``.
+    verts :     (N, 3) numpy array of float32
+    faces :     (M, 3) numpy array of uint32
+                Offset to index into the combined ``verts``.
 
-    return str(object_id), filenames, np.vstack(verts).astype(int), np.vstack(faces)
+    """
+    buf = _as_buffer(x)
+    frags = _scan_raw_ng(buf)
+
+    verts = np.empty((frags["n_verts"].sum(), 3), dtype=np.float32)
+    faces = np.empty((frags["n_faces"].sum(), 3), dtype=np.uint32)
+    _decode_into(buf, frags, verts, faces)
+
+    return frags, verts, faces
+
+
+def _decode_into(buf, frags, verts, faces):
+    """Copy vertices and faces of all fragments into given arrays.
+
+    Parameters
+    ----------
+    buf :           memoryview
+                    Flat buffer with neuroglancer binary mesh data.
+    frags :         dict
+                    Fragment headers as returned by ``_scan_raw_ng``.
+    verts, faces :  (N, 3) and (M, 3) arrays of float32 and uint32
+                    Arrays to write to - must have the combined size of all
+                    fragments. Faces are offset to index into ``verts``.
+
+    """
+    # Views into the buffer - the only copy is the concatenation
+    v = [
+        np.frombuffer(buf, dtype="<f4", count=n * 3, offset=o)
+        for o, n in zip(frags["verts_start"], frags["n_verts"])
+    ]
+    f = [
+        np.frombuffer(buf, dtype="<u4", count=n * 3, offset=o)
+        for o, n in zip(frags["faces_start"], frags["n_faces"])
+    ]
+
+    faces = faces.reshape(-1)
+    if v:
+        np.concatenate(v, out=verts.reshape(-1))
+    if f:
+        np.concatenate(f, out=faces)
+
+    # Faces of each fragment are offset by the vertices of all previous ones
+    offsets = np.cumsum(frags["n_verts"]) - frags["n_verts"]
+    faces += np.repeat(offsets.astype(np.uint32), frags["n_faces"] * 3)
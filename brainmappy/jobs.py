@@ -0,0 +1,381 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains resumable bulk export jobs.
+
+Jobs write their results incrementally and record completed items in a
+checkpoint log. If a job is interrupted (e.g. because the node was
+preempted), running it again with the same output skips everything that was
+already done.
+"""
+
+import os
+
+import numpy as np
+
+from . import utils
+from .client import _eval_client
+from .fetch import get_meshes_bulk, iter_seg_at_location
+from .store import MeshStore
+from .utils import tqdm
+
+__all__ = ["Checkpoint", "export_meshes", "export_seg"]
+
+
+class Checkpoint:
+    """Append-only log of completed items.
+
+    Each completed item is written as a single line and synced to disk
+    before ``mark`` returns. A partially written last line (e.g. after a
+    crash) is discarded on open.
+
+    Parameters
+    ----------
+    path :      str
+                Path to the log file. Will be created if it does not exist.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> cp = bm.Checkpoint("job.log")
+    >>> for x in cp.todo(items):
+    ...     process(x)
+    ...     cp.mark([x])
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+        if os.path.isfile(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                # Drop partially written last line
+                complete = data[: data.rfind(b"\n") + 1]
+                if len(complete) < len(data):
+                    f.truncate(len(complete))
+            self.done.update(complete.decode().splitlines())
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __repr__(self):
+        return "<{} path={!r} done={}>".format(
+            type(self).__name__, self.path, len(self)
+        )
+
+    def __len__(self):
+        return len(self.done)
+
+    def __contains__(self, item):
+        return str(item) in self.done
+
+    def todo(self, items):
+        """Return items that have not been completed yet (in order)."""
+        return [x for x in items if str(x) not in self.done]
+
+    def mark(self, items):
+        """Record items as completed."""
+        items = [str(x) for x in items]
+        if not items:
+            return
+
+        with open(self.path, "a") as f:
+            f.write("".join(x + "\n" for x in items))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.done.update(items)
+
+
+def export_meshes(
+    object_ids,
+    out,
+    checkpoint=None,
+    batch_size=100,
+    lod=0,
+    volume_id=None,
+    change_stack_id=None,
+    max_threads=10,
+    cache=None,
+    processes=None,
+    session=None,
+):
+    """Export meshes for many objects into a ``MeshStore`` - resumable.
+
+    Objects are fetched in batches via ``get_meshes_bulk``. Each mesh is
+    written to the store as soon as it is complete and each batch is
+    recorded in the checkpoint log once all of its meshes have been written.
+    Re-running with the same ``out`` continues where the last run stopped.
+
+    Parameters
+    ----------
+    object_ids :        iterable of int
+                        IDs of objects to export.
+    out :               str | MeshStore
+                        Directory of the mesh store (will be created if it
+                        does not exist) or an open store.
+    checkpoint :        str | Checkpoint, optional
+                        Checkpoint log. Defaults to ``checkpoint.log`` in the
+                        store's directory.
+    batch_size :        int
+                        Number of objects per batch. Larger batches make
+                        better use of ``max_threads`` but more work is lost
+                        if the job is interrupted.
+    lod :               int | str, optional
+                        Level of detail - see ``brainmappy.get_meshes_batch``.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    max_threads :       int, optional
+                        Max number of parallel requests.
+    cache :             FragmentCache | str, optional
+                        See ``brainmappy.get_meshes_bulk``.
+    processes :         int | DecodePool, optional
+                        See ``brainmappy.get_meshes_bulk``.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+
+    Returns
+    -------
+    MeshStore
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> store = bm.export_meshes(ids, "meshes/")
+    >>> verts, faces = store[ids[0]]
+
+    """
+    client = _eval_client(session)
+    store = out if isinstance(out, MeshStore) else MeshStore(out)
+    checkpoint = _eval_checkpoint(
+        checkpoint, os.path.join(store.path, "checkpoint.log")
+    )
+
+    todo = checkpoint.todo(int(x) for x in object_ids)
+
+    with tqdm(
+        desc="Exporting meshes",
+        total=len(todo),
+        disable=not utils.use_pbars,
+    ) as pbar:
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i : i + batch_size]
+            get_meshes_bulk(
+                batch,
+                lod=lod,
+                volume_id=volume_id,
+                change_stack_id=change_stack_id,
+                max_threads=max_threads,
+                cache=cache,
+                store=store,
+                processes=processes,
+                session=client,
+            )
+            store.flush()
+            checkpoint.mark(batch)
+            pbar.update(len(batch))
+
+    return store
+
+
+def export_seg(
+    files,
+    out,
+    checkpoint=None,
+    volume_id=None,
+    change_stack_id=None,
+    raw_coords=False,
+    max_threads=10,
+    root=None,
+    session=None,
+    **kwargs
+):
+    """Look up segment IDs for coordinate files - resumable.
+
+    For each input file, writes a ``{name}.seg.npy`` file with one uint64
+    segment ID per coordinate to ``out``. Without ``root``, ``name`` is the
+    file's name (without extension), so files must have unique names. With
+    ``root``, ``name`` is the path relative to ``root``, i.e. ``out`` mirrors
+    the directory structure of the input files. Results are streamed into a
+    memory-mapped file which is only moved into place once complete, so there
+    are never partial outputs. Completed files are recorded in the checkpoint
+    log and skipped when the job is run again.
+
+    Parameters
+    ----------
+    files :             iterable of str
+                        Paths to coordinate files: either ``.npy`` files with
+                        (N, 3) arrays or text files (e.g. CSV) with one X/Y/Z
+                        coordinate per line.
+    out :               str
+                        Output directory. Will be created if it does not exist.
+    checkpoint :        str | Checkpoint, optional
+                        Checkpoint log. Defaults to ``checkpoint.log`` in
+                        ``out``.
+    volume_id :         str | None, optional
+                        ID of segmentation volume to use. If not provided, will
+                        use global.
+    change_stack_id :   str, optional
+                        If provided, will use alternative agglomeration stack.
+    raw_coords :        bool, optional
+                        Whether coordinates are in voxels - see
+                        ``brainmappy.get_seg_at_location``.
+    max_threads :       int, optional
+                        Max number of parallel requests.
+    root :              str, optional
+                        Directory that input files are in (e.g. that of the
+                        manifest). Output names are made from paths relative
+                        to it. Files outside of ``root`` use their name.
+    session :           AuthorizedSession | BrainmapsClient
+                        Get from ``brainmappy.acquire_credentials``.
+                        If None, will search in globals.
+    **kwargs
+                        Passed to ``brainmappy.iter_seg_at_location``, e.g.
+                        ``memo`` or ``chunk_cache``.
+
+    Returns
+    -------
+    list of str
+                        Paths to the output files (including those from
+                        previous runs).
+
+    """
+    files = list(files)
+    outputs = [_seg_output(out, fp, root) for fp in files]
+
+    # Check up front - otherwise files would silently overwrite each other
+    seen = {}
+    for fp, target in zip(files, outputs):
+        if target in seen and seen[target] != fp:
+            raise ValueError(
+                "{} and {} would both be written to {}".format(seen[target], fp, target)
+            )
+        seen[target] = fp
+
+    client = _eval_client(session)
+    os.makedirs(out, exist_ok=True)
+    checkpoint = _eval_checkpoint(checkpoint, os.path.join(out, "checkpoint.log"))
+
+    for fp in tqdm(
+        checkpoint.todo(files),
+        desc="Exporting segmentation",
+        disable=not utils.use_pbars,
+    ):
+        coords = _load_coords(fp)
+        target = _seg_output(out, fp, root)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        tmp = target + ".tmp"
+        ids = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=np.uint64, shape=(len(coords),)
+        )
+        try:
+            for ix, seg_ids in iter_seg_at_location(
+                coords,
+                volume_id=volume_id,
+                change_stack_id=change_stack_id,
+                raw_coords=raw_coords,
+                max_threads=max_threads,
+                session=client,
+                **kwargs
+            ):
+                ids[ix] = seg_ids
+            ids.flush()
+        except BaseException:
+            del ids
+            os.remove(tmp)
+            raise
+
+        del ids
+        os.replace(tmp, target)
+
+        checkpoint.mark([fp])
+
+    return outputs
+
+
+def read_manifest(path):
+    """Read items from a manifest file.
+
+    Items are separated by newlines (or commas/whitespace). Empty lines and
+    lines starting with ``#`` are ignored. Use "-" to read from stdin.
+
+    Returns
+    -------
+    list of str
+
+    """
+    if path == "-":
+        import sys
+
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        items += [x for x in line.replace(",", " ").split() if x]
+
+    return items
+
+
+def _eval_checkpoint(checkpoint, default):
+    """Evaluate ``checkpoint`` parameter."""
+    if isinstance(checkpoint, Checkpoint):
+        return checkpoint
+    return Checkpoint(checkpoint or default)
+
+
+def _seg_output(out, fp, root=None):
+    """Return output path for given coordinate file."""
+    name = os.path.basename(fp)
+    if root is not None:
+        rel = os.path.relpath(os.path.abspath(fp), os.path.abspath(root))
+        # Files outside of root just use their name
+        if rel.split(os.sep)[0] != os.pardir:
+            name = rel
+    return os.path.join(out, os.path.splitext(name)[0] + ".seg.npy")
+
+
+def _load_coords(fp):
+    """Load (N, 3) coordinates from .npy or text file."""
+    if fp.endswith(".npy"):
+        coords = np.load(fp, mmap_mode="r")
+    else:
+        with open(fp, "r") as f:
+            sample = f.readline()
+        delimiter = "," if "," in sample else None
+        # Skip header if first line isn't numeric
+        try:
+            [float(x) for x in sample.replace(",", " ").split()]
+            skip = 0
+        except ValueError:
+            skip = 1
+        coords = np.loadtxt(fp, delimiter=delimiter, skiprows=skip, ndmin=2)
+
+    coords = np.asarray(coords)
+    if coords.ndim != 2 or coords.shape[1] != 3:
+        raise ValueError(
+            "Expected (N, 3) coordinates in {}, got shape {}".format(fp, coords.shape)
+        )
+    return coords
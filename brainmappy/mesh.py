@@ -0,0 +1,200 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains a lightweight mesh container and mesh utilities."""
+
+import numpy as np
+
+__all__ = ["Mesh", "weld_vertices"]
+
+# Valid values for the ``return_type`` of mesh functions
+RETURN_TYPES = ("trimesh", "mesh", "arrays")
+
+# Large primes for hashing integer coordinates
+_HASH_PRIMES = np.array([73856093, 19349663, 83492791], dtype=np.int64)
+
+
+class Mesh:
+    """Minimal triangle mesh.
+
+    Other than ``trimesh.Trimesh`` this does not process (e.g. merge
+    vertices of) the mesh on construction and has no dependencies beyond
+    numpy. Unpacks into vertices and faces::
+
+        >>> verts, faces = mesh
+
+    Parameters
+    ----------
+    vertices :  (N, 3) array
+    faces :     (M, 3) array
+                Indices into ``vertices``.
+    fragments : dict, optional
+                ``{(supervoxel ID, fragment key): (v_start, n_verts, f_start,
+                n_faces)}`` - where in ``vertices`` and ``faces`` each
+                fragment is. Meshes fetched with ``return_type="mesh"`` have
+                this which allows updating them via
+                ``brainmappy.refresh_meshes``.
+
+    """
+
+    __slots__ = ("vertices", "faces", "fragments")
+
+    def __init__(self, vertices, faces, fragments=None):
+        self.vertices = np.asarray(vertices)
+        self.faces = np.asarray(faces)
+        self.fragments = fragments
+
+    def __repr__(self):
+        return "<{} vertices={} faces={}>".format(
+            type(self).__name__, len(self.vertices), len(self.faces)
+        )
+
+    def __iter__(self):
+        return iter((self.vertices, self.faces))
+
+    @property
+    def bounds(self):
+        """Min and max corner of the bounding box as (2, 3) array."""
+        if not len(self.vertices):
+            return None
+        return np.vstack((self.vertices.min(axis=0), self.vertices.max(axis=0)))
+
+    def get_fragment(self, key):
+        """Return vertices and faces of a single fragment.
+
+        Parameters
+        ----------
+        key :       (supervoxel ID, fragment key)
+
+        Returns
+        -------
+        verts, faces
+                    Faces index into the returned vertices.
+
+        """
+        if self.fragments is None:
+            raise ValueError("Mesh has no fragment information")
+        v0, nv, f0, nf = self.fragments[key]
+        return self.vertices[v0 : v0 + nv], self.faces[f0 : f0 + nf] - v0
+
+    def weld(self, tolerance=None):
+        """Return copy with duplicate vertices merged.
+
+        See ``brainmappy.weld_vertices``. The copy has no fragment
+        information.
+        """
+        return type(self)(*weld_vertices(self.vertices, self.faces, tolerance))
+
+    def to_trimesh(self, **kwargs):
+        """Convert to ``trimesh.Trimesh``.
+
+        Parameters
+        ----------
+        **kwargs
+                    Passed to ``trimesh.Trimesh``. Set ``process=False`` to skip
+                    merging vertices.
+
+        """
+        import trimesh as tm
+
+        return tm.Trimesh(self.vertices, self.faces, **kwargs)
+
+
+def weld_vertices(verts, faces, tolerance=None):
+    """Merge duplicate vertices, e.g. along the seams between fragments.
+
+    Meshes fetched from brainmaps are stitched together from fragments that
+    each have their own copy of the vertices they share with neighbouring
+    fragments. This merges these duplicates which is much cheaper than
+    ``trimesh``'s full processing.
+
+    Parameters
+    ----------
+    verts :     (N, 3) array
+    faces :     (M, 3) array
+                Indices into ``verts``.
+    tolerance : float, optional
+                If provided, vertices are snapped to a grid of this size before
+                comparing them. If None, only exact duplicates are merged.
+
+    Returns
+    -------
+    verts :     (K, 3) array
+                Unique vertices in order of their first occurrence.
+    faces :     (M, 3) array
+                Faces re-indexed into the new vertices. Faces are not removed,
+                even if they collapse.
+
+    """
+    verts = np.asarray(verts)
+    faces = np.asarray(faces)
+
+    if not len(verts):
+        return verts, faces
+
+    if tolerance:
+        q = np.round(verts / tolerance).astype(np.int64)
+    else:
+        # Compare bit patterns - adding 0 turns -0.0 into 0.0
+        q = np.ascontiguousarray(verts + 0, dtype=np.float32)
+        q = q.view(np.int32).astype(np.int64)
+
+    # Hash integer coordinates into a single 64 bit integer (may overflow)
+    with np.errstate(over="ignore"):
+        h = np.bitwise_xor.reduce(q * _HASH_PRIMES, axis=1)
+
+    _, first, inverse = np.unique(h, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # Fall back to comparing full rows if there are any hash collisions
+    if np.any(q[first][inverse] != q):
+        _, first, inverse = np.unique(q, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+
+    # Keep vertices in the order of their first occurrence
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+
+    new_faces = remap[inverse][faces].astype(faces.dtype, copy=False)
+
+    return verts[first[order]], new_faces
+
+
+def _make_mesh(verts, faces, return_type="trimesh", fragments=None):
+    """Turn vertices and faces into requested mesh type.
+
+    ``fragments`` is only kept for ``Mesh``.
+    """
+    return_type = _eval_return_type(return_type)
+
+    if return_type == "trimesh":
+        import trimesh as tm
+
+        return tm.Trimesh(verts, faces)
+    elif return_type == "mesh":
+        return Mesh(verts, faces, fragments=fragments)
+
+    return verts, faces
+
+
+def _eval_return_type(return_type):
+    """Check that ``return_type`` is valid."""
+    if return_type not in RETURN_TYPES:
+        raise ValueError(
+            "`return_type` must be one of {}, got {!r}".format(
+                RETURN_TYPES, return_type
+            )
+        )
+    return return_type
@@ -0,0 +1,314 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains instrumentation of requests and processing stages.
+
+Instrumentation is disabled by default and costs (almost) nothing while
+disabled. Enable it with::
+
+    >>> import brainmappy as bm
+    >>> bm.metrics.enable()
+    >>> m = bm.get_meshes_batch(21716312853)
+    >>> bm.metrics.registry.to_dict()
+    >>> print(bm.metrics.registry.to_prometheus())
+
+Recorded metrics (all prefixed with ``brainmappy_``):
+
+- ``request_seconds{endpoint, status}``: time on the wire (histogram)
+- ``queue_seconds{endpoint}``: time between scheduling a request and
+  sending it (histogram)
+- ``requests_in_flight{endpoint}``: requests currently on the wire (gauge)
+- ``bytes_sent_total{endpoint}``, ``bytes_received_total{endpoint}``
+- ``retries_total{endpoint}``, ``throttled_total{endpoint}`` (429/503),
+  ``failed_total{endpoint}`` (given up after retries), ``errors_total{endpoint}``
+  (connection errors, timeouts, etc.)
+- ``stage_seconds{stage}``: time spent in processing stages (histogram),
+  e.g. "json_decode", "ng_decode", "assemble", "prepare"
+- ``cache_hits_total{cache}``, ``cache_misses_total{cache}``
+
+Callbacks added via ``Registry.add_callback`` are called for every single
+observation, e.g. to forward them to another monitoring system.
+"""
+
+import contextlib
+import threading
+import time
+import urllib.parse
+
+__all__ = ["Registry", "disable", "enable", "registry"]
+
+# Default histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    """Collects counters, gauges and histograms.
+
+    Parameters
+    ----------
+    prefix :    str
+                Prefix for metric names.
+    buckets :   tuple of float
+                Upper bounds of histogram buckets.
+
+    """
+
+    def __init__(self, prefix="brainmappy_", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.enabled = False
+        self.callbacks = []
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self):
+        return "<{} enabled={} metrics={}>".format(
+            type(self).__name__, self.enabled, len(self._types)
+        )
+
+    def reset(self):
+        """Remove all recorded values."""
+        with self._lock:
+            # name -> "counter" | "gauge" | "histogram"
+            self._types = {}
+            # (name, labels) -> value
+            self._values = {}
+            # (name, labels) -> [bucket counts, sum, count]
+            self._histograms = {}
+
+    def add_callback(self, func):
+        """Add function to be called for each observation.
+
+        Called as ``func(kind, name, value, labels)`` where ``kind`` is
+        "counter", "gauge" or "histogram" and ``labels`` is a dict.
+        """
+        self.callbacks.append(func)
+
+    def inc(self, name, value=1, **labels):
+        """Increment counter."""
+        self._add("counter", name, value, labels)
+
+    def add(self, name, value, **labels):
+        """Add (possibly negative) value to gauge."""
+        self._add("gauge", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """Add observation to histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            self._types[name] = "histogram"
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+        for func in self.callbacks:
+            func("histogram", name, value, labels)
+
+    def _add(self, kind, name, value, labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._types[name] = kind
+            self._values[key] = self._values.get(key, 0) + value
+
+        for func in self.callbacks:
+            func(kind, name, value, labels)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time a processing stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def to_dict(self):
+        """Return recorded values as plain dictionary.
+
+        Returns
+        -------
+        dict
+                ``{name: [{"labels": {...}, "value": ...}, ...]}``. For
+                histograms ``value`` is a dict with ``count``, ``sum`` and
+                ``buckets`` (non-cumulative counts per upper bound).
+
+        """
+        out = {}
+        with self._lock:
+            for (name, labels), value in self._values.items():
+                out.setdefault(name, []).append(dict(labels=dict(labels), value=value))
+            for (name, labels), (counts, total, n) in self._histograms.items():
+                out.setdefault(name, []).append(
+                    dict(
+                        labels=dict(labels),
+                        value=dict(
+                            count=n, sum=total, buckets=dict(zip(self.buckets, counts))
+                        ),
+                    )
+                )
+        return out
+
+    def to_prometheus(self):
+        """Return recorded values in Prometheus' text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                kind = self._types[name]
+                full = self.prefix + name
+                lines.append("# TYPE {} {}".format(full, kind))
+
+                if kind != "histogram":
+                    for (n, labels), value in sorted(self._values.items()):
+                        if n == name:
+                            lines.append("{}{} {}".format(full, _labels(labels), value))
+                    continue
+
+                for (n, labels), (counts, total, count) in sorted(
+                    self._histograms.items()
+                ):
+                    if n != name:
+                        continue
+                    cum = 0
+                    for b, c in zip(self.buckets, counts):
+                        cum += c
+                        le = labels + (("le", _fmt(b)),)
+                        lines.append("{}_bucket{} {}".format(full, _labels(le), cum))
+                    le = labels + (("le", "+Inf"),)
+                    lines.append("{}_bucket{} {}".format(full, _labels(le), count))
+                    lines.append("{}_sum{} {}".format(full, _labels(labels), total))
+                    lines.append("{}_count{} {}".format(full, _labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+def _key(name, labels):
+    """Return key for given metric - label values are stored as strings."""
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels(labels):
+    """Format labels for Prometheus."""
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+def _fmt(x):
+    """Format bucket bound for Prometheus."""
+    return repr(float(x))
+
+
+def endpoint_name(url):
+    """Return short endpoint name for given URL.
+
+    For example "meshes:batch", "listfragments" or "values".
+    """
+    last = urllib.parse.urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+    if ":" in last and not last.startswith("meshes:"):
+        # e.g. "{mesh_name}:listfragments"
+        return last.rsplit(":", 1)[-1]
+    return last
+
+
+# Default registry used by all of brainmappy
+registry = Registry()
+
+
+def enable():
+    """Start recording metrics."""
+    registry.enabled = True
+
+
+def disable():
+    """Stop recording metrics."""
+    registry.enabled = False
+
+
+def request(session, method, url, endpoint=None, **kwargs):
+    """Make request and record its metrics (if enabled).
+
+    Parameters
+    ----------
+    session :   requests.Session
+    method :    str
+    url :       str
+    endpoint :  str, optional
+                Name of the endpoint. If not provided, will be derived from
+                ``url``.
+    **kwargs
+                Passed through to ``session.request``.
+
+    Returns
+    -------
+    requests.Response
+
+    """
+    if not registry.enabled:
+        return session.request(method, url, **kwargs)
+
+    endpoint = endpoint or endpoint_name(url)
+    registry.add("requests_in_flight", 1, endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        resp = session.request(method, url, **kwargs)
+    except BaseException as e:
+        registry.observe(
+            "request_seconds",
+            time.perf_counter() - start,
+            endpoint=endpoint,
+            status=type(e).__name__,
+        )
+        registry.inc("errors_total", endpoint=endpoint)
+        raise
+    finally:
+        registry.add("requests_in_flight", -1, endpoint=endpoint)
+
+    registry.observe(
+        "request_seconds",
+        time.perf_counter() - start,
+        endpoint=endpoint,
+        status=str(resp.status_code),
+    )
+    body = resp.request.body
+    registry.inc("bytes_sent_total", len(body) if body else 0, endpoint=endpoint)
+    registry.inc("bytes_received_total", len(resp.content), endpoint=endpoint)
+
+    return resp
+
+
+def timer(stage):
+    """Time a processing stage - does nothing if metrics are disabled."""
+    if registry.enabled:
+        return registry.timer(stage)
+    return _NULL_TIMER
+
+
+class _NullTimer:
+    """Context manager that does nothing."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
@@ -0,0 +1,424 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains the scheduler that runs HTTP requests in parallel."""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from . import metrics
+
+__all__ = ["RequestScheduler"]
+
+# Responses with these status codes are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# These indicate that we are sending too much
+THROTTLE_STATUS = (429, 503)
+
+# Exceptions that are retried
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# Stats of the most recent run (see ``imap_requests``)
+last_stats = {}
+
+
+class RequestScheduler:
+    """Run requests with adaptive concurrency and retries.
+
+    Concurrency follows an AIMD (additive increase, multiplicative decrease)
+    scheme: each successful response increases the number of parallel
+    requests by ``1 / concurrency`` (i.e. by one per "round"), throttling
+    responses (429, 503) halve it and latencies well above the best observed
+    latency shrink it slightly.
+
+    Failed requests (connection errors, 429 and 5xx responses) are retried
+    individually with jittered exponential backoff. If the server sends a
+    ``Retry-After`` header, we wait at least that long.
+
+    Parameters
+    ----------
+    max_concurrency :   int
+                        Max number of parallel requests.
+    min_concurrency :   int
+                        Min number of parallel requests.
+    concurrency :       int, optional
+                        Number of parallel requests to start with. Defaults
+                        to ``max_concurrency``.
+    max_retries :       int
+                        Max number of times each request is retried.
+    backoff :           float
+                        Base for exponential backoff in seconds: the n-th
+                        retry waits between 0 and ``backoff * 2**n`` seconds.
+    max_backoff :       float
+                        Max wait between retries in seconds.
+    latency_factor :    float
+                        Shrink concurrency when latency exceeds this multiple
+                        of the best observed (smoothed) latency.
+    max_pool_size :     int
+                        Size of the thread pool. Threads are only started as
+                        needed. Calls can't ask for more parallel requests
+                        than this.
+    timeout :           float | (float, float)
+                        Default (connect, read) timeout in seconds for
+                        requests that don't set their own. Timeouts are
+                        retried like connection errors.
+
+    Examples
+    --------
+    >>> from brainmappy.scheduler import RequestScheduler
+    >>> sched = RequestScheduler(max_concurrency=32)
+    >>> reqs = [(i, "GET", url, {}) for i, url in enumerate(urls)]
+    >>> for i, resp in sched.imap(session, reqs):
+    ...     resp.raise_for_status()
+    >>> sched.stats["throughput"]
+    41.2
+
+    """
+
+    def __init__(
+        self,
+        max_concurrency=10,
+        min_concurrency=1,
+        concurrency=None,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=60,
+        latency_factor=3,
+        max_pool_size=64,
+        timeout=(10, 120),
+    ):
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.min_concurrency = max(min(int(min_concurrency), self.max_concurrency), 1)
+        self.concurrency = float(concurrency or self.max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_factor = latency_factor
+        self.timeout = timeout
+
+        self._latency = None  # smoothed latency
+        self._best_latency = None
+        self._last_decrease = 0
+        # The pool is never resized: ``imap`` calls sharing this scheduler
+        # would still hold on to the old one
+        self.pool_size = max(self.max_concurrency, int(max_pool_size))
+        self._pool = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def __repr__(self):
+        return "<{} concurrency={:.1f}/{}>".format(
+            type(self).__name__, self.concurrency, self.max_concurrency
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pool(self):
+        """Thread pool used to send requests - reused across ``imap`` calls."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.pool_size, thread_name_prefix="brainmappy"
+                )
+            return self._pool
+
+    def close(self):
+        """Shut down the thread pool."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def reset_stats(self):
+        """Reset request counters."""
+        with self._lock:
+            self._stats = dict(requests=0, retries=0, throttled=0, failed=0, time=0.0)
+
+    @property
+    def stats(self):
+        """Summary of requests made so far.
+
+        Returns
+        -------
+        dict
+                ``requests`` (successful + failed), ``retries``, ``throttled``
+                (429/503 responses), ``failed`` (given up after retries),
+                ``time`` (wall time in s spent in ``imap``), ``throughput``
+                (requests/s), ``concurrency`` (current number of parallel
+                requests) and ``latency`` (smoothed latency in s).
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["throughput"] = stats["requests"] / stats["time"] if stats["time"] else 0
+        stats["concurrency"] = self.concurrency
+        stats["latency"] = self._latency
+        return stats
+
+    def imap(self, session, requests, max_concurrency=None):
+        """Run requests and yield ``(key, response)`` in order of completion.
+
+        Parameters
+        ----------
+        session :           requests.Session
+                            Session to make the requests with.
+        requests :          iterable of (key, method, url, kwargs)
+                            Consumed lazily: new requests are only pulled once
+                            there is room.
+        max_concurrency :   int, optional
+                            Cap the number of parallel requests for this call
+                            (at most ``pool_size``). The scheduler's current
+                            concurrency is scaled to this cap, i.e. the call
+                            is throttled in proportion to the scheduler.
+
+        Yields
+        ------
+        key
+                    Key of the request.
+        requests.Response
+                    Final response. Requests that failed after all retries
+                    yield their last response - use ``raise_for_status()``.
+
+        """
+        ceiling = min(int(max_concurrency or self.max_concurrency), self.pool_size)
+        pool = self.pool
+
+        queue = iter(requests)
+        counter = itertools.count()
+        start = time.perf_counter()
+
+        # Heap of (ready time, tiebreaker, attempt, request) for retries
+        retries = []
+        # Maps future -> (attempt, request)
+        pending = {}
+        exhausted = False
+
+        try:
+            while True:
+                # Top up requests in flight - retries that are due first
+                while len(pending) < self._limit(ceiling):
+                    if retries and retries[0][0] <= time.perf_counter():
+                        _, _, attempt, req = heapq.heappop(retries)
+                    elif not exhausted:
+                        try:
+                            req = next(queue)
+                        except StopIteration:
+                            exhausted = True
+                            continue
+                        attempt = 0
+                    else:
+                        break
+                    f = pool.submit(
+                        _send, session, *req[1:], time.perf_counter(), self.timeout
+                    )
+                    pending[f] = (attempt, req)
+
+                if not pending and not retries and exhausted:
+                    break
+
+                # Wait for the next response or the next retry to be due
+                timeout = None
+                if retries:
+                    timeout = max(retries[0][0] - time.perf_counter(), 0)
+                if not pending:
+                    time.sleep(timeout)
+                    continue
+
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for f in done:
+                    attempt, req = pending.pop(f)
+                    resp, latency, error = f.result()
+                    status = resp.status_code if resp is not None else None
+                    headers = resp.headers if resp is not None else None
+
+                    if self._should_retry(status, error, latency):
+                        if metrics.registry.enabled:
+                            _record_retry(req[2], resp, attempt < self.max_retries)
+
+                        if attempt < self.max_retries:
+                            self._count("retries")
+                            ready = time.perf_counter() + self._wait(attempt, headers)
+                            heapq.heappush(
+                                retries, (ready, next(counter), attempt + 1, req)
+                            )
+                            continue
+
+                        self._count("failed")
+                        if error is not None:
+                            raise error
+
+                    self._count("requests")
+                    yield req[0], resp
+        finally:
+            self._count("time", time.perf_counter() - start)
+
+            # Don't start anything new if we exit early
+            for f in pending:
+                f.cancel()
+
+    def _limit(self, ceiling):
+        """Number of parallel requests for a call capped at ``ceiling``."""
+        # Concurrency moves between min and max concurrency - calls with a
+        # different cap get the same fraction of their own cap
+        return max(int(self.concurrency * ceiling / self.max_concurrency), 1)
+
+    def _count(self, stat, n=1):
+        """Increment counter in stats."""
+        with self._lock:
+            self._stats[stat] += n
+
+    def _should_retry(self, status, error, latency):
+        """Update concurrency from the outcome of a request and decide whether to retry.
+
+        Parameters
+        ----------
+        status :    int | None
+                    HTTP status code. None if the request failed with
+                    ``error``.
+        error :     Exception | None
+        latency :   float
+                    Time in seconds until the response arrived.
+
+        """
+        # Schedulers are shared by concurrent calls
+        with self._lock:
+            return self._update(status, error, latency)
+
+    def _update(self, status, error, latency):
+        """Update concurrency - see ``_should_retry``. Must hold the lock."""
+        now = time.perf_counter()
+
+        # Connection errors and throttling -> back off
+        if error is not None:
+            self._decrease(0.5, now)
+            return True
+        elif status in THROTTLE_STATUS:
+            self._stats["throttled"] += 1
+            self._decrease(0.5, now)
+            return True
+        elif status in RETRY_STATUS:
+            return True
+
+        # Track latency (exponentially weighted)
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * latency
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+
+        if self._latency > self.latency_factor * self._best_latency:
+            self._decrease(0.9, now)
+        else:
+            self.concurrency = min(
+                self.concurrency + 1 / self.concurrency, self.max_concurrency
+            )
+
+        return False
+
+    def _decrease(self, factor, now):
+        """Multiplicative decrease - at most once per round trip."""
+        if now - self._last_decrease < (self._latency or 0):
+            return
+        self._last_decrease = now
+        self.concurrency = max(self.concurrency * factor, self.min_concurrency)
+
+    def _wait(self, attempt, headers=None):
+        """Time to wait before the next retry given the last response's headers."""
+        wait = random.uniform(0, min(self.backoff * 2**attempt, self.max_backoff))
+
+        if headers is not None:
+            try:
+                wait = max(wait, float(headers.get("Retry-After", 0)))
+            except ValueError:
+                # Retry-After can also be a date - ignore that
+                pass
+
+        return wait
+
+
+def _send(session, method, url, kwargs, submitted=None, timeout=None):
+    """Send request and return ``(response, latency, error)``."""
+    if timeout is not None and "timeout" not in kwargs:
+        kwargs = dict(kwargs, timeout=timeout)
+
+    start = time.perf_counter()
+    if submitted and metrics.registry.enabled:
+        metrics.registry.observe(
+            "queue_seconds", start - submitted, endpoint=metrics.endpoint_name(url)
+        )
+    try:
+        resp = metrics.request(session, method, url, **kwargs)
+    except TRANSIENT_ERRORS as e:
+        return None, time.perf_counter() - start, e
+    return resp, time.perf_counter() - start, None
+
+
+def _record_retry(url, resp, retry):
+    """Record metrics for a request that failed."""
+    endpoint = metrics.endpoint_name(url)
+    if resp is not None and resp.status_code in THROTTLE_STATUS:
+        metrics.registry.inc("throttled_total", endpoint=endpoint)
+    if retry:
+        metrics.registry.inc("retries_total", endpoint=endpoint)
+    else:
+        metrics.registry.inc("failed_total", endpoint=endpoint)
+
+
+def imap_requests(session, requests, max_threads=10, scheduler=None):
+    """Run requests in parallel and yield ``(key, response)`` in order of completion.
+
+    Parameters
+    ----------
+    session :       requests.Session
+    requests :      iterable of (key, method, url, kwargs)
+                    Consumed lazily: new requests are only pulled once there
+                    is room.
+    max_threads :   int
+                    Max number of parallel requests.
+    scheduler :     RequestScheduler, optional
+                    Scheduler to use. If not provided, will use a new one
+                    just for these requests. Stats for these requests are
+                    available as ``brainmappy.scheduler.last_stats``.
+
+    """
+    if scheduler is None:
+        with RequestScheduler(max_concurrency=max_threads) as scheduler:
+            yield from imap_requests(session, requests, max_threads, scheduler)
+        return
+
+    # Schedulers can be shared - only report stats for these requests
+    before = scheduler.stats
+    try:
+        yield from scheduler.imap(session, requests, max_concurrency=max_threads)
+    finally:
+        stats = scheduler.stats
+        for k in ("requests", "retries", "throttled", "failed", "time"):
+            stats[k] -= before[k]
+        stats["throughput"] = stats["requests"] / stats["time"] if stats["time"] else 0
+        last_stats.clear()
+        last_stats.update(stats)
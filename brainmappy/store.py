@@ -0,0 +1,316 @@
+#    This script is part of brainmappy (http://www.github.com/schlegelp/brainmappy).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+
+"""This module contains an on-disk store for large numbers of meshes."""
+
+import os
+import threading
+
+import numpy as np
+
+__all__ = ["MeshStore"]
+
+# One record per object in ``index.bin``
+_INDEX_DTYPE = np.dtype(
+    [
+        ("object_id", "<u8"),
+        ("v_start", "<u8"),
+        ("n_verts", "<u8"),
+        ("f_start", "<u8"),
+        ("n_faces", "<u8"),
+    ]
+)
+
+
+class MeshStore:
+    """Append-only, memory-mapped on-disk store for meshes.
+
+    Vertices and faces of all objects are appended to two flat files
+    (``vertices.bin``: float32, ``faces.bin``: uint32) and an index
+    (``index.bin``) records where each object's mesh starts and how big it is.
+    Meshes can therefore be written fragment by fragment without ever holding
+    a full mesh in memory, and read back as memory-mapped arrays without
+    loading the rest of the store.
+
+    Faces are stored per object, i.e. they index into that object's
+    vertices. Adding an object that is already in the store appends the new
+    mesh and updates the index - the old data is not reclaimed.
+
+    Parameters
+    ----------
+    path :      str
+                Directory of the store. Will be created if it does not exist.
+    mode :      "a" | "r" | "w"
+                "a" (default) opens for reading and appending, "r" opens
+                read-only and "w" clears any existing store.
+
+    Examples
+    --------
+    >>> import brainmappy as bm
+    >>> store = bm.MeshStore("meshes")
+    >>> _ = bm.get_meshes_bulk([21716312853, 21716312854], store=store)
+    >>> verts, faces = store[21716312853]
+
+    """
+
+    def __init__(self, path, mode="a"):
+        if mode not in ("a", "r", "w"):
+            raise ValueError('`mode` must be "a", "r" or "w", got "{}"'.format(mode))
+
+        self.path = path
+        self.mode = mode
+
+        self._lock = threading.RLock()
+        self._files = None
+        self._maps = {}
+
+        if mode == "r":
+            if not os.path.isdir(path):
+                raise FileNotFoundError("No mesh store at {}".format(path))
+        else:
+            os.makedirs(path, exist_ok=True)
+            flag = "wb" if mode == "w" else "ab"
+            self._files = {
+                name: open(self._filepath(name), flag)
+                for name in ("vertices", "faces", "index")
+            }
+            # Drop partially written index records (e.g. after a crash)
+            index = self._files["index"]
+            index.truncate(index.tell() - index.tell() % _INDEX_DTYPE.itemsize)
+            index.seek(0, os.SEEK_END)
+
+        self._read_index()
+
+        if self._files is not None:
+            # Drop data that was written but never indexed - otherwise new
+            # objects would not start at a full row
+            self._truncate("vertices", self._end("v_start", "n_verts"))
+            self._truncate("faces", self._end("f_start", "n_faces"))
+
+    def __repr__(self):
+        return "<{} path={!r} mode={!r} objects={}>".format(
+            type(self).__name__, self.path, self.mode, len(self)
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, object_id):
+        return int(object_id) in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __getitem__(self, object_id):
+        return self.get(object_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _filepath(self, name):
+        return os.path.join(self.path, name + ".bin")
+
+    def _read_index(self):
+        """(Re-)read index from disk."""
+        fp = self._filepath("index")
+        n = os.path.getsize(fp) // _INDEX_DTYPE.itemsize if os.path.isfile(fp) else 0
+        records = np.fromfile(fp, dtype=_INDEX_DTYPE, count=n) if n else []
+
+        # Later records overwrite earlier ones
+        self._index = {int(r["object_id"]): r for r in records}
+
+    def _end(self, start, count):
+        """Return number of rows in a data file that are covered by the index."""
+        if not self._index:
+            return 0
+        return max(int(r[start]) + int(r[count]) for r in self._index.values())
+
+    def _truncate(self, name, rows):
+        """Truncate data file to given number of rows."""
+        f = self._files[name]
+        f.flush()
+        f.truncate(rows * 12)
+        f.seek(0, os.SEEK_END)
+        self._maps.pop(name, None)
+
+    @property
+    def object_ids(self):
+        """IDs of objects in the store."""
+        return np.array(list(self._index), dtype=np.uint64)
+
+    def info(self, object_id):
+        """Return number of vertices and faces for given object."""
+        r = self._index[int(object_id)]
+        return int(r["n_verts"]), int(r["n_faces"])
+
+    def get(self, object_id):
+        """Get mesh for given object.
+
+        Parameters
+        ----------
+        object_id :     int
+
+        Returns
+        -------
+        verts :         (N, 3) numpy array of float32
+        faces :         (M, 3) numpy array of uint32
+                        Both are read-only views into the memory-mapped store -
+                        copy them if you need to modify them.
+
+        """
+        r = self._index[int(object_id)]
+        v0, nv, f0, nf = (
+            int(r[k]) for k in ("v_start", "n_verts", "f_start", "n_faces")
+        )
+
+        verts = self._map("vertices", np.float32, v0 + nv)[v0 : v0 + nv]
+        faces = self._map("faces", np.uint32, f0 + nf)[f0 : f0 + nf]
+
+        return verts, faces
+
+    def _map(self, name, dtype, rows):
+        """Return (N, 3) memory map of given file with at least ``rows`` rows."""
+        mm = self._maps.get(name)
+        if mm is None or len(mm) < rows:
+            with self._lock:
+                if self._files is not None:
+                    self._files[name].flush()
+                size = os.path.getsize(self._filepath(name)) // 12
+                if size:
+                    mm = np.memmap(
+                        self._filepath(name), dtype=dtype, mode="r", shape=(size, 3)
+                    )
+                else:
+                    mm = np.zeros((0, 3), dtype=dtype)
+                self._maps[name] = mm
+        return mm
+
+    def add(self, object_id, verts, faces):
+        """Add mesh to store.
+
+        Parameters
+        ----------
+        object_id :     int
+        verts :         (N, 3) array
+        faces :         (M, 3) array
+                        Indices into ``verts``.
+
+        """
+        with self.writer(object_id) as w:
+            w.add(verts, faces)
+
+    def writer(self, object_id):
+        """Return writer that adds a single mesh piece by piece.
+
+        The object's data is written as it comes in and the object is only
+        added to the index once the writer is closed without error. Use as
+        context manager::
+
+            >>> with store.writer(12345) as w:
+            ...     for verts, faces in fragments:
+            ...         w.add(verts, faces)
+
+        Only one writer can be open at a time - others will block until it is
+        closed.
+
+        """
+        if self._files is None:
+            raise ValueError("Mesh store was opened read-only")
+        return _ObjectWriter(self, object_id)
+
+    def flush(self):
+        """Flush pending writes to disk."""
+        if self._files is not None:
+            with self._lock:
+                for f in self._files.values():
+                    f.flush()
+
+    def close(self):
+        """Close files."""
+        with self._lock:
+            if self._files is not None:
+                for f in self._files.values():
+                    f.close()
+                self._files = None
+            self._maps = {}
+
+
+class _ObjectWriter:
+    """Writes a single object to a ``MeshStore`` - see ``MeshStore.writer``."""
+
+    def __init__(self, store, object_id):
+        self.store = store
+        self.object_id = int(object_id)
+        self.n_verts = 0
+        self.n_faces = 0
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        files = self.store._files
+        self.v_start = files["vertices"].tell() // 12
+        self.f_start = files["faces"].tell() // 12
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self._commit()
+            else:
+                # Discard this object's data
+                self.store._truncate("vertices", self.v_start)
+                self.store._truncate("faces", self.f_start)
+        finally:
+            self.store._lock.release()
+
+    def add(self, verts, faces):
+        """Append vertices and faces (indices into ``verts``)."""
+        verts = np.asarray(verts, dtype="<f4").reshape(-1, 3)
+        faces = np.asarray(faces).reshape(-1, 3)
+
+        # Offset faces by vertices written so far
+        faces = (faces.astype(np.int64) + self.n_verts).astype("<u4")
+
+        files = self.store._files
+        files["vertices"].write(np.ascontiguousarray(verts).tobytes())
+        files["faces"].write(faces.tobytes())
+
+        self.n_verts += len(verts)
+        self.n_faces += len(faces)
+
+    def _commit(self):
+        """Add object to the index."""
+        record = np.array(
+            [
+                (
+                    self.object_id,
+                    self.v_start,
+                    self.n_verts,
+                    self.f_start,
+                    self.n_faces,
+                )
+            ],
+            dtype=_INDEX_DTYPE,
+        )
+
+        # Data must hit the file before the index points to it
+        files = self.store._files
+        files["vertices"].flush()
+        files["faces"].flush()
+        files["index"].write(record.tobytes())
+        files["index"].flush()
+
+        self.store._index[self.object_id] = record[0]
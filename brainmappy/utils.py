@@ -12,4 +12,246 @@
 #    GNU General Public License for more details.
 
 
+import math
+import os
+import warnings
+
+import numpy as np
+
 use_pbars = True
+
+# Root of the brainmaps API - can be pointed at e.g. a local stand-in server
+brainmaps_url = os.environ.get("BRAINMAPS_URL", "https://brainmaps.googleapis.com/")
+
+
+def tqdm(*args, **kwargs):
+    """Progress bar - ``tqdm.tqdm`` but imported on first use."""
+    from tqdm import tqdm
+
+    return tqdm(*args, **kwargs)
+
+
+def chunk_coords(coords, chunksize, method="morton"):
+    """Split coordinates into spatially compact chunks.
+
+    Parameters
+    ----------
+    coords :    (N, 3) array of int
+                Voxel coordinates.
+    chunksize : int
+                Max number of coordinates per chunk.
+    method :    "morton" | "grid" | "kmeans"
+                How to group coordinates:
+
+                - "morton" sorts coordinates along a Z-order curve and cuts
+                  the sorted list into chunks of exactly ``chunksize``
+                  (except for the last one). O(N log N).
+                - "grid" buckets coordinates into a voxel grid with about
+                  ``chunksize`` coordinates per cell (at average density),
+                  visits cells in Z-order and cuts into chunks of
+                  ``chunksize``. O(N log N).
+                - "kmeans" clusters coordinates with k-means and splits
+                  clusters larger than ``chunksize``. This produces the
+                  most compact chunks but is O(N * k) per iteration and
+                  chunks can be much smaller than ``chunksize``.
+
+    Returns
+    -------
+    list of arrays
+                Indices into ``coords`` for each chunk.
+
+    """
+    coords = np.asarray(coords)
+    chunksize = int(chunksize)
+
+    if len(coords) <= chunksize:
+        return [np.arange(len(coords))] if len(coords) else []
+
+    if method == "morton":
+        order = np.argsort(morton_codes(coords), kind="stable")
+    elif method == "grid":
+        order = _grid_order(coords, chunksize)
+    elif method == "kmeans":
+        return _kmeans_chunks(coords, chunksize)
+    else:
+        raise ValueError('`method` must be "morton", "grid" or "kmeans"')
+
+    return [order[i : i + chunksize] for i in range(0, len(order), chunksize)]
+
+
+def morton_codes(coords):
+    """Calculate Morton (Z-order) codes for 3D coordinates.
+
+    Coordinates are offset to start at 0. If the extent along any axis
+    exceeds 21 bits, the lowest bits are dropped (i.e. neighbouring voxels
+    may share a code).
+
+    Parameters
+    ----------
+    coords :    (N, 3) array of int
+
+    Returns
+    -------
+    (N, ) array of uint64
+
+    """
+    coords = np.asarray(coords)
+    coords = (coords - coords.min(axis=0)).astype(np.uint64)
+
+    # Drop low bits if we don't fit into 21 bits per axis
+    extent = int(coords.max()) if len(coords) else 0
+    shift = max(extent.bit_length() - 21, 0)
+    if shift:
+        coords = coords >> np.uint64(shift)
+
+    codes = np.zeros(len(coords), dtype=np.uint64)
+    for i in range(3):
+        codes |= _spread_bits(coords[:, i]) << np.uint64(i)
+
+    return codes
+
+
+def _spread_bits(x):
+    """Insert two 0 bits between each of the lower 21 bits of ``x``."""
+    x = x & np.uint64(0x1FFFFF)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1F00000000FFFF)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1F0000FF0000FF)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100F00F00F00F00F)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10C30C30C30C30C3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def _grid_order(coords, chunksize):
+    """Order coordinates by voxel grid cell."""
+    mn = coords.min(axis=0)
+    extent = np.maximum(coords.max(axis=0) - mn, 1).astype(float)
+
+    # Pick a cube size that holds ~chunksize points at average density
+    n_cells = len(coords) / chunksize
+    side = max(np.prod(extent / n_cells) ** (1 / 3), 1)
+
+    cells = ((coords - mn) // side).astype(np.int64)
+
+    # Visit cells along a Z-order curve so that consecutive cells are neighbours
+    return np.argsort(morton_codes(cells), kind="stable")
+
+
+def _kmeans_chunks(coords, chunksize):
+    """Chunk coordinates using k-means clustering."""
+    from scipy.cluster.vq import kmeans2
+
+    # Cluster but catch UserWarning if we get less than n_chunks clusters
+    n_chunks = math.ceil(len(coords) / chunksize)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        centroid, labels = kmeans2(coords.astype(float), k=n_chunks)
+
+    chunks = []
+    for i in range(n_chunks):
+        # Get this chunk's coordinates
+        ix = np.where(labels == i)[0]
+
+        # The kmeans cluster will be spatially close but will vary in size
+        # They will become bigger than the cap so we have to chop it up
+        for k in range(0, ix.shape[0], chunksize):
+            chunks.append(ix[k : k + chunksize])
+
+    return chunks
+
+
+# Powers of 10 that fit into uint64 (10**0 ... 10**19)
+_POW10 = 10 ** np.arange(20, dtype=np.uint64)
+
+
+def encode_locations(voxels):
+    """Format voxels as JSON strings ``"x,y,z",`` in bulk.
+
+    Parameters
+    ----------
+    voxels :    (N, 3) array of int
+
+    Returns
+    -------
+    buf :       bytes
+                ``"x1,y1,z1","x2,y2,z2",...,`` - note the trailing comma.
+    offsets :   (N + 1, ) array of int
+                Voxel ``i`` is at ``buf[offsets[i]:offsets[i + 1]]``.
+
+    """
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    neg = voxels < 0
+    absv = np.abs(voxels).astype(np.uint64)
+
+    # Number of digits (at least 1) plus sign
+    n_digits = np.searchsorted(_POW10, absv, side="right").clip(1)
+    width = n_digits + neg
+
+    # Each voxel is: quote, x, comma, y, comma, z, quote, comma
+    offsets = np.zeros(len(voxels) + 1, dtype=np.int64)
+    np.cumsum(width.sum(axis=1) + 5, out=offsets[1:])
+    buf = np.empty(offsets[-1], dtype=np.uint8)
+
+    starts = offsets[:-1]
+    field_starts = np.empty_like(width)
+    field_starts[:, 0] = starts + 1
+    field_starts[:, 1] = field_starts[:, 0] + width[:, 0] + 1
+    field_starts[:, 2] = field_starts[:, 1] + width[:, 1] + 1
+    field_ends = field_starts + width
+
+    buf[starts] = ord('"')
+    buf[field_ends[:, 0]] = ord(",")
+    buf[field_ends[:, 1]] = ord(",")
+    buf[field_ends[:, 2]] = ord('"')
+    buf[offsets[1:] - 1] = ord(",")
+    buf[field_starts[neg]] = ord("-")
+
+    # Write digits right to left
+    ends = field_ends.ravel()
+    rest = absv.ravel()
+    digits = n_digits.ravel()
+    for k in range(int(digits.max(initial=0))):
+        m = digits > k
+        buf[ends[m] - 1 - k] = (rest[m] % 10).astype(np.uint8) + ord("0")
+        rest = rest // 10
+
+    return buf.tobytes(), offsets
+
+
+def decode_uint64_list(content, key=b'"values"'):
+    """Parse a JSON list of uint64 strings straight into a numpy array.
+
+    Skips building the intermediate Python objects of a full JSON parse.
+
+    Parameters
+    ----------
+    content :   bytes
+                JSON document, e.g. ``{"uint64StrList": {"values": ["1", "2"]}}``.
+    key :       bytes
+                Key of the list in ``content``. The list must not contain
+                anything other than (quoted) non-negative integers.
+
+    Returns
+    -------
+    numpy array of uint64
+                Or None if ``content`` could not be parsed - fall back to
+                regular JSON parsing in that case.
+
+    """
+    start = content.find(key)
+    if start < 0:
+        return None
+    start = content.find(b"[", start)
+    end = content.find(b"]", start)
+    if start < 0 or end < 0:
+        return None
+
+    values = content[start + 1 : end].replace(b'"', b"")
+    if not values.strip():
+        return np.zeros(0, dtype=np.uint64)
+
+    try:
+        # Parses each item as arbitrary precision int -> no overflow
+        return np.array(values.split(b","), dtype=np.uint64)
+    except (ValueError, OverflowError):
+        return None
@@ -43,6 +43,8 @@ setup(
         'Programming Language :: Python :: 3.6',
     ],
     install_requires=requirements,
+    extras_require={'async': ['aiohttp']},
+    entry_points={'console_scripts': ['brainmappy = brainmappy.cli:main']},
     python_requires='>=3.3',
     zip_safe=False
 )
@@ -0,0 +1,297 @@
+"""Shared helpers and fixtures.
+
+Tests run against ``FakeAPI``, a stand-in for the brainmaps API that answers
+requests without touching the network.
+"""
+
+import collections
+import http.server
+import json
+import re
+import struct
+import threading
+import urllib.parse
+import zlib
+
+import numpy as np
+import pytest
+import requests
+
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+import brainmappy as bm
+
+VOLUME = "volume"
+
+
+def encode_ng(fragments):
+    """Encode ``[(object_id, filename, verts, faces), ...]`` as neuroglancer binary."""
+    data = b""
+    for ob, fn, verts, faces in fragments:
+        fn = fn.encode()
+        data += struct.pack("<QI4x", ob, len(fn)) + fn
+        data += struct.pack("<2q", len(verts), len(faces))
+        data += np.asarray(verts, dtype="<f4").tobytes()
+        data += np.asarray(faces, dtype="<u4").tobytes()
+    return data
+
+
+def make_fragments(n, seed=0):
+    """Return ``n`` random fragments as ``(object_id, filename, verts, faces)``."""
+    rng = np.random.default_rng(seed)
+    frags = []
+    for i in range(n):
+        nv = int(rng.integers(3, 30))
+        verts = rng.random((nv, 3)).astype(np.float32) * 1000
+        faces = rng.integers(0, nv, (2 * nv, 3)).astype(np.uint32)
+        frags.append((2**63 + i, "{}:{}".format(i, i * 7), verts, faces))
+    return frags
+
+
+class FakeAPI(BaseAdapter):
+    """Stand-in for the brainmaps API.
+
+    Mount on a ``requests`` session to answer its requests to brainmaps.
+    Responses are deterministic: object ``n`` has ``n % 250 + 1`` fragments
+    (none if ``n`` is a multiple of 1000) and every location has the same
+    segment ID every time.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.counts = collections.Counter()
+        # Status codes to answer the next requests with (None = answer)
+        self.errors = []
+        # Added to all segment IDs
+        self.seg_offset = 0
+        self._lock = threading.Lock()
+
+    def fragments(self, object_id):
+        """Return ``(supervoxel ID, fragment key)`` of given object."""
+        ob = int(object_id)
+        if ob % 1000 == 0:
+            return []
+        return [
+            (str(ob * 1000 + i // 3), "{}:{}".format(ob, i))
+            for i in range(ob % 250 + 1)
+        ]
+
+    def fragment(self, key):
+        """Return ``(verts, faces)`` of given fragment."""
+        rng = np.random.default_rng(zlib.crc32(key.encode()))
+        nv = int(rng.integers(3, 20))
+        verts = (rng.random((nv, 3)) * 1000).astype(np.float32)
+        faces = rng.integers(0, nv, (2 * nv, 3)).astype(np.uint32)
+        return verts, faces
+
+    def mesh(self, object_id, mesh_name="mesh"):
+        """Return ``(verts, faces)`` of given object's fragments combined."""
+        frags = self.fragments(object_id)
+        if mesh_name == "mesh_lowres":
+            frags = frags[::4]
+
+        verts, faces = [], []
+        offset = 0
+        for _, key in frags:
+            v, f = self.fragment(key)
+            verts.append(v)
+            faces.append(f + np.uint32(offset))
+            offset += len(v)
+        return np.vstack(verts), np.vstack(faces)
+
+    def seg_ids(self, voxels):
+        """Return segment IDs at (N, 3) voxels."""
+        v = np.asarray(voxels, dtype=np.uint64) // np.uint64(10)
+        ids = v[:, 0] * np.uint64(1000003) + v[:, 1] * np.uint64(1009) + v[:, 2]
+        return ids + np.uint64(self.seg_offset)
+
+    def handle(self, method, url, body):
+        """Answer request and return ``(status, content)``."""
+        url = urllib.parse.urlsplit(url)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path
+
+        with self._lock:
+            status = self.errors.pop(0) if self.errors else None
+        if status is not None:
+            self.count("errors")
+            return status, {"error": "injected"}
+
+        if method == "POST":
+            data = json.loads(body)
+            if path == "/v1/objects/meshes:batch":
+                self.count("meshes:batch")
+                keys = [k for b in data["batches"] for k in b["fragment_keys"]]
+                svs = [b["object_id"] for b in data["batches"]]
+                self.count("fragments", len(keys))
+                return 200, encode_ng(
+                    (int(sv), k, *self.fragment(k)) for sv, k in zip(svs, keys)
+                )
+            if re.fullmatch(r"/v1/volumes/[^/]+/values", path):
+                self.count("values")
+                self.count("locations", len(data["locations"]))
+                voxels = [[int(c) for c in loc.split(",")] for loc in data["locations"]]
+                ids = self.seg_ids(np.array(voxels).reshape(-1, 3))
+                return 200, {"uint64StrList": {"values": ids.astype(str).tolist()}}
+            if re.fullmatch(r"/v1/volumes/[^/]+/subvolume:binary", path):
+                self.count("subvolume")
+                geometry = data["geometry"]
+                corner = [int(c) for c in geometry["corner"].split(",")]
+                size = [int(c) for c in geometry["size"].split(",")]
+                grid = np.meshgrid(
+                    *[np.arange(c, c + n) for c, n in zip(corner, size)],
+                    indexing="ij",
+                )
+                ids = self.seg_ids(np.stack(grid, axis=-1).reshape(-1, 3))
+                # Z/Y/X order
+                content = ids.reshape(size).T.astype("<u8").tobytes()
+                if data["subvolume_format"] == "RAW_SNAPPY":
+                    import snappy
+
+                    content = snappy.compress(content)
+                return 200, content
+        elif method == "GET":
+            m = re.fullmatch(r"/v1/objects/[^/]+/meshes/([^/]+):listfragments", path)
+            if m:
+                self.count("listfragments")
+                frags = self.fragments(query["objectId"])
+                if m.group(1) == "mesh_lowres":
+                    frags = frags[::4]
+                if not frags:
+                    return 200, {}
+                return 200, {
+                    "supervoxelId": [sv for sv, _ in frags],
+                    "fragmentKey": [k for _, k in frags],
+                }
+            if re.fullmatch(r"/v1/objects/[^/]+/meshes", path):
+                self.count("meshes")
+                return 200, {"meshes": [{"name": "mesh"}, {"name": "mesh_lowres"}]}
+            if path == "/v1/volumes":
+                self.count("volumes")
+                return 200, {"volumeId": [VOLUME]}
+            if re.fullmatch(r"/v1/volumes/[^/]+", path):
+                self.count("volume_info")
+                size = dict(x=100_000, y=100_000, z=10_000)
+                return 200, {
+                    "geometry": [
+                        {
+                            "volumeSize": size,
+                            "channelType": "UINT64",
+                            "pixelSize": dict(x=4, y=4, z=40),
+                        }
+                    ]
+                }
+
+        return 404, {"error": "not found"}
+
+    def count(self, endpoint, n=1):
+        with self._lock:
+            self.counts[endpoint] += n
+
+    def reset(self):
+        """Reset request counts."""
+        with self._lock:
+            self.counts.clear()
+
+    def send(self, request, **kwargs):
+        status, content = self.handle(request.method, request.url, request.body)
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+
+        resp = requests.Response()
+        resp.status_code = status
+        resp.reason = "OK" if status == 200 else "Error"
+        resp.headers = CaseInsensitiveDict({"Content-Length": str(len(content))})
+        resp._content = content
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def make_session(api):
+    """Return session with dummy credentials that talks to ``api``."""
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2.credentials import Credentials
+
+    session = AuthorizedSession(Credentials(token="mock"))
+    session.mount("https://brainmaps.googleapis.com/", api)
+    return session
+
+
+def make_client(api, max_threads=8, **kwargs):
+    """Return client that talks to ``api`` (without metadata cache)."""
+    kwargs.setdefault("metadata_cache", False)
+    return bm.BrainmapsClient(make_session(api), max_threads=max_threads, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def _no_pbars(monkeypatch):
+    monkeypatch.setattr(bm.utils, "use_pbars", False)
+
+
+@pytest.fixture(autouse=True)
+def _metadata_cache(monkeypatch, tmp_path):
+    # Don't share cached metadata between tests (or with the user)
+    cache = bm.MetadataCache(path=str(tmp_path / "metadata"))
+    monkeypatch.setattr(bm.cache, "_default_metadata_cache", cache)
+
+
+@pytest.fixture
+def api():
+    return FakeAPI()
+
+
+@pytest.fixture
+def session(api):
+    """Session with dummy credentials that talks to ``api``."""
+    return make_session(api)
+
+
+@pytest.fixture
+def client(api):
+    """Client that talks to ``api``."""
+    with make_client(api) as c:
+        yield c
+
+
+@pytest.fixture
+def api_server(api, monkeypatch):
+    """Serve ``api`` over HTTP and point ``brainmaps_url`` at it.
+
+    For clients that don't go through a ``requests`` session. Errors are
+    answered with ``Retry-After: 0``.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _answer(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, content = api.handle(self.command, self.path, body or None)
+            if not isinstance(content, bytes):
+                content = json.dumps(content).encode()
+            self.send_response(status)
+            if status != 200:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = _answer
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = "http://127.0.0.1:{}/".format(server.server_port)
+    monkeypatch.setattr(bm.utils, "brainmaps_url", url)
+    yield url
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,135 @@
+import asyncio
+
+import numpy as np
+import pytest
+import requests
+import trimesh
+
+import brainmappy as bm
+
+from brainmappy.scheduler import RequestScheduler
+
+from conftest import VOLUME
+
+aio = pytest.importorskip("brainmappy.aio")
+pytest.importorskip("aiohttp")
+
+
+def run(session, func, *args, scheduler=None, **kwargs):
+    """Run ``func(client, *args, **kwargs)`` on a fresh client (without cache)."""
+
+    async def main():
+        async with aio.AsyncClient(
+            session, max_connections=4, metadata_cache=False, scheduler=scheduler
+        ) as client:
+            return await func(client, *args, **kwargs)
+
+    return asyncio.run(main())
+
+
+def test_get_meshes_batch(api, api_server, session):
+    async def fetch(client, ids):
+        return await asyncio.gather(
+            *[client.get_meshes_batch(ob, volume_id=VOLUME) for ob in ids]
+        )
+
+    ids = [7919, 42, 249]
+    meshes = run(session, fetch, ids)
+
+    for ob, m in zip(ids, meshes):
+        expected = trimesh.Trimesh(*api.mesh(ob))
+        assert np.array_equal(m.vertices, expected.vertices)
+        assert np.array_equal(m.faces, expected.faces)
+
+
+def test_get_meshes_batch_cache(api, api_server, session, tmp_path):
+    cache = bm.FragmentCache(path=str(tmp_path))
+
+    async def fetch(client):
+        return await client.get_meshes_batch(7919, volume_id=VOLUME, cache=cache)
+
+    a = run(session, fetch)
+    api.reset()
+    b = run(session, fetch)
+
+    assert "meshes:batch" not in api.counts
+    assert np.array_equal(a.vertices, b.vertices)
+    assert np.array_equal(a.faces, b.faces)
+
+
+def test_get_seg_at_location(api, api_server, session):
+    voxels = np.random.default_rng(0).integers(0, 10_000, (1000, 3))
+
+    async def fetch(client):
+        return await client.get_seg_at_location(
+            voxels, volume_id=VOLUME, raw_coords=True
+        )
+
+    ids = run(session, fetch)
+    assert np.array_equal(np.asarray(ids, dtype=np.uint64), api.seg_ids(voxels))
+
+
+def test_get_seg_at_location_uint64(api, api_server, session):
+    api.seg_offset = 2**63
+    voxels = np.random.default_rng(0).integers(0, 10_000, (500, 3))
+
+    async def fetch(client):
+        return await client.get_seg_at_location(
+            voxels, volume_id=VOLUME, raw_coords=True
+        )
+
+    ids = run(session, fetch)
+    assert ids.dtype == np.uint64
+    assert np.array_equal(ids, api.seg_ids(voxels))
+
+
+def test_retries(api, api_server, session):
+    async def fetch(client):
+        return await client.get_volume_info(VOLUME)
+
+    sched = RequestScheduler(max_retries=2, backoff=0.001)
+
+    api.errors = [429, 503]
+    assert run(session, fetch, scheduler=sched)[0]["channelType"] == "UINT64"
+    assert sched.stats["retries"] == 2
+    assert sched.stats["throttled"] == 2
+
+    # Client errors are not retried
+    api.errors = [404]
+    with pytest.raises(aio.aiohttp.ClientResponseError):
+        run(session, fetch, scheduler=sched)
+    assert sched.stats["retries"] == 2
+
+    # Give up after ``max_retries``
+    api.errors = [500] * 3
+    with pytest.raises(aio.aiohttp.ClientResponseError):
+        run(session, fetch, scheduler=sched)
+    assert sched.stats["failed"] == 1
+
+
+def test_sessions(api, api_server, session):
+    async def fetch(client):
+        return await client.get_mesh_list(VOLUME)
+
+    # Plain sessions send requests without credentials
+    client = aio.AsyncClient(requests.Session())
+    assert client.credentials is None
+    assert asyncio.run(client._headers()) == {}
+    assert run(requests.Session(), fetch) == [{"name": "mesh"}, {"name": "mesh_lowres"}]
+
+    # Clients lend their credentials and scheduler
+    with bm.BrainmapsClient(session) as c:
+        client = aio.AsyncClient(c)
+        assert client.credentials is session.credentials
+        assert client.scheduler is c.scheduler
+
+
+def test_metadata_cache(api, api_server, session, tmp_path):
+    cache = bm.MetadataCache(path=str(tmp_path))
+
+    async def fetch():
+        async with aio.AsyncClient(session, metadata_cache=cache) as client:
+            return await client.get_volume_info(VOLUME)
+
+    assert asyncio.run(fetch()) == asyncio.run(fetch())
+    assert api.counts["volume_info"] == 1
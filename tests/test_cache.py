@@ -0,0 +1,312 @@
+import mmap
+
+import numpy as np
+import pytest
+
+import brainmappy as bm
+
+from conftest import VOLUME, encode_ng, make_client, make_fragments
+
+
+def test_fragment_cache(tmp_path):
+    cache = bm.FragmentCache(str(tmp_path))
+    frags = make_fragments(3)
+    cache.put(VOLUME, "mesh", encode_ng(frags))
+
+    keys = [(f[0], f[1]) for f in frags]
+    found = cache.get(VOLUME, "mesh", keys + [(1, "missing")])
+
+    assert set(found) == set(keys)
+    for f in frags:
+        assert bytes(found[(f[0], f[1])]) == encode_ng([f])
+
+    # Keyed by volume and meshes
+    assert cache.get("other", "mesh", keys) == {}
+    assert cache.get(VOLUME, "mesh_lowres", keys) == {}
+
+    # Release memory maps before clearing
+    found = None
+    cache.clear()
+    assert cache.get(VOLUME, "mesh", keys) == {}
+
+
+def test_fragment_cache_iter_decoded(tmp_path, monkeypatch):
+    cache = bm.FragmentCache(str(tmp_path))
+    frags = make_fragments(10)
+    cache.put(VOLUME, "mesh", encode_ng(frags))
+    keys = [(f[0], f[1]) for f in frags]
+
+    maps = []
+    mmap_ = mmap.mmap
+
+    def track(*args, **kwargs):
+        maps.append(mmap_(*args, **kwargs))
+        return maps[-1]
+
+    monkeypatch.setattr(mmap, "mmap", track)
+    batches = list(cache.iter_decoded(VOLUME, "mesh", keys, batch_size=4))
+
+    assert [len(b) for b in batches] == [4, 4, 2]
+    for f in frags:
+        verts, faces = next(b[f[:2]] for b in batches if f[:2] in b)
+        assert np.array_equal(verts, f[2]) and np.array_equal(faces, f[3])
+    # Memory maps are closed once decoded
+    assert len(maps) == 10 and all(m.closed for m in maps)
+
+
+def test_fragment_cache_out_of_maps(tmp_path, monkeypatch):
+    cache = bm.FragmentCache(str(tmp_path))
+    frags = make_fragments(3)
+    cache.put(VOLUME, "mesh", encode_ng(frags))
+
+    def fail(*args, **kwargs):
+        raise OSError(12, "Cannot allocate memory")
+
+    # Treated as cache misses
+    monkeypatch.setattr(mmap, "mmap", fail)
+    assert cache.get(VOLUME, "mesh", [(f[0], f[1]) for f in frags]) == {}
+
+
+def test_fragment_cache_meshes(api, session, tmp_path):
+    cache = bm.FragmentCache(str(tmp_path))
+    ob = 7919
+
+    a = bm.get_meshes_batch(ob, volume_id=VOLUME, session=session, cache=cache)
+    api.reset()
+    b = bm.get_meshes_batch(ob, volume_id=VOLUME, session=session, cache=cache)
+    c = bm.get_meshes_bulk([ob], volume_id=VOLUME, session=session, cache=cache)[ob]
+
+    # All fragments come from the cache the second time around
+    assert "meshes:batch" not in api.counts
+    for m in (b, c):
+        assert np.array_equal(a.vertices, m.vertices)
+        assert np.array_equal(a.faces, m.faces)
+
+
+def test_segmentation_memo(tmp_path):
+    memo = bm.SegmentationMemo(max_items=10, path=str(tmp_path / "memo.db"))
+    voxels = np.arange(60).reshape(-1, 3)
+    ids = np.arange(20, dtype=np.uint64) + np.uint64(2**63)
+
+    memo.update(VOLUME, None, voxels, ids)
+    found, seg_ids = memo.lookup(VOLUME, None, voxels)
+    assert found.all()
+    assert np.array_equal(seg_ids, ids)
+
+    # Change stacks are kept apart
+    found, _ = memo.lookup(VOLUME, "stack", voxels)
+    assert not found.any()
+
+    # Only 10 voxels stay in memory but the database has all of them
+    assert len(memo) == 10
+    found, seg_ids = bm.SegmentationMemo(path=memo.path).lookup(VOLUME, None, voxels)
+    assert found.all()
+    assert np.array_equal(seg_ids, ids)
+
+    memo.clear()
+    assert not memo.lookup(VOLUME, None, voxels)[0].any()
+
+
+def test_segmentation_memo_lru():
+    memo = bm.SegmentationMemo(max_items=100)
+    voxels = np.arange(300).reshape(-1, 3) - 150
+    ids = np.arange(100, dtype=np.uint64)
+    memo.update(VOLUME, None, voxels, ids)
+
+    # Voxels that were looked up are kept, the oldest others are dropped
+    memo.lookup(VOLUME, None, voxels[:10])
+    memo.update(VOLUME, "stack", voxels[:5], ids[:5])
+    found, seg_ids = memo.lookup(VOLUME, None, voxels)
+    assert len(memo) == 100
+    assert found[:10].all() and not found[10:15].any() and found[15:].all()
+    assert np.array_equal(seg_ids[found], ids[found])
+
+    # Updates replace existing entries - the last duplicate wins
+    memo.update(VOLUME, None, voxels[[20, 20]], [7, 8])
+    assert memo.lookup(VOLUME, None, voxels[[20]])[1].tolist() == [8]
+    assert len(memo) == 100
+
+    # Voxels too far out to be packed into keys are not kept in memory
+    far = np.array([[2**20, 0, 0], [0, -(2**20) - 1, 0]])
+    memo.update(VOLUME, None, far, [1, 2])
+    assert not memo.lookup(VOLUME, None, far)[0].any()
+
+
+def test_segmentation_memo_lookups(api, session):
+    memo = bm.SegmentationMemo()
+    voxels = np.random.default_rng(0).integers(0, 10_000, (500, 3))
+    # Duplicates are only queried once
+    voxels = np.vstack([voxels, voxels[:100]])
+
+    a = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, memo=memo, session=session
+    )
+    assert api.counts["locations"] == 500
+    api.reset()
+    b = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, memo=memo, session=session
+    )
+
+    assert np.array_equal(np.asarray(a, dtype=np.uint64), api.seg_ids(voxels))
+    assert np.array_equal(a, b)
+    assert "values" not in api.counts
+
+
+def test_chunk_cache(tmp_path):
+    cache = bm.SegmentationChunkCache(
+        chunk_size=(4, 4, 4), min_hits=3, max_chunks=2, path=str(tmp_path)
+    )
+    seg = np.arange(64, dtype=np.uint64).reshape(4, 4, 4) + np.uint64(2**63)
+    boxes = []
+
+    def fetch(b):
+        boxes.extend(b)
+        return [seg for _ in b]
+
+    # Two hits -> chunk is not fetched yet
+    voxels = np.array([[4, 5, 6], [7, 7, 7]])
+    found, _ = cache.lookup(VOLUME, None, voxels, fetch=fetch)
+    assert not found.any() and not boxes
+
+    # Third hit fetches the whole chunk
+    found, ids = cache.lookup(VOLUME, None, voxels[:1], fetch=fetch)
+    assert found.all()
+    assert [(c.tolist(), s.tolist()) for c, s in boxes] == [([4, 4, 4], [4, 4, 4])]
+    found, ids = cache.lookup(VOLUME, None, voxels)
+    assert found.all()
+    assert ids.tolist() == [seg[0, 1, 2], seg[3, 3, 3]]
+
+    # Change stacks and scales are kept apart
+    assert not cache.lookup(VOLUME, "stack", voxels)[0].any()
+    assert not cache.lookup(VOLUME, None, voxels, scale=1)[0].any()
+
+    # Chunks at the edge of the volume may be smaller
+    cache.put(VOLUME, None, (0, 0, 0), seg[:2])
+    found, ids = cache.lookup(VOLUME, None, [[1, 3, 3], [2, 0, 0]])
+    assert found.tolist() == [True, False]
+    assert ids[0] == seg[1, 3, 3]
+    with pytest.raises(ValueError):
+        cache.put(VOLUME, None, (0, 0, 0), np.zeros((5, 4, 4)))
+
+    # Only two chunks stay in memory but all of them are on disk
+    cache.put(VOLUME, None, (2, 0, 0), seg)
+    assert len(cache) == 2
+    other = bm.SegmentationChunkCache(chunk_size=(4, 4, 4), path=cache.path)
+    found, ids = other.lookup(VOLUME, None, voxels)
+    assert found.all()
+    assert ids.tolist() == [seg[0, 1, 2], seg[3, 3, 3]]
+
+    # Corrupted files are misses
+    with open(cache._filepath((VOLUME, "", 0, (2, 0, 0))), "wb") as f:
+        f.write(b"junk")
+    other = bm.SegmentationChunkCache(chunk_size=(4, 4, 4), path=cache.path)
+    assert not other.lookup(VOLUME, None, [[8, 0, 0]])[0].any()
+
+    cache.clear()
+    assert len(cache) == 0
+    assert not cache.lookup(VOLUME, None, voxels)[0].any()
+
+
+def test_chunk_cache_lookups(api, session):
+    cache = bm.SegmentationChunkCache(chunk_size=(32, 32, 8), min_hits=50)
+    # All in one chunk
+    voxels = np.random.default_rng(0).integers(0, [32, 32, 8], (500, 3))
+    voxels += [320, 640, 80]
+
+    a = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, chunk_cache=cache, session=session
+    )
+    assert np.array_equal(a, api.seg_ids(voxels))
+    assert api.counts["subvolume"] == 1
+
+    # Answered from the chunk without asking the server
+    api.reset()
+    b = bm.get_seg_at_location(
+        voxels[::-1],
+        volume_id=VOLUME,
+        raw_coords=True,
+        chunk_cache=cache,
+        session=session,
+    )
+    assert np.array_equal(b, a[::-1])
+    assert not api.counts
+
+
+def test_metadata_cache(tmp_path):
+    cache = bm.MetadataCache(path=str(tmp_path), ttl={"volumes": 0})
+    cache.put("volume_info", "url1", {"a": [1]}, volume_id="v1")
+    cache.put("volume_info", "url2", {"b": [2]}, volume_id="v2")
+    cache.put("volumes", "url3", ["v1", "v2"])
+
+    # Callers get copies
+    data = cache.get("volume_info", "url1")
+    data["a"].append(2)
+    assert cache.get("volume_info", "url1") == {"a": [1]}
+
+    # Entries survive restarts - except those that expired
+    other = bm.MetadataCache(path=str(tmp_path), ttl={"volumes": 0})
+    assert other.get("volume_info", "url2") == {"b": [2]}
+    assert other.get("volumes", "url3") is None
+    assert cache.get("volumes", "url3") is None
+
+    cache.invalidate("volume_info", volume_id="v1")
+    assert cache.get("volume_info", "url1") is None
+    assert bm.MetadataCache(path=str(tmp_path)).get("volume_info", "url1") is None
+    assert cache.get("volume_info", "url2") == {"b": [2]}
+
+    cache.clear()
+    assert bm.MetadataCache(path=str(tmp_path)).get("volume_info", "url2") is None
+
+
+def test_metadata_cache_memory(tmp_path):
+    cache = bm.MetadataCache(path=str(tmp_path), max_items=2)
+    for i in range(3):
+        cache.put("volume_info", "url{}".format(i), i)
+
+    # The two most recent entries are served from memory
+    for fp in tmp_path.glob("**/*.json"):
+        fp.unlink()
+    assert [cache.get("volume_info", "url{}".format(i)) for i in range(3)] == [
+        None,
+        1,
+        2,
+    ]
+
+
+def test_metadata_cache_no_disk(tmp_path, monkeypatch):
+    # Directory can't be created (e.g. read-only home)
+    (tmp_path / "file").touch()
+    with pytest.warns(UserWarning, match="in memory only"):
+        cache = bm.MetadataCache(path=str(tmp_path / "file" / "metadata"))
+    assert cache.path is None
+    cache.put("volumes", "url", ["v1"])
+    assert cache.get("volumes", "url") == ["v1"]
+    cache.invalidate("volumes")
+    assert cache.get("volumes", "url") is None
+
+    # Disk full
+    def full(fp, data):
+        raise OSError(28, "No space left on device")
+
+    cache = bm.MetadataCache(path=str(tmp_path / "metadata"))
+    monkeypatch.setattr(bm.cache, "_atomic_write", full)
+    cache.put("volumes", "url", ["v1"])
+    assert cache.get("volumes", "url") == ["v1"]
+
+
+def test_metadata_cache_client(api, tmp_path):
+    cache = bm.MetadataCache(path=str(tmp_path))
+    for _ in range(2):
+        with make_client(api, metadata_cache=cache) as client:
+            assert client.get_volumes() == [VOLUME]
+            client.get_volume_info(VOLUME)
+            client.get_mesh_list(VOLUME)
+    assert api.counts["volumes"] == 1
+    assert api.counts["volume_info"] == 1
+    assert api.counts["meshes"] == 1
+
+    # Caching can be disabled
+    with make_client(api, metadata_cache=False) as client:
+        assert client.metadata_cache is None
+        client.get_volumes()
+    assert api.counts["volumes"] == 2
@@ -0,0 +1,75 @@
+import gc
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+import brainmappy as bm
+
+from brainmappy import client as client_mod
+from conftest import VOLUME
+
+
+def test_client(api, client):
+    assert client.get_volumes() == [VOLUME]
+    assert client.get_mesh_list(VOLUME) == [{"name": "mesh"}, {"name": "mesh_lowres"}]
+    mesh = client.get_meshes_batch(7919, volume_id=VOLUME)
+    assert len(mesh.vertices)
+    # Requests share the client's scheduler
+    endpoints = ["volumes", "meshes", "listfragments", "meshes:batch"]
+    assert client.scheduler.stats["requests"] == sum(api.counts[e] for e in endpoints)
+
+
+def test_session_untouched(api, session):
+    retries = Retry(total=3)
+    session.mount("https://", HTTPAdapter(max_retries=retries))
+    session.proxies = {"http": "http://proxy.invalid"}
+    adapters = dict(session.adapters)
+
+    with bm.BrainmapsClient(session, max_threads=20) as c:
+        assert c.get_volumes() == [VOLUME]
+
+        # Client has its own, larger connection pool with the same retries
+        adapter = c.session.adapters["https://"]
+        assert adapter is not adapters["https://"]
+        assert adapter._pool_maxsize == 20
+        assert adapter.max_retries is retries
+        assert c.session.proxies == session.proxies
+        assert c.session.credentials is session.credentials
+
+    assert session.adapters == adapters
+
+
+def test_custom_adapter_kept():
+    class MyAdapter(HTTPAdapter):
+        pass
+
+    session = requests.Session()
+    adapter = MyAdapter()
+    session.mount("https://", adapter)
+
+    c = bm.BrainmapsClient(session)
+    assert c.session.adapters["https://"] is adapter
+
+
+def test_default_client(api, session):
+    assert bm.get_volumes(session=session) == [VOLUME]
+    client = client_mod._eval_client(session)
+    assert client_mod._eval_client(session) is client
+    assert client_mod._eval_client(client) is client
+
+
+def test_default_clients_released():
+    gc.collect()
+    n = len(client_mod._default_clients)
+    session = requests.Session()
+    c = client_mod._eval_client(session)
+    pool = c.scheduler.pool
+
+    del session, c
+    gc.collect()
+
+    assert len(client_mod._default_clients) == n
+    # Client was closed
+    assert pool._shutdown
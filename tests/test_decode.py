@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import trimesh
+
+import brainmappy as bm
+from brainmappy.decode import imap_decode
+from brainmappy.io import _decode_raw_ng
+
+from conftest import VOLUME, encode_ng, make_fragments
+
+
+@pytest.fixture(scope="module")
+def pool():
+    # Decode everything in the worker processes
+    with bm.DecodePool(processes=2, min_size=0) as pool:
+        yield pool
+
+
+def assert_decoded_equal(a, b):
+    for x, y in zip(a, b):
+        if isinstance(x, dict):
+            assert x.keys() == y.keys()
+            for k in x:
+                np.testing.assert_array_equal(x[k], y[k])
+        else:
+            np.testing.assert_array_equal(x, y)
+
+
+def test_decode_pool(pool):
+    data = encode_ng(make_fragments(50))
+    expected = _decode_raw_ng(data)
+
+    assert_decoded_equal(pool.submit(data).result(), expected)
+
+    # Small payloads are decoded inline
+    inline = bm.DecodePool(processes=2)
+    assert_decoded_equal(inline.submit(data).result(), expected)
+    assert inline._executor is None
+
+
+def test_decode_pool_error(pool):
+    data = encode_ng(make_fragments(5))
+
+    with pytest.raises(ValueError):
+        pool.submit(data[:-10]).result()
+
+    # Pool is still usable
+    assert_decoded_equal(pool.submit(data).result(), _decode_raw_ng(data))
+
+
+@pytest.mark.parametrize("use_pool", [False, True])
+def test_imap_decode(pool, use_pool):
+    payloads = [encode_ng(make_fragments(20, seed=i)) for i in range(10)]
+
+    out = dict(imap_decode(enumerate(payloads), pool=pool if use_pool else None))
+
+    assert sorted(out) == list(range(10))
+    for i, data in enumerate(payloads):
+        assert_decoded_equal(out[i], _decode_raw_ng(data))
+
+
+def test_get_meshes_batch_processes(api, session, pool):
+    ob = 7919
+    m = bm.get_meshes_batch(ob, volume_id=VOLUME, session=session, processes=pool)
+
+    expected = trimesh.Trimesh(*api.mesh(ob))
+    assert np.array_equal(m.vertices, expected.vertices)
+    assert np.array_equal(m.faces, expected.faces)
+
+
+def test_get_meshes_bulk_processes(api, session, pool):
+    object_ids = [7919, 42, 2 * 7919]
+    meshes = bm.get_meshes_bulk(
+        object_ids, volume_id=VOLUME, session=session, processes=pool
+    )
+
+    for ob in object_ids:
+        expected = trimesh.Trimesh(*api.mesh(ob))
+        assert np.array_equal(meshes[ob].vertices, expected.vertices)
+        assert np.array_equal(meshes[ob].faces, expected.faces)
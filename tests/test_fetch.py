@@ -0,0 +1,249 @@
+import numpy as np
+import pytest
+import requests
+import trimesh
+
+import brainmappy as bm
+
+from conftest import VOLUME
+
+
+def test_get_meshes_batch(api, session):
+    # 170 fragments -> two batches
+    ob = 7919
+    m = bm.get_meshes_batch(ob, volume_id=VOLUME, session=session, max_threads=4)
+
+    expected = trimesh.Trimesh(*api.mesh(ob))
+    assert api.counts["meshes:batch"] == 2
+    assert np.array_equal(m.vertices, expected.vertices)
+    assert np.array_equal(m.faces, expected.faces)
+
+
+def test_get_meshes_batch_failed(api, session):
+    # Mesh list and fragments are fine, first batch fails (and isn't retried)
+    api.errors = [None, None, 404]
+
+    with pytest.raises(requests.HTTPError):
+        bm.get_meshes_batch(7919, volume_id=VOLUME, session=session)
+
+
+def test_get_meshes_bulk(api, session):
+    object_ids = [7919, 42, 2 * 7919, 3000]
+
+    # Duplicates are dropped
+    with pytest.warns(UserWarning, match="No fragments found for 1 object"):
+        meshes = bm.get_meshes_bulk(
+            object_ids + [42], volume_id=VOLUME, session=session, max_threads=4
+        )
+
+    assert list(meshes) == object_ids
+    # Object without fragments
+    assert meshes[3000] is None
+    for ob in object_ids[:3]:
+        expected = trimesh.Trimesh(*api.mesh(ob))
+        assert np.array_equal(meshes[ob].vertices, expected.vertices)
+        assert np.array_equal(meshes[ob].faces, expected.faces)
+
+    # Fragments of all objects are packed into shared batches
+    n = sum(len(api.fragments(ob)) for ob in object_ids)
+    assert api.counts["fragments"] == n
+    assert api.counts["meshes:batch"] == -(-n // 100)
+
+
+@pytest.mark.parametrize("chunking", ["morton", "grid", "kmeans"])
+def test_get_seg_at_location(api, session, chunking):
+    voxels = np.random.default_rng(0).integers(0, 10_000, (1000, 3))
+
+    ids = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, session=session, chunking=chunking
+    )
+
+    assert np.array_equal(np.asarray(ids, dtype=np.uint64), api.seg_ids(voxels))
+
+
+def test_get_seg_at_location_uint64(api, session):
+    # IDs >= 2**63 must survive the round trip
+    api.seg_offset = 2**63
+    voxels = np.random.default_rng(0).integers(0, 10_000, (500, 3))
+
+    ids = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, session=session
+    )
+
+    assert ids.dtype == np.uint64
+    assert np.array_equal(ids, api.seg_ids(voxels))
+    assert (ids >= 2**63).all()
+
+
+@pytest.mark.parametrize("block_size", [None, 300])
+def test_iter_seg_at_location(api, session, block_size):
+    voxels = np.random.default_rng(0).integers(0, 10_000, (1000, 3))
+    memo = bm.SegmentationMemo()
+    memo.update(VOLUME, None, voxels[:10], api.seg_ids(voxels[:10]))
+
+    ids = np.zeros(len(voxels), dtype=np.uint64)
+    seen = np.zeros(len(voxels), dtype=int)
+    for ix, seg_ids in bm.iter_seg_at_location(
+        voxels,
+        volume_id=VOLUME,
+        raw_coords=True,
+        session=session,
+        block_size=block_size,
+        memo=memo,
+    ):
+        ids[ix] = seg_ids
+        seen[ix] += 1
+
+    assert (seen == 1).all()
+    assert np.array_equal(ids, api.seg_ids(voxels))
+
+
+def test_iter_seg_at_location_generator(api, session):
+    # Blocks are pulled from the input iterable lazily
+    rng = np.random.default_rng(0)
+    blocks = [rng.integers(0, 10_000, (200, 3)) for _ in range(5)]
+    pulled = []
+
+    def gen():
+        for b in blocks:
+            pulled.append(len(b))
+            yield b
+
+    it = bm.iter_seg_at_location(
+        gen(), volume_id=VOLUME, raw_coords=True, session=session, max_threads=1
+    )
+    ix, seg_ids = next(it)
+    assert len(pulled) < len(blocks)
+
+    ids = np.zeros(1000, dtype=np.uint64)
+    ids[ix] = seg_ids
+    for ix, seg_ids in it:
+        ids[ix] = seg_ids
+    assert np.array_equal(ids, api.seg_ids(np.vstack(blocks)))
+
+
+def expected_seg(api, lo, hi):
+    grid = np.meshgrid(*[np.arange(a, b) for a, b in zip(lo, hi)], indexing="ij")
+    return api.seg_ids(np.stack(grid, axis=-1).reshape(-1, 3)).reshape(
+        np.subtract(hi, lo)
+    )
+
+
+def test_get_seg_in_bbox(api, session):
+    lo, hi = (95, 1003, 7), (130, 1020, 12)
+    seg = bm.get_seg_in_bbox(
+        [lo, hi],
+        volume_id=VOLUME,
+        raw_coords=True,
+        chunk_size=(16, 16, 4),
+        session=session,
+    )
+
+    assert seg.shape == (35, 17, 5)
+    assert seg.dtype == np.uint64
+    assert seg.flags.f_contiguous
+    np.testing.assert_array_equal(seg, expected_seg(api, lo, hi))
+    # 3 x 2 x 2 chunks
+    assert api.counts["subvolume"] == 12
+
+
+def test_get_seg_in_bbox_nm(api, session):
+    # Pixel size is 4 x 4 x 40 nm
+    seg = bm.get_seg_in_bbox(
+        [[400, 4000, 400], [480, 4040, 800]], volume_id=VOLUME, session=session
+    )
+
+    np.testing.assert_array_equal(
+        seg, expected_seg(api, (100, 1000, 10), (120, 1010, 20))
+    )
+
+    with pytest.raises(ValueError):
+        bm.get_seg_in_bbox([[0, 0, 0], [0, 10, 10]], volume_id=VOLUME, session=session)
+
+
+def test_get_seg_in_bbox_out(api, session, tmp_path):
+    lo, hi = (0, 0, 0), (20, 30, 10)
+    expected = expected_seg(api, lo, hi)
+
+    out = np.zeros((20, 30, 10), dtype=np.uint64)
+    seg = bm.get_seg_in_bbox(
+        [lo, hi], volume_id=VOLUME, raw_coords=True, session=session, out=out
+    )
+    assert seg is out
+    np.testing.assert_array_equal(out, expected)
+
+    with pytest.raises(ValueError, match="shape"):
+        bm.get_seg_in_bbox(
+            [lo, hi], volume_id=VOLUME, raw_coords=True, session=session, out=out[1:]
+        )
+
+    # Memory-mapped .npy file
+    fp = str(tmp_path / "seg.npy")
+    seg = bm.get_seg_in_bbox(
+        [lo, hi],
+        volume_id=VOLUME,
+        raw_coords=True,
+        chunk_size=(8, 8, 8),
+        session=session,
+        out=fp,
+    )
+    assert isinstance(seg, np.memmap)
+    del seg
+    np.testing.assert_array_equal(np.load(fp), expected)
+
+
+def test_iter_meshes_progressive(api, session):
+    ob = 7919
+    meshes = list(
+        bm.iter_meshes_progressive(
+            ob, volume_id=VOLUME, session=session, return_type="mesh"
+        )
+    )
+
+    # Coarse to fine, i.e. the reverse of the mesh list
+    assert [name for name, _ in meshes] == ["mesh_lowres", "mesh"]
+    for name, m in meshes:
+        verts, faces = api.mesh(ob, name)
+        assert np.array_equal(m.vertices, verts)
+        assert np.array_equal(m.faces, faces)
+    assert api.counts["fragments"] == len(api.fragments(ob)[::4]) + len(
+        api.fragments(ob)
+    )
+
+    # Explicit levels of detail, object without fragments
+    meshes = list(
+        bm.iter_meshes_progressive(3000, lods=[1], volume_id=VOLUME, session=session)
+    )
+    assert meshes == [("mesh_lowres", None)]
+
+
+def test_iter_meshes_progressive_stop(api, client):
+    # Stopping early doesn't wait for (or raise from) finer levels
+    api.errors = [None] * 4 + [404] * 10
+    it = client.iter_meshes_progressive(7, volume_id=VOLUME, return_type="arrays")
+    name, (verts, faces) = next(it)
+    it.close()
+
+    assert name == "mesh_lowres"
+    assert np.array_equal(verts, api.mesh(7, "mesh_lowres")[0])
+
+
+def test_get_meshes_progressive(api, client):
+    received = []
+    future = client.get_meshes_progressive(
+        7919, lambda name, m: received.append((name, m)), volume_id=VOLUME
+    )
+
+    final = future.result(timeout=10)
+    assert [name for name, _ in received] == ["mesh_lowres", "mesh"]
+    assert final is received[-1][1]
+    expected = trimesh.Trimesh(*api.mesh(7919))
+    assert np.array_equal(final.vertices, expected.vertices)
+
+    # Errors are delivered through the future
+    api.errors = [404]
+    future = client.get_meshes_progressive(
+        7919, lambda name, m: None, volume_id=VOLUME, lods=[0]
+    )
+    with pytest.raises(requests.HTTPError):
+        future.result(timeout=10)
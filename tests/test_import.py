@@ -0,0 +1,23 @@
+import subprocess
+import sys
+
+# Imported on first use only
+LAZY = [
+    "trimesh",
+    "pandas",
+    "scipy",
+    "tqdm",
+    "google.auth",
+    "google_auth_oauthlib",
+    "aiohttp",
+]
+
+
+def test_lazy_imports():
+    code = "import sys, brainmappy; print(' '.join(sorted(sys.modules)))"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.split()
+
+    assert "brainmappy" in out
+    assert [m for m in LAZY if m in out] == []
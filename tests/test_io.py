@@ -0,0 +1,99 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+import brainmappy as bm
+
+from conftest import VOLUME, encode_ng, make_fragments
+
+
+def test_parse_raw_ng():
+    frags = make_fragments(5)
+
+    ob, filenames, verts, faces = bm.parse_raw_ng(encode_ng(frags))
+
+    assert ob == str(frags[-1][0])
+    assert filenames == [f[1] for f in frags]
+    assert verts.dtype == np.float32 and faces.dtype == np.uint32
+    assert np.array_equal(verts, np.vstack([f[2] for f in frags]))
+
+    # Faces are offset to index into the combined vertices
+    offset = 0
+    expected = []
+    for f in frags:
+        expected.append(f[3] + offset)
+        offset += len(f[2])
+    assert np.array_equal(faces, np.vstack(expected))
+
+
+def test_parse_raw_ng_roundtrip():
+    frags = make_fragments(3, seed=1)
+    data = encode_ng(frags)
+
+    # Bytes, memoryviews and file-likes give the same result
+    a = bm.parse_raw_ng(data)
+    b = bm.parse_raw_ng(memoryview(data))
+    c = bm.parse_raw_ng(io.BytesIO(data))
+    for x, y in ((a, b), (a, c)):
+        assert x[0] == y[0] and x[1] == y[1]
+        assert np.array_equal(x[2], y[2]) and np.array_equal(x[3], y[3])
+
+    # Re-encoding the parsed mesh as a single fragment gives the same mesh
+    ob, _, verts, faces = a
+    d = bm.parse_raw_ng(encode_ng([(int(ob), "all", verts, faces)]))
+    assert np.array_equal(d[2], verts) and np.array_equal(d[3], faces)
+
+
+def test_parse_raw_ng_empty():
+    ob, filenames, verts, faces = bm.parse_raw_ng(b"")
+
+    assert ob is None
+    assert len(filenames) == 0
+    assert verts.shape == (0, 3) and faces.shape == (0, 3)
+
+
+@pytest.mark.parametrize("cut", [5, 20, 40, -1])
+def test_parse_raw_ng_truncated(cut):
+    data = encode_ng(make_fragments(2))
+    # Cut off in the second fragment's header (5, 20) or in a payload
+    first = len(encode_ng(make_fragments(1)))
+
+    with pytest.raises(ValueError, match="Truncated mesh data"):
+        bm.parse_raw_ng(data[: first + cut] if cut > 0 else data[:cut])
+
+
+def test_get_ng_meshes(api, api_server, tmp_path):
+    # cURLs as copied from the browser: one single-fragment batch each
+    frags = api.fragments(7)
+    curls = tmp_path / "curls.txt"
+    with open(curls, "w") as f:
+        for sv, key in frags:
+            body = json.dumps(
+                dict(
+                    volumeId=VOLUME,
+                    meshName="mesh",
+                    batches=[{"object_id": sv, "fragment_keys": [key]}],
+                )
+            )
+            f.write(
+                "curl '{}v1/objects/meshes:batch' -H 'content-type: application/json'"
+                " --data-binary '{}'\n".format(api_server, body)
+            )
+
+    # The cURL's JSON body must be sent as JSON (not form-encoded)
+    data = bm.get_ng_meshes(str(curls))
+
+    assert api.counts["meshes:batch"] == len(frags)
+    assert sorted(int(ob) for ob in data) == sorted({int(sv) for sv, _ in frags})
+
+    # Each object combines its responses in the order of the cURLs
+    for sv, d in data.items():
+        keys = [k for s, k in frags if s == sv]
+        verts = [api.fragment(k)[0] for k in keys]
+        offsets = np.cumsum([0] + [len(v) for v in verts[:-1]])
+        faces = [api.fragment(k)[1] + n for k, n in zip(keys, offsets)]
+        assert len(d["fragments"]) == len(keys)
+        np.testing.assert_array_equal(d["verts"], np.vstack(verts))
+        np.testing.assert_array_equal(d["faces"], np.vstack(faces))
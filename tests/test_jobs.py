@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pytest
+import requests
+import trimesh
+
+import brainmappy as bm
+from brainmappy import cli, jobs
+
+from conftest import VOLUME, make_session
+
+
+def test_checkpoint(tmp_path):
+    fp = str(tmp_path / "sub" / "job.log")
+    cp = bm.Checkpoint(fp)
+    cp.mark([1, 2])
+    cp.mark([])
+    assert 1 in cp and 3 not in cp
+
+    # Partially written last line is dropped
+    with open(fp, "a") as f:
+        f.write("3")
+    cp = bm.Checkpoint(fp)
+    assert len(cp) == 2
+    assert cp.todo([3, 2, 1, 4]) == [3, 4]
+    cp.mark([3])
+    assert bm.Checkpoint(fp).done == {"1", "2", "3"}
+
+
+def test_export_meshes(api, session, tmp_path):
+    object_ids = [7919, 42, 2 * 7919, 3000, 11]
+    out = str(tmp_path / "meshes")
+
+    # First batch makes 6 requests (mesh list, 2 fragment lists, 3 batches),
+    # then the second batch fails
+    api.errors = [None] * 6 + [404]
+    with pytest.raises(requests.HTTPError):
+        bm.export_meshes(
+            object_ids, out, batch_size=2, volume_id=VOLUME, session=session
+        )
+    assert bm.Checkpoint(os.path.join(out, "checkpoint.log")).done == {"7919", "42"}
+
+    # Resuming only fetches the rest
+    api.reset()
+    with pytest.warns(UserWarning, match="No fragments found for 1 object"):
+        store = bm.export_meshes(
+            object_ids, out, batch_size=2, volume_id=VOLUME, session=session
+        )
+    n = sum(len(api.fragments(ob)) for ob in object_ids[2:])
+    assert api.counts["fragments"] == n
+
+    for ob in [7919, 42, 2 * 7919, 11]:
+        # Fragments are written in the order they arrive
+        verts, faces = store[ob]
+        expected = trimesh.Trimesh(*api.mesh(ob), process=False)
+        mesh = trimesh.Trimesh(verts, faces, process=False)
+        assert np.allclose(mesh.area, expected.area)
+        assert len(verts) == len(expected.vertices)
+    store.close()
+
+    # Nothing left to do
+    api.reset()
+    bm.export_meshes(object_ids, out, volume_id=VOLUME, session=session).close()
+    assert not api.counts
+
+
+def test_export_seg(api, session, tmp_path):
+    rng = np.random.default_rng(0)
+    coords = [rng.integers(0, 10_000, (n, 3)) for n in (300, 50, 20)]
+    files = [str(tmp_path / "a" / "pts.npy"), str(tmp_path / "b" / "pts.csv")]
+    os.makedirs(tmp_path / "a")
+    os.makedirs(tmp_path / "b")
+    np.save(files[0], coords[0])
+    np.savetxt(files[1], coords[1], delimiter=",", header="x,y,z", comments="")
+    out = str(tmp_path / "seg")
+
+    # Same name -> would overwrite each other without root
+    with pytest.raises(ValueError, match="both be written"):
+        bm.export_seg(files, out, volume_id=VOLUME, session=session)
+
+    outputs = bm.export_seg(
+        files,
+        out,
+        volume_id=VOLUME,
+        raw_coords=True,
+        root=str(tmp_path),
+        session=session,
+    )
+    assert outputs == [
+        os.path.join(out, "a", "pts.seg.npy"),
+        os.path.join(out, "b", "pts.seg.npy"),
+    ]
+    for fp, c in zip(outputs, coords):
+        assert np.array_equal(np.load(fp), api.seg_ids(c))
+
+    # Completed files are skipped
+    files.append(str(tmp_path / "c.txt"))
+    np.savetxt(files[2], coords[2])
+    api.reset()
+    outputs = bm.export_seg(
+        files,
+        out,
+        volume_id=VOLUME,
+        raw_coords=True,
+        root=str(tmp_path),
+        session=session,
+    )
+    assert api.counts["locations"] == 20
+    assert np.array_equal(np.load(outputs[2]), api.seg_ids(coords[2]))
+
+    # Bad coordinates
+    np.save(files[0], coords[0][:, :2])
+    with pytest.raises(ValueError, match="Expected"):
+        bm.export_seg(files[:1], str(tmp_path / "other"), session=session)
+
+
+def test_read_manifest(tmp_path):
+    fp = tmp_path / "ids.txt"
+    fp.write_text("# header\n1, 2\n\n3 4\n5\n")
+
+    assert jobs.read_manifest(str(fp)) == ["1", "2", "3", "4", "5"]
+
+
+def test_cli(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        bm.auth, "acquire_credentials", lambda **kwargs: make_session(api)
+    )
+
+    (tmp_path / "ids.txt").write_text("42\n11\n")
+    args = ["--volume", VOLUME, "--quiet", "meshes", str(tmp_path / "ids.txt")]
+    assert cli.main(args + [str(tmp_path / "meshes")]) == 0
+    with bm.MeshStore(str(tmp_path / "meshes"), mode="r") as store:
+        assert sorted(store) == [11, 42]
+
+    # Coordinate files are relative to the manifest
+    coords = np.random.default_rng(0).integers(0, 10_000, (100, 3))
+    os.makedirs(tmp_path / "pts")
+    np.save(tmp_path / "pts" / "a.npy", coords)
+    (tmp_path / "files.txt").write_text("pts/a.npy\n")
+
+    args = ["--volume", VOLUME, "seg", str(tmp_path / "files.txt")]
+    assert cli.main(args + [str(tmp_path / "seg"), "--raw-coords"]) == 0
+    ids = np.load(tmp_path / "seg" / "pts" / "a.seg.npy")
+    assert np.array_equal(ids, api.seg_ids(coords))
@@ -0,0 +1,155 @@
+import asyncio
+
+import numpy as np
+import pytest
+import trimesh
+
+import brainmappy as bm
+
+from brainmappy import mesh as mesh_mod
+from conftest import VOLUME
+
+
+def seam_mesh():
+    """Two fragments that share two vertices (duplicated in each fragment)."""
+    a = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float32)
+    b = np.array([[1, 0, 0], [0, 1, 0], [1, 1, 0]], dtype=np.float32)
+    verts = np.vstack([a, b])
+    faces = np.array([[0, 1, 2], [3, 5, 4]], dtype=np.uint32)
+    return verts, faces
+
+
+def test_weld_vertices():
+    verts, faces = seam_mesh()
+    new_verts, new_faces = bm.weld_vertices(verts, faces)
+
+    assert new_verts.tolist() == [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]]
+    assert new_faces.tolist() == [[0, 1, 2], [1, 3, 2]]
+    assert new_faces.dtype == faces.dtype
+    # Same triangles as before
+    assert np.array_equal(new_verts[new_faces], verts[faces])
+
+
+def test_weld_vertices_tolerance():
+    verts, faces = seam_mesh()
+    verts[3] += 1e-4
+    verts[4] = -0.0
+
+    # -0.0 == 0.0 but 1 + 1e-4 != 1
+    assert len(bm.weld_vertices(verts, faces)[0]) == 5
+    assert len(bm.weld_vertices(verts, faces, tolerance=0.01)[0]) == 4
+
+
+def test_weld_vertices_collisions(monkeypatch):
+    # All vertices have the same hash - must fall back to comparing rows
+    monkeypatch.setattr(mesh_mod, "_HASH_PRIMES", np.zeros(3, dtype=np.int64))
+    verts, faces = seam_mesh()
+    new_verts, new_faces = bm.weld_vertices(verts, faces)
+    assert len(new_verts) == 4
+    assert np.array_equal(new_verts[new_faces], verts[faces])
+
+
+def test_weld_vertices_empty():
+    verts, faces = bm.weld_vertices(np.zeros((0, 3)), np.zeros((0, 3), dtype=int))
+    assert verts.shape == (0, 3) and faces.shape == (0, 3)
+
+
+def test_mesh():
+    verts, faces = seam_mesh()
+    m = bm.Mesh(verts, faces)
+
+    v, f = m
+    assert v is m.vertices and f is m.faces
+    assert m.bounds.tolist() == [[0, 0, 0], [1, 1, 0]]
+    assert len(m.weld().vertices) == 4
+    assert len(m.to_trimesh(process=False).vertices) == 6
+    assert bm.Mesh(np.zeros((0, 3)), np.zeros((0, 3))).bounds is None
+
+
+def test_return_type(api, session):
+    expected = api.mesh(7919)
+
+    m = bm.get_meshes_batch(7919, volume_id=VOLUME, session=session, return_type="mesh")
+    assert isinstance(m, bm.Mesh)
+    assert np.array_equal(m.vertices, expected[0])
+    assert np.array_equal(m.faces, expected[1])
+
+    verts, faces = bm.get_meshes_batch(
+        7919, volume_id=VOLUME, session=session, return_type="arrays"
+    )
+    assert np.array_equal(verts, expected[0])
+
+    m = bm.get_meshes_batch(7919, volume_id=VOLUME, session=session)
+    assert isinstance(m, trimesh.Trimesh)
+
+    meshes = bm.get_meshes_bulk(
+        [7919, 42], volume_id=VOLUME, session=session, return_type="mesh"
+    )
+    assert all(isinstance(m, bm.Mesh) for m in meshes.values())
+    assert np.array_equal(meshes[42].faces, api.mesh(42)[1])
+
+    with pytest.raises(ValueError):
+        bm.get_meshes_batch(7919, volume_id=VOLUME, session=session, return_type="x")
+
+
+def test_return_type_aio(api, api_server, session):
+    aio = pytest.importorskip("brainmappy.aio")
+    pytest.importorskip("aiohttp")
+
+    async def fetch():
+        async with aio.AsyncClient(session, metadata_cache=False) as client:
+            return await client.get_meshes_batch(
+                42, volume_id=VOLUME, return_type="arrays"
+            )
+
+    verts, faces = asyncio.run(fetch())
+    assert np.array_equal(verts, api.mesh(42)[0])
+    assert np.array_equal(faces, api.mesh(42)[1])
+
+
+def test_refresh_meshes(api, session, monkeypatch):
+    object_ids = [7919, 42, 11]
+    meshes = bm.get_meshes_bulk(
+        object_ids, volume_id=VOLUME, session=session, return_type="mesh"
+    )
+
+    # Proofreading: 7919 loses and gains fragments, 11 is merged away
+    fragments = api.fragments
+
+    def edited(object_id):
+        frags = fragments(object_id)
+        if int(object_id) == 7919:
+            return frags[5:] + [("7919999", "7919:new"), ("7919998", "7919:new2")]
+        if int(object_id) == 11:
+            return []
+        return frags
+
+    monkeypatch.setattr(api, "fragments", edited)
+    api.reset()
+    refreshed = bm.refresh_meshes(meshes, volume_id=VOLUME, session=session)
+
+    # Only new fragments are downloaded
+    assert api.counts["fragments"] == 2
+    assert refreshed[42] is meshes[42]
+    assert refreshed[11] is None
+
+    # Same as fetching from scratch
+    expected = bm.get_meshes_bulk(
+        [7919], volume_id=VOLUME, session=session, return_type="mesh"
+    )[7919]
+    m = refreshed[7919]
+    assert np.array_equal(m.vertices, expected.vertices)
+    assert np.array_equal(m.faces, expected.faces)
+    assert list(m.fragments) == list(expected.fragments)
+
+    # Refreshed meshes can be refreshed again
+    api.reset()
+    refreshed = {ob: m for ob, m in refreshed.items() if m is not None}
+    again = bm.refresh_meshes(refreshed, volume_id=VOLUME, session=session)
+    assert again[7919] is m
+    assert "meshes:batch" not in api.counts
+
+    with pytest.raises(ValueError, match="return_type='mesh'"):
+        bm.refresh_meshes(
+            {42: meshes[42].to_trimesh()}, volume_id=VOLUME, session=session
+        )
@@ -0,0 +1,97 @@
+import pytest
+import requests
+
+import brainmappy as bm
+
+from brainmappy import metrics
+from conftest import VOLUME, make_client
+
+
+@pytest.fixture
+def registry():
+    metrics.registry.reset()
+    metrics.enable()
+    yield metrics.registry
+    metrics.disable()
+    metrics.registry.reset()
+
+
+def values(registry, name):
+    """Return ``{labels: value}`` for given metric."""
+    return {
+        tuple(sorted(v["labels"].items())): v["value"]
+        for v in registry.to_dict().get(name, [])
+    }
+
+
+def test_disabled(api, session):
+    metrics.registry.reset()
+    bm.get_meshes_batch(7919, volume_id=VOLUME, session=session)
+    assert metrics.registry.to_dict() == {}
+
+
+def test_fetch(api, registry, tmp_path):
+    api.errors = [None, None, 429]
+    cache = bm.FragmentCache(str(tmp_path))
+    with make_client(api) as client:
+        for _ in range(2):
+            client.get_meshes_batch(7919, volume_id=VOLUME, cache=cache)
+
+    requests_ = values(registry, "request_seconds")
+    assert requests_[(("endpoint", "listfragments"), ("status", "200"))]["count"] == 2
+    assert requests_[(("endpoint", "meshes:batch"), ("status", "429"))]["count"] == 1
+    assert values(registry, "throttled_total") == {(("endpoint", "meshes:batch"),): 1}
+    assert values(registry, "retries_total") == {(("endpoint", "meshes:batch"),): 1}
+
+    n = len(api.fragments(7919))
+    hits = values(registry, "cache_hits_total")
+    misses = values(registry, "cache_misses_total")
+    assert sum(hits.values()) == n and sum(misses.values()) == n
+
+    stages = {k[0][1] for k in values(registry, "stage_seconds")}
+    assert {"ng_decode", "assemble", "cache_read", "cache_write"} <= stages
+
+
+def test_to_prometheus_mixed_status(api, session, registry):
+    url = bm.utils.brainmaps_url
+
+    # Success, error status and connection error
+    metrics.request(session, "GET", url + "v1/volumes")
+    metrics.request(session, "GET", url + "v1/unknown")
+    with pytest.raises(requests.ConnectionError):
+        metrics.request(requests.Session(), "GET", "http://127.0.0.1:9/v1/volumes")
+
+    text = registry.to_prometheus()
+
+    assert 'endpoint="volumes",status="200",le="+Inf"} 1' in text
+    assert 'endpoint="unknown",status="404",le="+Inf"} 1' in text
+    assert 'endpoint="volumes",status="ConnectionError",le="+Inf"} 1' in text
+    assert 'brainmappy_errors_total{endpoint="volumes"} 1' in text
+    assert 'brainmappy_requests_in_flight{endpoint="volumes"} 0' in text
+
+
+def test_registry_labels():
+    reg = metrics.Registry(prefix="test_")
+    reg.observe("latency", 0.002, status=200)
+    reg.observe("latency", 0.2, status="200")
+    reg.observe("latency", 1, status="Timeout")
+    reg.inc("count", kind=1)
+    reg.inc("count", kind="1")
+
+    # Label values are compared as strings
+    assert reg.to_dict()["count"] == [dict(labels={"kind": "1"}, value=2)]
+
+    lines = reg.to_prometheus().splitlines()
+    assert "# TYPE test_latency histogram" in lines
+    assert 'test_latency_count{status="200"} 2' in lines
+    assert 'test_latency_count{status="Timeout"} 1' in lines
+    assert 'test_latency_bucket{status="200",le="0.005"} 1' in lines
+
+
+def test_endpoint_name():
+    url = bm.utils.brainmaps_url
+    assert metrics.endpoint_name(url + "v1/objects/meshes:batch") == "meshes:batch"
+    assert metrics.endpoint_name(url + "v1/objects/v/meshes/m:listfragments?x=1") == (
+        "listfragments"
+    )
+    assert metrics.endpoint_name(url + "v1/volumes/v/values") == "values"
@@ -0,0 +1,192 @@
+import collections
+import threading
+import time
+
+import numpy as np
+import pytest
+import requests
+
+import brainmappy as bm
+
+from brainmappy import scheduler
+
+from conftest import VOLUME, make_client
+
+
+class FakeSession:
+    """Records concurrency (per URL prefix) and answers with given status codes."""
+
+    def __init__(self, statuses=(), latency=0.01):
+        self.statuses = list(statuses)
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.peak = collections.Counter()
+        self._prefix = collections.Counter()
+        self.kwargs = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.kwargs.append(kwargs)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            prefix = url.split("/")[0]
+            self._prefix[prefix] += 1
+            self.peak[prefix] = max(self.peak[prefix], self._prefix[prefix])
+            status = self.statuses.pop(0) if self.statuses else 200
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+            self._prefix[prefix] -= 1
+
+        if status is None:
+            raise requests.ConnectionError("dropped")
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers["Retry-After"] = "0"
+        resp._content = url.encode()
+        return resp
+
+
+def requests_for(n, prefix="url"):
+    return [(i, "GET", "{}/{}".format(prefix, i), {}) for i in range(n)]
+
+
+def test_imap():
+    session = FakeSession()
+    sched = scheduler.RequestScheduler(max_concurrency=4)
+
+    results = dict(sched.imap(session, requests_for(50)))
+
+    assert sorted(results) == list(range(50))
+    assert all(r.content == "url/{}".format(i).encode() for i, r in results.items())
+    assert 1 < session.max_in_flight <= 4
+    assert sched.stats["requests"] == 50
+    assert sched.stats["retries"] == 0
+    # Requests get the default timeout unless they set their own
+    assert all(kw["timeout"] == sched.timeout for kw in session.kwargs)
+
+
+def test_imap_lazy():
+    sched = scheduler.RequestScheduler(max_concurrency=2)
+    pulled = []
+
+    def gen():
+        for r in requests_for(100):
+            pulled.append(r)
+            yield r
+
+    it = sched.imap(FakeSession(), gen())
+    next(it)
+    assert len(pulled) < 10
+    it.close()
+
+
+def test_retries():
+    session = FakeSession([503, 429, None, 500])
+    sched = scheduler.RequestScheduler(max_concurrency=1, backoff=0.001)
+
+    results = dict(sched.imap(session, requests_for(3)))
+
+    assert all(r.status_code == 200 for r in results.values())
+    assert sched.stats["retries"] == 4
+    assert sched.stats["throttled"] == 2
+    assert sched.stats["failed"] == 0
+
+
+def test_retries_exhausted():
+    sched = scheduler.RequestScheduler(max_retries=2, backoff=0.001)
+
+    # The last response is returned...
+    ((_, resp),) = sched.imap(FakeSession([500] * 3), requests_for(1))
+    assert resp.status_code == 500
+    assert sched.stats["failed"] == 1
+
+    # ... or the last error raised
+    with pytest.raises(requests.ConnectionError):
+        list(sched.imap(FakeSession([None] * 3), requests_for(1)))
+
+    # Client errors are not retried
+    ((_, resp),) = sched.imap(FakeSession([404]), requests_for(1))
+    assert resp.status_code == 404
+    assert sched.stats["retries"] == 4
+
+
+def test_throttling():
+    sched = scheduler.RequestScheduler(max_concurrency=8, backoff=0.001)
+    list(sched.imap(FakeSession([429]), requests_for(1)))
+    assert sched.stats["throttled"] == 1
+    assert sched.concurrency < 5
+
+
+def test_imap_requests(api, session):
+    api.errors = [503, 500]
+    voxels = np.random.default_rng(0).integers(0, 10_000, (1000, 3))
+
+    ids = bm.get_seg_at_location(
+        voxels, volume_id=VOLUME, raw_coords=True, session=session, max_threads=4
+    )
+
+    assert np.array_equal(np.asarray(ids, dtype=np.uint64), api.seg_ids(voxels))
+    assert scheduler.last_stats["retries"] == 2
+    assert scheduler.last_stats["requests"] == api.counts["values"]
+
+
+def test_metadata_retries(api, session):
+    api.errors = [429]
+    info = bm.get_volume_info(VOLUME, session=session)
+    assert info[0]["channelType"] == "UINT64"
+    assert api.counts["errors"] == 1
+
+
+def test_imap_concurrent_calls():
+    # One scheduler, calls with different caps - some above the scheduler's
+    sched = scheduler.RequestScheduler(max_concurrency=4, max_pool_size=16)
+    session = FakeSession()
+    caps = dict(a=2, b=8, c=32, d=3)
+    results = {}
+
+    def run(prefix):
+        results[prefix] = dict(
+            sched.imap(session, requests_for(40, prefix), caps[prefix])
+        )
+
+    threads = [threading.Thread(target=run, args=(p,)) for p in caps]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for prefix, cap in caps.items():
+        assert sorted(results[prefix]) == list(range(40))
+        assert session.peak[prefix] <= min(cap, sched.pool_size)
+    assert session.max_in_flight <= sched.pool_size
+    # Calls don't change the shared scheduler's settings
+    assert sched.max_concurrency == 4
+    assert sched.stats["requests"] == 160
+
+
+def test_shared_client(api):
+    voxels = np.random.default_rng(0).integers(0, 10_000, (2000, 3))
+    results = [None] * 4
+
+    with make_client(api, max_threads=4) as client:
+
+        def run(i):
+            results[i] = client.get_seg_at_location(
+                voxels[i::4], volume_id=VOLUME, raw_coords=True, max_threads=2 + i
+            )
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert client.scheduler.max_concurrency == 4
+        assert client.scheduler.stats["requests"] == api.counts["values"]
+
+    for i, ids in enumerate(results):
+        expected = api.seg_ids(voxels[i::4])
+        assert np.array_equal(np.asarray(ids, dtype=np.uint64), expected)
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pytest
+import trimesh
+
+import brainmappy as bm
+
+from conftest import VOLUME
+
+
+def make_mesh(n, value):
+    verts = np.full((n, 3), value, dtype=np.float32)
+    faces = np.arange(3 * n, dtype=np.uint32).reshape(-1, 3) % n
+    return verts, faces
+
+
+def check(store, object_id, n, value):
+    verts, faces = store[object_id]
+    expected = make_mesh(n, value)
+    assert np.array_equal(verts, expected[0])
+    assert np.array_equal(faces, expected[1])
+
+
+def test_mesh_store(tmp_path):
+    path = str(tmp_path)
+    with bm.MeshStore(path) as store:
+        store.add(1, *make_mesh(4, 1))
+        with store.writer(2) as w:
+            for _ in range(3):
+                w.add(*make_mesh(2, 2))
+
+        assert len(store) == 2 and 2 in store
+        assert store.info(2) == (6, 6)
+        # Faces of later pieces are offset by earlier pieces' vertices
+        assert store[2][1].max() == 5
+
+        # Re-adding an object replaces it
+        store.add(1, *make_mesh(5, 3))
+        check(store, 1, 5, 3)
+
+    with bm.MeshStore(path, mode="r") as store:
+        assert sorted(store) == [1, 2]
+        check(store, 1, 5, 3)
+        with pytest.raises(ValueError):
+            store.add(3, *make_mesh(1, 1))
+
+    with bm.MeshStore(path, mode="w") as store:
+        assert len(store) == 0
+
+
+def test_mesh_store_failed_writer(tmp_path):
+    with bm.MeshStore(str(tmp_path)) as store:
+        store.add(1, *make_mesh(4, 1))
+        with pytest.raises(RuntimeError):
+            with store.writer(2) as w:
+                w.add(*make_mesh(7, 2))
+                raise RuntimeError
+
+        assert 2 not in store
+        store.add(3, *make_mesh(3, 3))
+        check(store, 1, 4, 1)
+        check(store, 3, 3, 3)
+
+
+@pytest.mark.parametrize("torn", ["vertices", "faces", "index"])
+def test_mesh_store_torn_write(tmp_path, torn):
+    path = str(tmp_path)
+    with bm.MeshStore(path) as store:
+        store.add(1, *make_mesh(4, 1))
+        store.add(2, *make_mesh(3, 2))
+
+    # Simulate a crash while writing the next object: data was (partially)
+    # written but never made it into the index
+    with open(os.path.join(path, "vertices.bin"), "ab") as f:
+        f.write(b"\x01" * (12 * 5 if torn != "vertices" else 17))
+    with open(os.path.join(path, "faces.bin"), "ab") as f:
+        f.write(b"\x02" * (12 * 2 if torn != "faces" else 7))
+    if torn == "index":
+        with open(os.path.join(path, "index.bin"), "ab") as f:
+            f.write(b"\x03" * 11)
+
+    with bm.MeshStore(path) as store:
+        assert sorted(store) == [1, 2]
+        store.add(3, *make_mesh(6, 3))
+        check(store, 3, 6, 3)
+
+    with bm.MeshStore(path, mode="r") as store:
+        assert sorted(store) == [1, 2, 3]
+        check(store, 1, 4, 1)
+        check(store, 2, 3, 2)
+        check(store, 3, 6, 3)
+
+    # Nothing is left over
+    assert os.path.getsize(os.path.join(path, "vertices.bin")) == 12 * 13
+    assert os.path.getsize(os.path.join(path, "faces.bin")) == 12 * 13
+
+
+def test_get_meshes_store(api, session, tmp_path):
+    cache = bm.FragmentCache(str(tmp_path / "cache"))
+    ids = [7919, 42, 3000, 249]
+
+    with bm.MeshStore(str(tmp_path / "store")) as store:
+        # Fragments come from the cache and the API
+        bm.get_meshes_batch(42, volume_id=VOLUME, session=session, cache=cache)
+        assert (
+            bm.get_meshes_batch(
+                7919, volume_id=VOLUME, session=session, cache=cache, store=store
+            )
+            is store
+        )
+        with pytest.warns(UserWarning):
+            bm.get_meshes_bulk(
+                ids, volume_id=VOLUME, session=session, cache=cache, store=store
+            )
+
+        # Objects without fragments are skipped
+        assert sorted(store) == [42, 249, 7919]
+        for ob in store:
+            verts, faces = store[ob]
+            expected = trimesh.Trimesh(*api.mesh(ob), process=False)
+            mesh = trimesh.Trimesh(verts, faces, process=False)
+            # Fragments are written in the order they arrive
+            assert np.allclose(mesh.area, expected.area)
+            assert len(verts) == len(expected.vertices)
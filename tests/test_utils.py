@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+
+from brainmappy import utils
+
+
+@pytest.mark.parametrize("method", ["morton", "grid", "kmeans"])
+def test_chunk_coords(method):
+    rng = np.random.default_rng(0)
+    coords = rng.integers(0, 10_000, size=(1050, 3))
+
+    chunks = utils.chunk_coords(coords, 100, method=method)
+
+    # Every coordinate ends up in exactly one chunk
+    assert sorted(np.concatenate(chunks).tolist()) == list(range(len(coords)))
+    assert max(len(c) for c in chunks) <= 100
+    if method != "kmeans":
+        assert [len(c) for c in chunks] == [100] * 10 + [50]
+
+
+def test_chunk_coords_compact():
+    # Two well separated clusters must not share chunks
+    rng = np.random.default_rng(0)
+    coords = np.vstack(
+        [rng.integers(0, 100, (100, 3)), rng.integers(0, 100, (100, 3)) + 10**6]
+    )
+
+    for c in utils.chunk_coords(coords, 100):
+        assert len(np.unique(coords[c] // 10**6)) == 1
+
+
+def test_chunk_coords_small():
+    assert utils.chunk_coords(np.zeros((0, 3)), 10) == []
+    assert [c.tolist() for c in utils.chunk_coords(np.zeros((3, 3)), 10)] == [[0, 1, 2]]
+
+    with pytest.raises(ValueError):
+        utils.chunk_coords(np.zeros((20, 3)), 10, method="other")
+
+
+def test_encode_locations():
+    voxels = np.array([[0, 1, -2], [123, 45678, 9], [-(10**12), 10**18, 10]])
+
+    buf, offsets = utils.encode_locations(voxels)
+
+    expected = ['"{},{},{}",'.format(*v) for v in voxels]
+    assert buf.decode() == "".join(expected)
+    for i, e in enumerate(expected):
+        assert buf[offsets[i] : offsets[i + 1]].decode() == e
+
+    buf, offsets = utils.encode_locations(np.zeros((0, 3)))
+    assert buf == b"" and offsets.tolist() == [0]
+
+
+def test_decode_uint64_list():
+    values = [0, 1, 2**63, 2**64 - 1]
+    content = json.dumps(
+        {"uint64StrList": {"values": [str(v) for v in values]}}
+    ).encode()
+
+    ids = utils.decode_uint64_list(content)
+    assert ids.dtype == np.uint64
+    assert ids.tolist() == values
+
+    empty = utils.decode_uint64_list(b'{"uint64StrList": {"values": []}}')
+    assert len(empty) == 0 and empty.dtype == np.uint64
+
+    # Can't be parsed -> caller falls back to JSON
+    assert utils.decode_uint64_list(b"{}") is None
+    assert utils.decode_uint64_list(b'{"values": ["1", "x"]}') is None